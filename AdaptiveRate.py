@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+AdaptiveRate.py
+
+part of the Hybrid Parameter Monitor
+
+Adaptive measurement periods. A RateController watches the records of its
+channel and sets the channel's period between min_period and max_period:
+
+    transient -- a value changed by more than its deadband since the previous
+        record, changed faster than its rate per second, or its recent
+        standard deviation (exponentially weighted over about window records)
+        exceeds the deadband. The channel drops to min_period right away.
+    steady -- after hold seconds without a transient the period is
+        multiplied by backoff, step by step up to max_period.
+
+So the measurements, and the records published, follow the signal: fast
+during coil ramps or beam realignments, slow while it is steady. All tests
+run on arrays across the channel's dataNames, one transient value is enough.
+
+For devices delivering blocks of samples (the continuous DAQ) the blocks are
+watched too, the mean and standard deviation of each block against the
+previous one. A transient there wakes the channel at once through the
+scheduler (ChannelScheduler.wake) instead of waiting for its slow deadline.
+
+Controllers are read from HybridMonitor.cfg, one section per channel:
+
+    [Adaptive Beam_Balances]
+    min_period = 0.5
+    max_period = 10
+    deadband = 0.01
+    deadband.X1_std = 0.005
+    rate = 0.002
+"""
+
+import threading
+
+import numpy as np
+
+SETTINGS = ('min_period', 'max_period', 'backoff', 'hold', 'window', 'deadband', 'rate')
+# settings with one value per dataName, the others apply to the channel
+PER_NAME = ('deadband', 'rate')
+
+
+def load_adaptive(config, name, dataNames, period=None, blockNames=None):
+    """
+    Reads the rate controller of a channel from a ConfigParser object.
+    deadband and rate apply to all dataNames, "setting.dataname" overrides
+    one of them.
+    Arguments:
+        config -- ConfigParser object
+        name -- name of the channel, the section is "Adaptive <name>"
+        dataNames -- the channel's dataNames
+        period -- the channel's configured period, the starting period
+        blockNames -- names of the columns of the device's blocks of samples
+            the controller will watch (see RateController.blockListener),
+            they have to be dataNames too
+    Returns:
+        -controller: RateController, or None if the channel has no section
+    """
+    section = 'Adaptive ' + name
+    if not config.has_section(section):
+        return None
+    settings = {}
+    for option, value in config.items(section):
+        setting, _, dataName = option.partition('.')
+        setting = setting.lower()
+        if setting not in SETTINGS:
+            raise ValueError('unknown adaptive setting ' + repr(option) + ' in ' + section)
+        if setting not in PER_NAME:
+            settings[setting] = int(value) if setting == 'window' else float(value)
+            continue
+        perName = settings.setdefault(setting, {})
+        if not dataName:
+            perName[None] = float(value)
+            continue
+        for candidate in dataNames:
+            # ConfigParser lower cases option names unless told otherwise
+            if candidate.lower() == dataName.lower():
+                perName[candidate] = float(value)
+    for setting in PER_NAME:
+        if setting in settings:
+            perName = settings[setting]
+            default = perName.pop(None, None)
+            settings[setting] = [perName.get(key, default) for key in dataNames]
+    for setting in ('min_period', 'max_period'):
+        if setting not in settings:
+            raise ValueError(setting + ' missing in ' + section)
+    missing = [blockName for blockName in blockNames or () if blockName not in dataNames]
+    if missing:
+        # e.g. a continuous DAQ without the mean among its reductions
+        raise ValueError(section + ' watches the blocks of samples of ' + ', '.join(missing) +
+                         ', which are not values of the channel')
+    return RateController(name, dataNames, period=period, **settings)
+
+
+class RateController(object):
+    """
+    Sets the period of one channel from the activity of its values
+    """
+    def __init__(self, name, dataNames, min_period, max_period, period=None,
+                 deadband=None, rate=None, backoff=2.0, hold=None, window=10):
+        """
+        Arguments:
+            name -- name of the channel
+            dataNames -- the channel's dataNames
+            min_period, max_period -- bounds of the period in seconds
+            period -- starting period, max_period by default
+            deadband -- change, or recent standard deviation, of a value
+                which makes a transient. A number or a list with one entry
+                per dataName (None entries disable it for that dataName)
+            rate -- rate of change per second which makes a transient, like
+                deadband
+            backoff -- factor the period grows by in each steady step
+            hold -- seconds without a transient before each steady step,
+                max_period by default
+            window -- number of records the standard deviation is
+                weighted over
+        """
+        if not 0 < min_period <= max_period:
+            raise ValueError('periods of ' + name + ' must satisfy 0 < min_period <= max_period')
+        self.name = name
+        self.dataNames = list(dataNames)
+        self.minPeriod = float(min_period)
+        self.maxPeriod = float(max_period)
+        self.period = min(max(float(period or max_period), self.minPeriod), self.maxPeriod)
+        # disabled settings are infinite, so they never make a transient
+        self.deadband = self._setting(deadband)
+        self.rate = self._setting(rate)
+        self.backoff = backoff
+        self.hold = self.maxPeriod if hold is None else hold
+        self.alpha = 2.0/(window + 1)
+        self.transients = 0     # times the channel was sped up
+        self.wake = None        # called when a block makes a transient
+        self._lock = threading.Lock()
+        self.last = None        # values of the previous record
+        self.lastTime = None
+        self.quietSince = None  # time of the latest transient or steady step
+        self._mean = np.zeros(len(self.dataNames))
+        self._var = np.zeros(len(self.dataNames))
+        self._delta = np.zeros(len(self.dataNames))
+        self._score = np.zeros(len(self.dataNames))
+        self._blockIndex = None
+        self._blockLast = None
+        self._blockTime = None
+
+    def _setting(self, value):
+        """
+        Returns a setting as an array across dataNames, infinite where it is
+        not set
+        """
+        if value is None:
+            value = np.inf
+        if np.isscalar(value):
+            return np.full(len(self.dataNames), float(value))
+        return np.array([np.inf if v is None else v for v in value], dtype=np.float64)
+
+    def update(self, t, values):
+        """
+        Takes a record of the channel into account
+        Arguments:
+            t -- acquisition time of the record in seconds since the epoch
+            values -- array of the record's values in the order of dataNames
+        Returns:
+            -period: the channel's next period in seconds
+        """
+        with self._lock:
+            if self.last is None:
+                self.last = values.copy()
+                self.lastTime = t
+                self._mean[:] = values
+                self.quietSince = t
+                return self.period
+            dt = max(t - self.lastTime, 1e-9)
+            # NaN readings (e.g. an open thermocouple) leave the statistics of
+            # their dataName alone, they would stay NaN for good
+            finite = np.isfinite(values)
+            unseen = np.isnan(self._mean)
+            self._mean[unseen] = values[unseen]
+            # exponentially weighted mean and variance of the recent records
+            np.subtract(values, self._mean, out=self._delta)
+            self._delta[~finite] = 0
+            self._mean += self.alpha*self._delta
+            self._var += self.alpha*self._delta*self._delta
+            self._var *= np.where(finite, 1 - self.alpha, 1.0)
+            change = np.abs(values - self.last)
+            score = self._score
+            np.divide(change, self.deadband, out=score)
+            np.maximum(score, np.sqrt(self._var)/self.deadband, out=score)
+            np.maximum(score, change/(dt*self.rate), out=score)
+            # nor do they or the first reading after them make a transient
+            score[np.isnan(score)] = 0
+            np.copyto(self.last, values, where=finite)
+            self.lastTime = t
+            self._step(t, np.count_nonzero(score >= 1) > 0)
+            return self.period
+
+    def _step(self, t, transient):
+        """
+        Changes the period after a record or block, called holding the lock.
+        Returns True if the channel was sped up.
+        """
+        if self.quietSince is None:
+            self.quietSince = t
+        if transient:
+            self.quietSince = max(t, self.quietSince)
+            if self.period > self.minPeriod:
+                self.period = self.minPeriod
+                self.transients += 1
+                return True
+        elif t - self.quietSince >= self.hold and self.period < self.maxPeriod:
+            self.period = min(self.maxPeriod, self.period*self.backoff)
+            self.quietSince = t
+        return False
+
+    def blockListener(self, names):
+        """
+        Returns the function watching the blocks of samples of a device
+        Arguments:
+            names -- dataNames of the columns of the blocks
+        Returns:
+            -listener: called as listener(times, block) with the acquisition
+                times of the samples and an array of shape (samples, columns)
+        """
+        self._blockIndex = np.array([self.dataNames.index(name) for name in names], dtype=int)
+        return self.checkBlock
+
+    def checkBlock(self, times, block):
+        """
+        Compares the mean and standard deviation of a block of samples with
+        the previous block, and wakes the channel if they make a transient
+        """
+        mean = block.mean(axis=0)
+        std = block.std(axis=0)
+        t = 0.5*(float(times[0]) + float(times[-1]))
+        index = self._blockIndex
+        with self._lock:
+            last, lastTime = self._blockLast, self._blockTime
+            self._blockLast, self._blockTime = mean, t
+            if last is None:
+                return
+            change = np.abs(mean - last)
+            deadband = self.deadband[index]
+            score = np.maximum(change/deadband, std/deadband)
+            np.maximum(score, change/(max(t - lastTime, 1e-9)*self.rate[index]), out=score)
+            spedUp = self._step(t, np.count_nonzero(score >= 1) > 0)
+        if spedUp and self.wake is not None:
+            self.wake()
+
+    def stats(self):
+        """
+        Returns the current period and the number of transients
+        """
+        with self._lock:
+            return {'period' : self.period, 'transients' : self.transients}
@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+Alarms.py
+
+part of the Hybrid Parameter Monitor
+
+Alarm and interlock rules, checked on every new measurement before it is
+published, and on every block of samples of devices which deliver blocks
+(the continuous DAQ), so an alarm is raised within one block of the sample
+that caused it rather than with the next publish cycle:
+
+    high -- a value rose above high, cleared below high - hysteresis
+    low -- a value fell below low, cleared above low + hysteresis
+    rate -- a value changed faster than rate per second, cleared below
+        rate - rate_hysteresis
+    latch -- the alarms of a value stay raised until AlarmEngine.reset(),
+        for interlocks
+
+All tests run on arrays across the channel's dataNames and the samples of a
+block at once. The hysteresis state machine of a block is run without a loop
+over its samples: the state after each sample is the one set by the latest
+tripping or clearing sample so far. Every change of state inside the block is
+reported, dated by the sample which made it, so an alarm raised and cleared
+within one block is not lost.
+
+Only changes of alarm states leave the evaluating thread, through the
+AlarmEngine's queue to its notifier thread. The notifier calls the
+registered handlers (interlock actions) and hands the alarm states of the
+Hybrid_Alarms stream to the publisher as urgent records, which are sent
+ahead of the queued records without waiting for a batch to fill up.
+
+Rules are read from HybridMonitor.cfg, one section per channel:
+
+    [Alarms Temp]
+    high = 40
+    hysteresis = 0.5
+    high.coils = 60
+    rate.coils = 0.5
+    latch.coils = true
+"""
+
+import collections
+import Queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from HybridChannels import channel
+from LoopStats import LatencyHistogram
+
+SETTINGS = ('high', 'low', 'rate', 'hysteresis', 'rate_hysteresis', 'latch')
+CONDITIONS = ('high', 'low', 'rate')
+# bits of the alarm states published on the alarm stream
+BITS = {'high' : 1, 'low' : 2, 'rate' : 4}
+BOOLEANS = {'1' : True, 'yes' : True, 'true' : True, 'on' : True,
+            '0' : False, 'no' : False, 'false' : False, 'off' : False}
+
+# a change of the alarm state of one value
+#     time -- acquisition time of the sample which changed the state
+#     channel, dataName -- the value
+#     condition -- 'high', 'low' or 'rate'
+#     active -- True when the alarm was raised, False when it cleared
+#     value -- the sample (the rate for rate alarms)
+#     limit -- the limit it was compared against
+AlarmEvent = collections.namedtuple('AlarmEvent',
+    'time channel dataName condition active value limit')
+
+
+def load_alarms(config, name, dataNames, engine=None):
+    """
+    Reads the alarm rules of a channel from a ConfigParser object. Settings
+    apply to all dataNames, "setting.dataname" overrides one of them.
+    Arguments:
+        config -- ConfigParser object
+        name -- name of the channel, the section is "Alarms <name>"
+        dataNames -- the channel's dataNames
+        engine -- AlarmEngine the rules are added to
+    Returns:
+        -rules: AlarmRules, or None if the channel has no section
+    """
+    section = 'Alarms ' + name
+    if not config.has_section(section):
+        return None
+    settings = {}
+    for option, value in config.items(section):
+        setting, _, dataName = option.partition('.')
+        setting = setting.lower()
+        if setting not in SETTINGS:
+            raise ValueError('unknown alarm setting ' + repr(option) + ' in ' + section)
+        if setting == 'latch':
+            if value.lower() not in BOOLEANS:
+                raise ValueError('latch must be true or false, not ' + repr(value) + ' in ' + section)
+            value = BOOLEANS[value.lower()]
+        else:
+            value = float(value)
+        perName = settings.setdefault(setting, {})
+        if not dataName:
+            perName[None] = value
+            continue
+        for candidate in dataNames:
+            # ConfigParser lower cases option names unless told otherwise
+            if candidate.lower() == dataName.lower():
+                perName[candidate] = value
+    for setting, perName in settings.items():
+        default = perName.pop(None, None)
+        settings[setting] = [perName.get(key, default) for key in dataNames]
+    rules = AlarmRules(name, dataNames, **settings)
+    if engine is not None:
+        engine.add(rules)
+    return rules
+
+
+def _settle(trip, clear, active, latch):
+    """
+    Runs the hysteresis state machine of the alarms over a block of samples.
+    Arguments:
+        trip, clear -- boolean arrays of shape (samples, values), whether each
+            sample raises or clears the alarm. Never both for one sample
+        active -- boolean array of the states before the block
+        latch -- boolean array, latched alarms do not clear
+    Returns:
+        -active: the states after the block
+        -samples, values: arrays of the sample and value index of every
+            change of state in the block, in the order of the samples
+        -states: array of the state each change set
+    """
+    clear = clear & ~latch
+    if len(trip) == 1:
+        new = (active | trip[0]) & ~clear[0]
+        values = np.flatnonzero(new != active)
+        return new, np.zeros(len(values), dtype=int), values, new[values]
+    order = np.arange(1, len(trip) + 1)[:,None]
+    # for every sample the latest sample so far which tripped or cleared,
+    # counted from 1, 0 if none did yet
+    decided = np.maximum.accumulate(np.where(trip | clear, order, 0), axis=0)
+    columns = np.arange(trip.shape[1])
+    states = np.where(decided > 0, trip[np.maximum(decided - 1, 0), columns], active)
+    previous = np.vstack((active[None,:], states[:-1]))
+    samples, values = np.nonzero(states != previous)
+    return states[-1], samples, values, states[samples, values]
+
+
+class _Columns(object):
+    """
+    Limits and states of the dataNames of a channel which are checked
+    together, either in its records or in the blocks of its device. They are
+    gathered once so a check does not index them again.
+    """
+    def __init__(self, rules, columns):
+        self.index = np.array(columns, dtype=int)
+        index = self.index
+        self.names = [rules.dataNames[i] for i in columns]
+        self.limits = {'high' : rules.high[index], 'low' : rules.low[index],
+                       'rate' : rules.rate[index]}
+        self.clears = {'high' : rules.highClear[index], 'low' : rules.lowClear[index],
+                       'rate' : rules.rateClear[index]}
+        self.latch = rules.latch[index]
+        self.active = dict((condition, np.zeros(len(index), dtype=bool))
+                           for condition in CONDITIONS)
+        self.raised = dict((condition, False) for condition in CONDITIONS)
+        # the rates are only computed if one of them has a limit
+        self.hasRate = bool(np.isfinite(self.limits['rate']).any())
+        self.last = None        # latest sample, for the rates
+        self.lastTime = None
+
+
+class AlarmRules(object):
+    """
+    The alarm rules of one channel
+    """
+    def __init__(self, name, dataNames, high=None, low=None, rate=None,
+                 hysteresis=None, rate_hysteresis=None, latch=None):
+        """
+        Arguments:
+            name -- name of the channel
+            dataNames -- the channel's dataNames
+            high, low -- limits, a number or a list with one entry per
+                dataName (None entries disable them for that dataName)
+            rate -- limit of the absolute rate of change per second, like high
+            hysteresis -- how far a value has to move back past high or low
+                before the alarm clears, like high
+            rate_hysteresis -- the same for rate
+            latch -- True (or a list like high) to keep alarms raised until
+                reset(), for interlocks
+        """
+        self.name = name
+        self.dataNames = list(dataNames)
+        # disabled limits are infinite, so they never trip
+        self.high = self._setting(high, np.inf)
+        self.low = self._setting(low, -np.inf)
+        self.rate = self._setting(rate, np.inf)
+        hysteresis = self._setting(hysteresis, 0.0)
+        self.highClear = self.high - hysteresis
+        self.lowClear = self.low + hysteresis
+        self.rateClear = self.rate - self._setting(rate_hysteresis, 0.0)
+        self.latch = self._setting(latch, 0.0) != 0
+        self.engine = None
+        self.offset = None  # position of the values in the engine's states
+        self.blockNames = []
+        self._lock = threading.Lock()
+        self._record = _Columns(self, range(len(self.dataNames)))
+        self._block = None
+        self._values = np.zeros((1, len(self.dataNames)))
+        self._times = np.zeros(1)
+
+    def _setting(self, value, disabled):
+        """
+        Returns a setting as an array across dataNames, disabled where it is
+        not set
+        """
+        if value is None:
+            value = disabled
+        if np.isscalar(value):
+            return np.full(len(self.dataNames), float(value))
+        return np.array([disabled if v is None else v for v in value], dtype=np.float64)
+
+    def blockListener(self, names):
+        """
+        Returns the function checking the blocks of samples of a device. The
+        dataNames it covers are no longer checked in check(), the samples
+        already were.
+        Arguments:
+            names -- dataNames of the columns of the blocks
+        Returns:
+            -listener: called as listener(times, block) with the acquisition
+                times of the samples and an array of shape (samples, columns)
+        """
+        columns = [self.dataNames.index(name) for name in names]
+        with self._lock:
+            self.blockNames = list(names)
+            self._block = _Columns(self, columns)
+            self._record = _Columns(self, [i for i in range(len(self.dataNames))
+                                           if i not in columns])
+            self._values = np.zeros((1, len(self._record.index)))
+        return self.checkBlock
+
+    def check(self, t, data):
+        """
+        Checks a record of the channel
+        Arguments:
+            t -- acquisition time of the record in seconds since the epoch
+            data -- the channel's record, a Records.Record
+        """
+        columns = self._record
+        if not columns.names:
+            return
+        self._values[0] = data.values[columns.index]
+        self._times[0] = t
+        self._evaluate(columns, self._times, self._values)
+
+    def checkBlock(self, times, block):
+        """
+        Checks a block of samples of the columns given to blockListener
+        Arguments:
+            times -- array of the acquisition times of the samples
+            block -- array of shape (samples, columns)
+        """
+        self._evaluate(self._block, times, block)
+
+    def _evaluate(self, columns, times, block):
+        start = time.time()
+        limits = columns.limits
+        events = []
+        with self._lock:
+            samples = {'high' : block, 'low' : block}
+            trips = {'high' : block > limits['high'], 'low' : block < limits['low']}
+            if columns.hasRate:
+                if columns.lastTime is not None:
+                    # the first sample compares to the latest one of the
+                    # previous check
+                    if len(block) == 1:
+                        rate = np.abs(block - columns.last)
+                        rate /= max(float(times[0]) - columns.lastTime, 1e-9)
+                    else:
+                        change = np.diff(np.vstack((columns.last, block)), axis=0)
+                        dt = np.diff(np.concatenate(([columns.lastTime], times)))
+                        rate = np.abs(change)/np.maximum(dt, 1e-9)[:,None]
+                    samples['rate'] = rate
+                    trips['rate'] = rate > limits['rate']
+                columns.last = block[-1].copy()
+                columns.lastTime = float(times[-1])
+            for condition, trip in trips.items():
+                # count_nonzero is much cheaper than any() on small arrays
+                if not columns.raised[condition] and not np.count_nonzero(trip):
+                    continue
+                if condition == 'low':
+                    clear = samples[condition] > columns.clears[condition]
+                else:
+                    clear = samples[condition] < columns.clears[condition]
+                active = columns.active[condition]
+                new, rows, cols, states = _settle(trip, clear, active, columns.latch)
+                columns.active[condition] = new
+                columns.raised[condition] = np.count_nonzero(new) > 0
+                for k, j, state in zip(rows.tolist(), cols.tolist(), states.tolist()):
+                    events.append(AlarmEvent(float(times[k]), self.name, columns.names[j],
+                                             condition, state,
+                                             float(samples[condition][k,j]),
+                                             float(limits[condition][j])))
+        if self.engine is not None:
+            self.engine.evaluated(time.time() - start, events)
+
+    def states(self):
+        """
+        Returns the alarm state of every dataName as a bit field of BITS
+        """
+        states = np.zeros(len(self.dataNames), dtype=int)
+        with self._lock:
+            for columns in (self._record, self._block):
+                if columns is None:
+                    continue
+                for condition in CONDITIONS:
+                    states[columns.index] |= BITS[condition]*columns.active[condition]
+        return states
+
+    def reset(self):
+        """
+        Clears the alarms, including latched ones. Alarms whose values are
+        still past their limits are raised again by the next sample.
+        """
+        with self._lock:
+            for columns in (self._record, self._block):
+                if columns is None:
+                    continue
+                for condition in CONDITIONS:
+                    columns.active[condition][:] = False
+                    columns.raised[condition] = False
+
+
+class alarmChannel(channel):
+    """
+    Class representing the stream of alarm states, one bit field of BITS per
+    value with alarm rules. It is not scheduled, the AlarmEngine sends its
+    records.
+    """
+    def measure(self):
+        return self.data
+
+
+class AlarmEngine(object):
+    """
+    Collects the alarm rules of all channels and delivers their alarms from
+    its own notifier thread
+    """
+    def __init__(self, maxQueue=1000):
+        """
+        Arguments:
+            maxQueue -- maximum number of alarm events waiting for the
+                notifier, further events are dropped (and counted)
+        """
+        self.rules = []
+        self.dataNames = []
+        self.handlers = []
+        self.channel = None
+        self.publisher = None
+        self.timestamp = None
+        self.timestampKey = None
+        self.queue = Queue.Queue(maxQueue)
+        self.events = 0
+        self.dropped = 0
+        self.evaluation = LatencyHistogram(lowest=1e-7)  # duration of a check
+        self.latency = LatencyHistogram(lowest=1e-7)     # sample to notifier
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, rules):
+        """
+        Adds the rules of a channel
+        """
+        with self._lock:
+            rules.engine = self
+            rules.offset = len(self.dataNames)
+            self.rules.append(rules)
+            self.dataNames.extend(rules.name + '_' + dataName for dataName in rules.dataNames)
+
+    def remove(self, rules):
+        """
+        Removes the rules of a channel, e.g. one which failed to start,
+        before connect()
+        """
+        with self._lock:
+            if rules not in self.rules:
+                return
+            self.rules.remove(rules)
+            rules.engine = None
+            self.dataNames = []
+            for other in self.rules:
+                other.offset = len(self.dataNames)
+                self.dataNames.extend(other.name + '_' + dataName for dataName in other.dataNames)
+
+    def onAlarm(self, handler):
+        """
+        Registers handler to be called with every AlarmEvent, from the
+        notifier thread, e.g. an interlock switching off a power supply
+        """
+        self.handlers.append(handler)
+
+    def evaluated(self, duration, events):
+        """
+        Called by the rules after every check with its duration and the
+        changes of alarm states it found
+        """
+        # the histogram counts the evaluations
+        self.evaluation.add(duration)
+        if not events:
+            return
+        with self._lock:
+            self.events += len(events)
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except Queue.Full:
+                with self._lock:
+                    self.dropped += 1
+
+    def start(self):
+        """
+        Starts the notifier thread
+        """
+        self._thread = threading.Thread(target=self._run, name="alarms")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def connect(self, server, publisher, timestamp, timestampKey, dataType="float"):
+        """
+        Registers the alarm stream with the server, once the rules of all
+        channels were added. Alarms raised before are handled but not sent.
+        Arguments:
+            server -- the server class representing connection to Origin
+            publisher -- OriginPublisher sending the alarm states
+            timestamp -- callable returning the timestamp of a time in seconds
+                since the epoch, see TimeAlignment.originTimestamp
+            timestampKey -- name of the timestamp in the record
+            dataType -- data type of the alarm stream
+        """
+        if not self.dataNames:
+            return
+        self.publisher = publisher
+        self.timestamp = timestamp
+        self.timestampKey = timestampKey
+        self.channel = alarmChannel("Alarms", dataType, server, list(self.dataNames))
+
+    def _run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            self.latency.add(time.time() - event.time)
+            print ("ALARM " if event.active else "alarm cleared ") + event.channel + " " + \
+                event.dataName + " " + event.condition + " : %g (limit %g)" % (event.value, event.limit)
+            for handler in self.handlers:
+                try:
+                    handler(event)
+                except Exception:
+                    print "alarm handler failed"
+                    traceback.print_exc()
+            if self.channel is not None:
+                self._send(event)
+
+    def _send(self, event):
+        """
+        Hands the alarm states to the publisher, ahead of the queued records.
+        The publisher's worker owns the connections, and spools the states
+        while the stream is offline.
+        """
+        record = self.states()
+        record[self.timestampKey] = self.timestamp(event.time)
+        self.publisher.publish(self.channel, record, urgent=True)
+
+    def states(self):
+        """
+        Returns a dictionary of the alarm state of every value with rules
+        """
+        states = {}
+        for rules in list(self.rules):
+            for i, value in enumerate(rules.states().tolist()):
+                states[self.dataNames[rules.offset + i]] = value
+        return states
+
+    def reset(self, name=None):
+        """
+        Clears the alarms of the channel name, or of all channels
+        """
+        for rules in list(self.rules):
+            if name is None or rules.name == name:
+                rules.reset()
+
+    def stats(self):
+        """
+        Returns a dictionary of the engine's counters and timings
+        """
+        return {'evaluations' : self.evaluation.count,
+                'events' : self.events,
+                'dropped' : self.dropped,
+                'evaluation' : self.evaluation.snapshot(),
+                'latency' : self.latency.snapshot()}
+
+    def stop(self, timeout=None):
+        """
+        Stops the notifier once it delivered the pending alarms, and closes
+        the alarm stream
+        """
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout)
+        if self.channel is not None:
+            self.channel.hang()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+ChannelScheduler.py
+
+part of the Hybrid Parameter Monitor
+
+Runs the measurement of each channel in its own worker thread on a fixed
+deadline grid, so a slow device call on one channel can not hold up the others
+and the time spent measuring does not add to the measurement period.
+
+A channel's period is read again after every measurement, so it can be changed
+while the channel runs (e.g. by AdaptiveRate.RateController), and wake()
+measures a channel right away instead of at its next deadline.
+"""
+
+import sys
+import threading
+import time
+
+
+class ChannelScheduler(object):
+    """
+    Deadline scheduler for channels.
+
+    Every channel gets its own worker thread which calls task(channel) at
+    t0 + k*period. Deadlines are computed from the start time rather than from
+    the end of the previous call, so the period does not drift by however long
+    the task took. If a call overruns one or more deadlines, the missed slots
+    are skipped (and counted) instead of being run back to back.
+    """
+    def __init__(self, channels, task, defaultPeriod=10, recoverable=()):
+        """
+        Arguments:
+            channels -- iterable of channels to be scheduled
+            task -- callable taking a channel, run once per period. Any
+                exception raised by it stops the scheduler, unless it is
+                recoverable.
+            defaultPeriod -- period in seconds for channels whose period
+                attribute is None
+            recoverable -- tuple of exception types which only skip the
+                channel's current measurement, e.g. DeviceWorkers.DeviceError
+        """
+        self.channels = []
+        self.task = task
+        self.defaultPeriod = defaultPeriod
+        self.recoverable = tuple(recoverable)
+        self.missed = {}
+        self.failed = {}
+        self.errors = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._wakes = {}
+        self._t0 = None
+        for channel in channels:
+            self.add(channel)
+
+    def period(self, channel):
+        """
+        Returns the measurement period of the channel in seconds
+        """
+        period = getattr(channel, 'period', None)
+        if period is None:
+            period = self.defaultPeriod
+        return period
+
+    def add(self, channel):
+        """
+        Adds a channel to the scheduler. If the scheduler is already running
+        the channel's worker is started right away.
+        """
+        with self._lock:
+            self.channels.append(channel)
+            self.missed[channel.name] = 0
+            self.failed[channel.name] = 0
+            self._wakes[channel.name] = threading.Event()
+            if self._t0 is not None:
+                self._spawn(channel)
+
+    def start(self):
+        """
+        Starts one worker thread per channel. All channels share the same
+        start time so channels with commensurate periods stay in phase.
+        """
+        with self._lock:
+            self._t0 = time.time()
+            for channel in self.channels:
+                self._spawn(channel)
+
+    def _spawn(self, channel):
+        thread = threading.Thread(target=self._run,
+                                  args=(channel,),
+                                  name="scheduler-" + channel.name)
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+    def wake(self, channel):
+        """
+        Measures the channel right away instead of at its next deadline. Its
+        deadline grid restarts from there.
+        """
+        self._wakes[channel.name].set()
+
+    def _run(self, channel):
+        deadline = max(self._t0, time.time())
+        stats = getattr(channel, 'stats', None)
+        wake = self._wakes[channel.name]
+        while not self._stop.is_set():
+            if stats is not None:
+                stats.lateness.add(max(0.0, time.time() - deadline))
+            try:
+                self.task(channel)
+            except self.recoverable as e:
+                print "channel " + channel.name + " skipped a measurement : " + str(e)
+                self.failed[channel.name] += 1
+            except Exception:
+                print "channel " + channel.name + " failed, stopping scheduler"
+                self.errors.append((channel, sys.exc_info()))
+                self._stop.set()
+                return
+            period = self.period(channel)
+            deadline += period
+            late = time.time() - deadline
+            if late > 0:
+                skipped = int(late // period) + 1
+                self.missed[channel.name] += skipped
+                deadline += skipped*period
+            if wake.wait(max(0.0, deadline - time.time())):
+                wake.clear()
+                deadline = time.time()
+
+    def is_running(self):
+        """
+        Returns True until stop() has been called or a task has failed
+        """
+        return not self._stop.is_set()
+
+    def stop(self, timeout=None):
+        """
+        Stops all workers, waiting at most timeout seconds for each to return
+        from the task it is currently running.
+        """
+        self._stop.set()
+        for wake in self._wakes.values():
+            wake.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
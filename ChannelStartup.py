@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+ChannelStartup.py
+
+part of the Hybrid Parameter Monitor
+
+Starts the channels listed in HybridMonitor.cfg. Each "[Channel <name>]"
+section names the device module of the channel, and its options:
+
+    [Channel Temp]
+    device = PicosMonitor
+    period = 10
+    thermocouples = Chamber:1, Coils:2, Near_Terminal:3
+
+Only the device modules named in the config are imported. Every channel is
+started from its own thread, so the devices are opened and the streams
+registered with the server concurrently, and each channel is handed over
+(e.g. to the scheduler) as soon as it is ready. A slow or broken device only
+holds up its own channel.
+
+Options of every channel:
+    device -- device module, one of DEVICES
+    period -- measurement period in seconds, the monitor's default if missing
+    process -- run the device in its own worker process (DeviceWorkers.py)
+    rollups -- resolutions in seconds of rollup streams (Rollups.py)
+    publish_raw -- with rollups, false sends only the rollups to the server
+    data_type -- data type of the channel's streams, float by default
+The channel's reporting policy, alarm rules and adaptive period are read
+from its [Reporting <name>], [Alarms <name>] and [Adaptive <name>] sections.
+"""
+
+import collections
+import importlib
+import sys
+import threading
+import time
+import traceback
+
+from AdaptiveRate import load_adaptive
+from Alarms import load_alarms
+from DeviceWorkers import DeviceProcess
+from HybridChannels import tempChannel, I2VChannel, magChannel
+from ReportingPolicy import load_policy
+from Rollups import RollupStage
+
+# how a channel's device is created, measured and released. factory, args and
+# kwargs create the started device, see DeviceWorkers.DeviceProcess. blocks is
+# True if the device hands its blocks of samples to block listeners (alarm
+# checks, rate controllers)
+DeviceSpec = collections.namedtuple('DeviceSpec',
+    'channelClass dataNames factory args kwargs method closeMethod blocks')
+
+PICOS_DLL_PATH = "C:\Program Files\Pico Technology\SDK\lib"
+# the NI DAQ device of PickoffMonitor and MagSensor channels without daq option
+DAQ_DEVICE = 'PXI2Slot6'
+
+
+def _pairs(value):
+    """
+    Returns the (name, value) pairs of an option like "X1:ai4, X2:ai2"
+    """
+    pairs = []
+    for item in value.split(','):
+        name, _, target = item.partition(':')
+        pairs.append((name.strip(), target.strip()))
+    return pairs
+
+
+def _get(config, section, option, default=None, get=None):
+    if not config.has_option(section, option):
+        return default
+    return (get or config.get)(section, option)
+
+
+def tempDevice(module, config, section):
+    """
+    The TC-08 thermocouple logger (PicosMonitor.py). Options:
+        thermocouples -- name:channel pairs read from a single unit, not used
+            if the [Thermocouples] section maps thermocouples to several units
+        streaming -- run the TC-08 in streaming mode
+        dll_path -- location of usbtc08.dll
+    """
+    channels = module.load_thermocouples(config)
+    if not channels:
+        channels = dict((name, int(chan)) for name, chan in
+                        _pairs(config.get(section, 'thermocouples')))
+    kwargs = {'dll_path' : _get(config, section, 'dll_path', PICOS_DLL_PATH),
+              'streaming' : _get(config, section, 'streaming', False, config.getboolean)}
+    return DeviceSpec(tempChannel, channels.keys(), module.start_tc08,
+                      (channels,), kwargs, 'get_temp', 'close_unit', kwargs['streaming'])
+
+
+def I2VDevice(module, config, section):
+    """
+    The pickoff photodiodes on the NI DAQ (PickoffMonitor.py). Options:
+        inputs -- name:analog input pairs, e.g. X1:ai4
+        continuous -- sample continuously instead of triggered measurements
+        reductions -- continuous mode only, e.g. mean, std, min, max
+        sample_rate, every_n, window -- see PickoffMonitor.NIDAQmxAI
+        daq -- name of the DAQ device, PXI2Slot6 by default
+    The calibration is read from the [Pickoff Calibration] section.
+    """
+    inputs = dict(_pairs(config.get(section, 'inputs')))
+    kwargs = {'continuous' : _get(config, section, 'continuous', False, config.getboolean),
+              'calibration' : module.load_calibration(config)}
+    reductions = _get(config, section, 'reductions')
+    if reductions is not None:
+        kwargs['reductions'] = tuple(r.strip() for r in reductions.split(','))
+    for option in ('sample_rate', 'every_n', 'window'):
+        if config.has_option(section, option):
+            kwargs[option] = config.getint(section, option)
+    if config.has_option(section, 'daq'):
+        kwargs['device_name'] = config.get(section, 'daq')
+    dataNames = module.data_names(inputs, kwargs['continuous'],
+                                  kwargs.get('reductions', ('mean',)))
+    return DeviceSpec(I2VChannel, dataNames, module.NIDAQmxAI,
+                      (inputs,), kwargs, 'get_powers', 'close_task',
+                      kwargs['continuous'])
+
+
+def magDevice(module, config, section):
+    """
+    The three axis magnetic field sensor on the NI DAQ (MagSensor.py). Options:
+        axes -- name:analog input pairs, e.g. Bx:ai8
+        sample_rate, every_n, segment, overlap, mains, harmonics, bandwidth
+            -- see MagSensor.MagSensor
+        daq -- name of the DAQ device, PXI2Slot6 by default
+    The calibration is read from the [Mag Calibration] section.
+    """
+    axes = dict(_pairs(config.get(section, 'axes')))
+    kwargs = {'calibration' : module.load_mag_calibration(config)}
+    for option in ('sample_rate', 'every_n', 'segment', 'harmonics'):
+        if config.has_option(section, option):
+            kwargs[option] = config.getint(section, option)
+    for option in ('overlap', 'mains', 'bandwidth'):
+        if config.has_option(section, option):
+            kwargs[option] = config.getfloat(section, option)
+    if config.has_option(section, 'daq'):
+        kwargs['device_name'] = config.get(section, 'daq')
+    dataNames = module.data_names(axes, kwargs.get('mains', 60.0),
+                                  kwargs.get('harmonics', 3))
+    return DeviceSpec(magChannel, dataNames, module.MagSensor,
+                      (axes,), kwargs, 'get_field', 'close_task', True)
+
+
+# device module : function returning its DeviceSpec from the config
+DEVICES = {'PicosMonitor' : tempDevice,
+           'PickoffMonitor' : I2VDevice,
+           'MagSensor' : magDevice}
+
+
+def load_channels(config):
+    """
+    Returns the (name, section) of every channel in the config, in the order
+    of the file
+    """
+    return [(section[len('Channel '):], section) for section in config.sections()
+            if section.startswith('Channel ')]
+
+
+def daq_channels(config):
+    """
+    Returns the (name, daq device, continuous) of every channel of the config
+    on the NI DAQ
+    """
+    channels = []
+    for name, section in load_channels(config):
+        deviceName = config.get(section, 'device')
+        if deviceName == 'PickoffMonitor':
+            continuous = _get(config, section, 'continuous', False, config.getboolean)
+        elif deviceName == 'MagSensor':
+            continuous = True
+        else:
+            continue
+        channels.append((name, _get(config, section, 'daq', DAQ_DEVICE), continuous))
+    return channels
+
+
+class ChannelStartup(object):
+    """
+    Starts the channels of a config concurrently
+    """
+    def __init__(self, config, server, onReady, supervisor=None, alarms=None):
+        """
+        Arguments:
+            config -- ConfigParser object of HybridMonitor.cfg
+            server -- the server class representing connection to Origin
+            onReady -- called with each channel as soon as it is ready, from
+                the channel's startup thread
+            supervisor -- DeviceWorkers.DeviceSupervisor watching the devices
+                of channels with process = true
+            alarms -- Alarms.AlarmEngine the channels' alarm rules are added to
+        """
+        self.config = config
+        self.server = server
+        self.onReady = onReady
+        self.supervisor = supervisor
+        self.alarms = alarms
+        self.channels = []
+        self.errors = []
+        self.names = None       # the channels started, all by default
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self, names=None):
+        """
+        Starts one thread per channel of the config
+        Arguments:
+            names -- names of the channels to start, all of them by default
+        """
+        self.names = names
+        for name, section in load_channels(self.config):
+            if names is not None and name not in names:
+                continue
+            thread = threading.Thread(target=self._start, args=(name, section),
+                                      name="startup-" + name)
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def _start(self, name, section):
+        t0 = time.time()
+        try:
+            chan = self.open(name, section)
+        except Exception:
+            print "channel " + name + " failed to start"
+            traceback.print_exc()
+            with self._lock:
+                self.errors.append((name, sys.exc_info()))
+            return
+        print "channel " + chan.name + " ready after %.2f s" % (time.time() - t0)
+        with self._lock:
+            self.channels.append(chan)
+        self.onReady(chan)
+
+    def open(self, name, section):
+        """
+        Opens the device of a channel and registers the channel's streams
+        Returns:
+            -channel: the channel, with its rollups, reporting policy, alarm
+                rules and rate controller
+        """
+        config = self.config
+        deviceName = config.get(section, 'device')
+        if deviceName not in DEVICES:
+            raise ValueError('unknown device ' + repr(deviceName) + ' of channel ' + name)
+        spec = DEVICES[deviceName](importlib.import_module(deviceName), config, section)
+        self.checkDAQ(name)
+        device = self.openDevice(name, section, spec)
+        chan = None
+        try:
+            dataType = _get(config, section, 'data_type', 'float')
+            chan = spec.channelClass(name, dataType, self.server, spec.dataNames,
+                                     device, period=_get(config, section, 'period',
+                                                         None, config.getfloat))
+            rollups = _get(config, section, 'rollups')
+            if rollups is not None:
+                chan.rollups = RollupStage(chan, self.server,
+                                           [float(r) for r in rollups.split(',')],
+                                           publishRaw=_get(config, section, 'publish_raw',
+                                                           True, config.getboolean),
+                                           dataType=dataType)
+            chan.policy = load_policy(config, name, chan.dataNames)
+            chan.alarms = load_alarms(config, name, chan.dataNames, self.alarms)
+            if chan.alarms is not None and getattr(device, 'continuous', False):
+                # the values of continuous devices (the DAQ, a streaming
+                # TC-08) are checked on every block of samples instead of
+                # on the reduced records
+                device.add_block_listener(chan.alarms.blockListener(device.mapNames))
+            chan.adaptive = load_adaptive(config, name, chan.dataNames, chan.period,
+                                          blockNames=device.mapNames
+                                          if getattr(device, 'continuous', False) else None)
+            if chan.adaptive is not None:
+                chan.period = chan.adaptive.period
+                if getattr(device, 'continuous', False):
+                    # transients between two measurements wake the channel
+                    device.add_block_listener(chan.adaptive.blockListener(device.mapNames))
+        except Exception:
+            # do not keep the device open, the streams registered or the
+            # alarm rules checked for a channel which is not started
+            getattr(device, spec.closeMethod)()
+            if chan is not None:
+                if chan.alarms is not None and self.alarms is not None:
+                    self.alarms.remove(chan.alarms)
+                chan.hang()
+                if chan.rollups is not None:
+                    chan.rollups.hang()
+            raise
+        return chan
+
+    def checkDAQ(self, name):
+        """
+        Refuses a triggered DAQ channel on the same device as a continuous
+        one: its task of its own would take the device's inputs from the
+        shared task of the continuous channels (PickoffMonitor.SharedAITask),
+        or fail to start, depending on which channel opened first
+        Arguments:
+            name -- the channel to be opened
+        """
+        channels = [channel for channel in daq_channels(self.config)
+                    if self.names is None or channel[0] in self.names]
+        for channel, daq, continuous in channels:
+            if channel != name or continuous:
+                continue
+            for other, otherDaq, otherContinuous in channels:
+                if otherDaq == daq and otherContinuous:
+                    raise ValueError('triggered channel ' + name + ' can not share DAQ device ' +
+                                     daq + ' with continuous channel ' + other +
+                                     ', it needs continuous = true or another daq')
+
+    def openDevice(self, name, section, spec):
+        """
+        Returns the started device of a channel, in a worker process if the
+        channel's section says process = true. Block listeners can not be
+        added to a device in a worker process, so a device delivering blocks
+        of samples is refused there if the channel has alarm rules or a rate
+        controller.
+        Arguments:
+            name, section -- the channel and its section of the config
+            spec -- the channel's DeviceSpec
+        """
+        config = self.config
+        if _get(config, section, 'process', False, config.getboolean):
+            for listener in ('Alarms ', 'Adaptive '):
+                if spec.blocks and config.has_section(listener + name):
+                    raise ValueError('channel ' + name + ' can not check the blocks of samples '
+                                     'of its device in a worker process, [' + listener + name +
+                                     '] needs process = false')
+            device = DeviceProcess(spec.factory, spec.args, spec.kwargs,
+                                   dataNames=spec.dataNames, method=spec.method,
+                                   closeMethod=spec.closeMethod, name=name)
+            device.start()
+            if self.supervisor is not None:
+                self.supervisor.add(device)
+            return device
+        return spec.factory(*spec.args, **spec.kwargs)
+
+    def join(self, timeout=None):
+        """
+        Waits for all channels to be started or to have failed
+        Returns:
+            -channels: the started channels
+        """
+        end = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            # join in short steps, a join without timeout can not be
+            # interrupted by ctrl-c
+            while thread.is_alive() and (end is None or time.time() < end):
+                thread.join(0.5 if end is None else min(0.5, max(0, end - time.time())))
+        with self._lock:
+            return list(self.channels)
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+DeviceWorkers.py
+
+part of the Hybrid Parameter Monitor
+
+Runs a Device Monitor class in its own worker process, so a driver call that
+hangs only takes down that worker, and the device's number crunching runs on
+its own core instead of competing for the main process' GIL.
+
+The worker creates the device itself (driver handles can not be shared
+between processes) and measures it on request. Records are written to a
+SampleRing in shared memory, only the request and the row number go through
+the pipe and the main process reads the row in place. A DeviceSupervisor
+restarts workers which died or stopped answering.
+
+Usage:
+    temps = DeviceProcess(PicosMonitor.start_tc08, (tempChannels,),
+                          dataNames = tempChannels.keys(),
+                          method = 'get_temp', closeMethod = 'close_unit')
+    temps.start()
+    chan = tempChannel("Temp","float",serv,temps.dataNames,temps)
+
+The factory and its arguments are pickled to the worker on Windows, so the
+factory has to be a class or a function of an importable module, not of the
+main script.
+"""
+
+import ctypes
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from Records import value_order
+
+
+class DeviceError(Exception):
+    """
+    A measurement failed, in the device or in its worker process. The
+    scheduler only skips the channel's measurement (see HybridMonitor.py)
+    """
+    pass
+
+
+class DeviceUnavailable(DeviceError):
+    """
+    The worker process is not running, or did not answer in time
+    """
+    pass
+
+
+class SampleRing(object):
+    """
+    Ring buffer of records in shared memory. Each row holds the acquisition
+    time of the record followed by the values in the order of dataNames. Only the
+    worker writes, rows are numbered by a counter which only increases.
+    """
+    def __init__(self, dataNames, capacity=1024):
+        """
+        Arguments:
+            dataNames -- names of the values of a record
+            capacity -- number of records kept
+        """
+        self.dataNames = list(dataNames)
+        self.capacity = capacity
+        self.width = len(self.dataNames) + 1
+        self._buffer = multiprocessing.RawArray(ctypes.c_double, capacity*self.width)
+        self._written = multiprocessing.RawValue(ctypes.c_longlong, 0)
+        self._attach()
+
+    def _attach(self):
+        self.rows = np.frombuffer(self._buffer, dtype=np.float64).reshape(self.capacity, self.width)
+
+    def __getstate__(self):
+        # the numpy view is rebuilt on the shared buffer in the worker
+        state = self.__dict__.copy()
+        del state['rows']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    @property
+    def written(self):
+        """
+        Number of records written so far
+        """
+        return self._written.value
+
+    def write(self, t, data):
+        """
+        Writes a record.
+        Arguments:
+            t -- acquisition time of the record in seconds since the epoch
+            data -- dictionary of dataNames to values
+        Returns:
+            -seq: number of the record
+        """
+        row = self.next_row()
+        for i,name in enumerate(self.dataNames):
+            row[i+1] = data[name]
+        return self.commit(t)
+
+    def next_row(self):
+        """
+        Returns the row the next record goes to, for a device writing its
+        values in place (from column 1 on) before commit()
+        """
+        return self.rows[self._written.value % self.capacity]
+
+    def commit(self, t):
+        """
+        Announces the record written to next_row()
+        Arguments:
+            t -- acquisition time of the record in seconds since the epoch
+        Returns:
+            -seq: number of the record
+        """
+        seq = self._written.value
+        self.rows[seq % self.capacity, 0] = t
+        # the row is complete before the counter announces it
+        self._written.value = seq + 1
+        return seq
+
+    def row(self, seq):
+        """
+        Returns record seq as a view of the shared buffer, time first
+        """
+        if not self.written - self.capacity <= seq < self.written:
+            raise IndexError('record ' + str(seq) + ' is not in the ring')
+        return self.rows[seq % self.capacity]
+
+    def record(self, seq):
+        """
+        Returns the time and the dictionary of dataNames to values of record seq
+        """
+        row = self.row(seq)
+        return row[0], dict(zip(self.dataNames, row[1:].tolist()))
+
+    def latest(self, n=1):
+        """
+        Returns the latest n records as an array of shape (n, 1+len(dataNames)),
+        a view of the shared buffer unless the records wrap around its end
+        """
+        end = self.written
+        n = min(n, end, self.capacity)
+        first = (end - n) % self.capacity
+        if first + n <= self.capacity:
+            return self.rows[first:first+n]
+        return np.concatenate((self.rows[first:], self.rows[:first + n - self.capacity]))
+
+
+def _work(factory, args, kwargs, method, closeMethod, ring, conn):
+    """
+    Main function of a worker process. Creates the device, then answers
+    measurement requests until told to stop or the main process is gone.
+    """
+    try:
+        device = factory(*args, **kwargs)
+        measure = getattr(device, method)
+        # devices which can write their values in place skip the dictionary
+        measureInto = getattr(device, method + '_into', None)
+        if measureInto is not None:
+            order = device.value_order(ring.dataNames)
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+    conn.send(('ready', None))
+    try:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            try:
+                if measureInto is not None:
+                    measureInto(ring.next_row()[1:], order)
+                    data = None
+                else:
+                    data = measure()
+                t = getattr(device, 'acquisition_time', None)
+                t = time.time() if t is None else t
+                conn.send(('data', ring.write(t, data) if data is not None else ring.commit(t)))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    except (EOFError, IOError, KeyboardInterrupt):
+        pass
+    finally:
+        if closeMethod is not None:
+            getattr(device, closeMethod)()
+
+
+def _startProcess(process):
+    """
+    Starts a worker process. On Windows the worker would import the main
+    script again, for HybridMonitor.py that would start a second monitor, so
+    the script is hidden from it.
+    """
+    if sys.platform != 'win32':
+        process.start()
+        return
+    main = sys.modules['__main__']
+    mainFile = getattr(main, '__file__', None)
+    argv0 = sys.argv[0] if sys.argv else None
+    if mainFile is not None:
+        del main.__file__
+    if argv0 is not None:
+        sys.argv[0] = ''
+    try:
+        process.start()
+    finally:
+        if mainFile is not None:
+            main.__file__ = mainFile
+        if argv0 is not None:
+            sys.argv[0] = argv0
+
+
+class DeviceProcess(object):
+    """
+    A device running in its own worker process. It answers to the device's
+    measure and close methods, so the channel classes use it like the device
+    itself.
+    """
+    def __init__(self, factory, args=(), kwargs=None, dataNames=(),
+                 method='measure', closeMethod=None, timeout=30.0,
+                 startTimeout=60.0, capacity=1024, name=None):
+        """
+        Arguments:
+            factory -- class or function creating the started device in the
+                worker, called as factory(*args, **kwargs)
+            args, kwargs -- arguments of the factory
+            dataNames -- names of the values returned by the device
+            method -- name of the device's method returning a dictionary of
+                dataNames to values
+            closeMethod -- name of the device's method releasing it, called
+                by the worker when it stops
+            timeout -- seconds a measurement may take before the worker is
+                considered hung
+            startTimeout -- seconds the worker may take to create the device
+            capacity -- number of records kept in the shared ring
+            name -- name of the worker process
+        """
+        self.factory = factory
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.dataNames = list(dataNames)
+        self.method = method
+        self.closeMethod = closeMethod
+        self.timeout = timeout
+        self.startTimeout = startTimeout
+        self.name = name or getattr(factory, '__name__', 'device')
+        self.ring = SampleRing(self.dataNames, capacity)
+        self.process = None
+        self.ready = False
+        self.stopped = False
+        self.restarts = 0
+        self.acquisition_time = None    # acquisition time of the latest record
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == self.__dict__.get('method'):
+            return self.measure
+        if name == self.__dict__.get('method', '') + '_into':
+            return self.measure_into
+        if name == self.__dict__.get('closeMethod'):
+            return self.stop
+        raise AttributeError(name)
+
+    def start(self):
+        """
+        Starts the worker and waits until it created the device. Raises
+        DeviceError if that fails.
+        """
+        self.stopped = False
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_work, name=self.name,
+                                          args=(self.factory, self.args, self.kwargs,
+                                                self.method, self.closeMethod,
+                                                self.ring, child))
+        process.daemon = True
+        _startProcess(process)
+        child.close()
+        with self._lock:
+            self.process = process
+            self._conn = conn
+        if not conn.poll(self.startTimeout):
+            self._kill()
+            raise DeviceUnavailable(self.name + ' did not start within ' + str(self.startTimeout) + ' s')
+        try:
+            kind, value = conn.recv()
+        except EOFError:
+            kind, value = 'error', 'worker exited'
+        if kind != 'ready':
+            self._kill()
+            raise DeviceError(self.name + ' failed to start :\n' + value)
+        self.ready = True
+
+    def measure(self):
+        """
+        Measures the device in the worker
+        Returns:
+            -data: dictionary of dataNames to values
+        Raises DeviceError if the measurement failed and DeviceUnavailable if
+        the worker is not ready or did not answer within timeout.
+        """
+        with self._lock:
+            self.acquisition_time, data = self.ring.record(self._request())
+            return data
+
+    def _request(self):
+        """
+        Asks the worker for a measurement, called holding the lock
+        Returns:
+            -seq: number of the record in the ring
+        """
+        if not self.ready:
+            raise DeviceUnavailable(self.name + ' is not running')
+        try:
+            self._conn.send(True)
+            if not self._conn.poll(self.timeout):
+                self.ready = False
+                raise DeviceUnavailable(self.name + ' did not answer within ' + str(self.timeout) + ' s')
+            kind, value = self._conn.recv()
+        except (EOFError, IOError):
+            self.ready = False
+            raise DeviceUnavailable(self.name + ' exited')
+        if kind == 'error':
+            raise DeviceError(self.name + ' failed :\n' + value)
+        return value
+
+    def value_order(self, names):
+        """
+        Returns the index of the given names among dataNames, for measure_into
+        """
+        return value_order(self.dataNames, names)
+
+    def measure_into(self, out, order):
+        """
+        Measures the device in the worker like measure, but copies the values
+        from the shared ring into an array instead of building a dictionary.
+        Answers to the device's method name followed by _into, e.g.
+        get_temp_into
+        Arguments:
+            out -- float array the values are written to
+            order -- the values of out, from value_order()
+        """
+        with self._lock:
+            seq = self._request()
+            row = self.ring.row(seq)
+            self.acquisition_time = row[0]
+            out[:] = row[1:][order]
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def needs_restart(self):
+        """
+        Returns True if the worker is hung or died
+        """
+        return not self.stopped and (not self.ready or not self.is_alive())
+
+    def restart(self):
+        """
+        Replaces the worker with a new one
+        """
+        with self._lock:
+            self.ready = False
+            self._kill()
+        self.restarts += 1
+        self.start()
+
+    def _kill(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1.0)
+
+    def stop(self, timeout=5.0):
+        """
+        Asks the worker to release the device and exit, terminating it if it
+        does not within timeout seconds
+        """
+        self.stopped = True
+        with self._lock:
+            self.ready = False
+            if self._conn is not None:
+                try:
+                    self._conn.send(None)
+                except IOError:
+                    pass
+            if self.process is not None:
+                self.process.join(timeout)
+            self._kill()
+
+
+class DeviceSupervisor(object):
+    """
+    Thread restarting device workers which are hung or died
+    """
+    def __init__(self, workers, interval=2.0):
+        """
+        Arguments:
+            workers -- DeviceProcess objects to watch
+            interval -- seconds between checks, and between restart attempts
+                of a device which fails to start
+        """
+        self.workers = list(workers)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="device-supervisor")
+        self._thread.daemon = True
+
+    def add(self, worker):
+        """
+        Adds a DeviceProcess to watch, also while the supervisor is running
+        """
+        self.workers.append(worker)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for worker in list(self.workers):
+                if self._stop.is_set() or not worker.needs_restart():
+                    continue
+                print "restarting device worker " + worker.name
+                try:
+                    worker.restart()
+                except DeviceError as e:
+                    print e
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
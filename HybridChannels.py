@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+HybridChannels.py
+
+part of the Hybrid Parameter Monitor
+
+Channel classes connecting the Device Monitor classes to the Origin server.
+A channel registers a stream with the server and knows how to measure its
+device, HybridMonitor.py decides when the channels are measured.
+"""
+
+import time
+
+import numpy as np
+
+from LoopStats import ChannelStats, writeStatsFile
+from Records import RecordBuffer
+
+
+class channel(object):
+    """
+    A base class for all channels which connect to the server.
+    """
+    def __init__(self, name, dataType,server,dataNames,period=None,capacity=1024):
+        """
+        Arguments:
+            name -- the name of the channel to be used
+            dataType -- the data type to be written to the server.
+                for options see ../lib/origin/origin_data_types.py
+                or origin-test-datatypes-binary
+            server -- the server class representing connection to Origin
+            dataNames -- the names of the different data sets to be sent over
+                this channel
+            period -- measurement period of this channel in seconds. None uses
+                the scheduler's default period
+            capacity -- number of records kept in the channel's RecordBuffer,
+                a record not sent within capacity newer records is dropped
+        """
+        self.name = "Hybrid_" + name
+        self.period = period
+        self.capacity = capacity
+        self.buffer = None # Records.RecordBuffer of the measured records, made by newRecord()
+        self.stats = ChannelStats()
+        self.rollups = None # Rollups.RollupStage of this channel, if any
+        self.policy = None # ReportingPolicy.ReportingPolicy of this channel, if any
+        self.alarms = None # Alarms.AlarmRules of this channel, if any
+        self.adaptive = None # AdaptiveRate.RateController setting the period, if any
+        self.alignment = None # TimeAlignment.GridAligner this channel is part of, if any
+        # acquisition time of the latest measurement in seconds since the
+        # epoch, as reported by the device. None if the device does not
+        self.acquisitionTime = None
+        self.dataType = dataType
+        self.serv = server
+        self.records = {}
+        self.dataNames = dataNames
+        for dataName in dataNames:
+            self.records.update({dataName:dataType})
+        self.connection = self.connect()
+        self.data = {}
+
+    def newRecord(self, data=None):
+        """
+        Returns the next Records.Record of the channel, for measure() to fill
+        in place
+        Arguments:
+            data -- dictionary of dataNames to values copied into the record,
+                for channels measuring dictionaries
+        """
+        if self.buffer is None:
+            self.buffer = RecordBuffer(self.dataNames, self.capacity)
+        if data is not None:
+            return self.buffer.fill(data)
+        return self.buffer.next()
+        
+    def connect(self, timeout=30) :
+        """
+        lets the server know we going to be sending this type of data
+        Arguments:
+            timeout -- seconds to wait for the server
+        """
+        print self.records
+        chan = self.serv.registerStream(
+                stream = self.name, 
+                records = self.records,
+                timeout = int(timeout*1000))
+        return chan
+    def reconnect(self, timeout=30):
+        """
+        Registers the stream again after its connection failed. The device
+        is left alone. Raises IOError if the server does not accept it.
+        """
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        connection = self.connect(timeout)
+        if not connection:
+            raise IOError('registering ' + self.name + ' failed')
+        self.connection = connection
+    def measure(self) :
+        """
+        Overwrite this funciton with something that returns your data
+        should return an list with the same dimensions as dataNames.
+        Preferably fill a record from newRecord() instead, dictionaries
+        are copied into one by measureAndPublish.
+        """
+        self.data = dict(zip(
+                self.dataNames,
+                np.random(1,len(self.dataNames)).tolist()
+                ))
+        return self.data
+    def hang(self):
+        """
+        Closes connection with the server. Returns status/error
+        """
+        self.connection.close()
+    def close(self):
+        """
+        Closes the connection with the server and releases the device, when
+        the monitor stops
+        """
+        self.hang()
+        
+class tempChannel(channel):
+    """
+    Class to deal with a channel opened to monitor the temperature
+    """
+    def __init__(self, name, dataType,server,dataNames,picos,period=None):
+        """
+        Arguments
+            picos -- object representing connection to picos TC-08 temperature
+                monitor
+        """
+        super(tempChannel,self).__init__(name, dataType,server,dataNames,period)
+        self.picos = picos
+        self._order = picos.value_order(dataNames)
+    def measure(self) :
+        """
+        Determines the temperatures measured at different locations in hybrid.
+        The device writes them straight into a record of the channel, in the
+        order of dataNames
+        """
+        record = self.newRecord()
+        self.picos.get_temp_into(record.values, self._order)
+        self.acquisitionTime = self.picos.acquisition_time
+        self.data = record
+        return record
+    def close(self):
+        self.picos.close_unit()
+        self.hang()
+
+class I2VChannel(channel):
+    """
+    Class to deal with analog inputs from the NIDAQmx monitors
+    """
+    def __init__(self,name,dataType,server,dataNames,I2Vmonitor,period=None):
+        super(I2VChannel,self).__init__(name,dataType,server,dataNames,period)
+        self.I2Vmonitor = I2Vmonitor
+        self._order = I2Vmonitor.value_order(dataNames)
+    def measure(self):
+        """
+        Calls the NIDAQ's measurement class, which writes the powers organized by the channel mapping into a record of the channel
+        """
+        record = self.newRecord()
+        self.I2Vmonitor.get_powers_into(record.values, self._order)
+        self.acquisitionTime = self.I2Vmonitor.acquisition_time
+        self.data = record
+        return record
+    def close(self) :
+        """
+        Closes the connection with the server and the open tasks in DAQmx.
+        hang() only closes the connection, so a server failure leaves the
+        task running
+        """
+        self.I2Vmonitor.close_task()
+        self.hang()
+        
+class magChannel(channel):
+    """
+    Class to deal with the magnetic field monitor near the science chamber
+    """
+    def __init__(self, name, dataType,server,dataNames,magSensor,period=None):
+        """
+        Arguments
+            magSensor -- MagSensor.MagSensor object representing connection
+                to the magnetic field sensor
+        """
+        super(magChannel,self).__init__(name, dataType,server,dataNames,period)
+        self.magSensor = magSensor
+        self._order = magSensor.value_order(dataNames)
+    def measure(self):
+        """
+        Determines the mean magnetic field and its mains band amplitudes
+        since the previous measurement, written into a record of the channel
+        in the order of dataNames
+        """
+        record = self.newRecord()
+        self.magSensor.get_field_into(record.values, self._order)
+        self.acquisitionTime = self.magSensor.acquisition_time
+        self.data = record
+        return record
+    def close(self) :
+        """
+        Closes the connection with the server and the sensor's DAQmx task
+        """
+        self.magSensor.close_task()
+        self.hang()
+
+
+class statsChannel(channel):
+    """
+    Class publishing the timing statistics of the other channels, and the
+    publisher's counters, as a stream of its own. Each measurement reports the
+    statistics since the previous one.
+    """
+    QUANTITIES = ('p50', 'p95', 'max')
+    PUBLISHER = ('depth', 'dropped', 'spool depth', 'reconnects')
+
+    def __init__(self, name, dataType, server, channels, publisher=None,
+                 statsFile=None, statsServer=None, period=None):
+        """
+        Arguments
+            channels -- the channels whose statistics are published
+            publisher -- OriginPublisher whose counters are published
+            statsFile -- path of a JSON file the statistics are also written to
+            statsServer -- LoopStats.StatsServer serving the statistics
+        """
+        self.channels = channels
+        self.publisher = publisher
+        self.statsFile = statsFile
+        self.statsServer = statsServer
+        self._names = []
+        # the current period of channels with an adaptive rate
+        self._periods = []
+        for chan in channels:
+            short = chan.name[len("Hybrid_"):]
+            for metric in ChannelStats.METRICS:
+                for quantity in self.QUANTITIES:
+                    self._names.append((short + '_' + metric + '_' + quantity,
+                                        chan.name, metric, quantity))
+            if chan.adaptive is not None:
+                self._periods.append((short + '_period', chan))
+        dataNames = [dataName for dataName, _, _, _ in self._names]
+        dataNames += [dataName for dataName, _ in self._periods]
+        if publisher is not None:
+            dataNames += ['publisher_' + key.replace(' ', '_') for key in self.PUBLISHER]
+        super(statsChannel,self).__init__(name, dataType,server,dataNames,period)
+
+    def measure(self):
+        """
+        Collects the statistics of all channels, resetting them. Missing
+        values (no samples in the interval) are reported as NaN
+        """
+        snapshot = dict((chan.name, chan.stats.snapshot(reset=True))
+                        for chan in self.channels)
+        if self.publisher is not None:
+            snapshot['publisher'] = self.publisher.stats()
+        snapshot['time'] = time.time()
+        if self.statsFile is not None:
+            writeStatsFile(self.statsFile, snapshot)
+        if self.statsServer is not None:
+            self.statsServer.update(snapshot)
+
+        record = self.newRecord()
+        values = record.values
+        for i, (dataName, chanName, metric, quantity) in enumerate(self._names):
+            value = snapshot[chanName][metric][quantity]
+            values[i] = np.nan if value is None else value
+        offset = len(self._names)
+        for i, (dataName, chan) in enumerate(self._periods):
+            values[offset + i] = chan.adaptive.period
+        offset += len(self._periods)
+        if self.publisher is not None:
+            for i, key in enumerate(self.PUBLISHER):
+                values[offset + i] = snapshot['publisher'][key]
+        self.data = record
+        return record
+
+
+def flushRollups(channels):
+    """
+    Publishes the incomplete rollup buckets of the channels, before the
+    publisher stops
+    Arguments:
+        channels -- array of channels
+    """
+    for channel in channels:
+        if channel.rollups is not None:
+            channel.rollups.flush()
+
+
+def closeAll (channels):
+    """
+    closes all the channels in the argument.
+    Arguments:
+        channels -- array of channels
+    """
+    aligners = []
+    for channel in channels:
+        print "closing channel : " + channel.name
+        channel.close()
+        if channel.rollups is not None:
+            channel.rollups.hang()
+        if channel.alignment is not None and channel.alignment not in aligners:
+            aligners.append(channel.alignment)
+            channel.alignment.hang()
+
+
+def measureAndPublish(channel, publisher, timestamp, timestampKey):
+    """
+    Measures a channel, timestamps the data with the time the device acquired
+    it (or the end of the measurement if the device does not tell) and hands
+    it to the publisher. The channel's alarm rules check the record before
+    anything else, then its rate controller sets the channel's next period.
+    Rollups and the time alignment see every record, the channel's reporting
+    policy then decides which records are published.
+    The record is a Records.Record on a row of the channel's buffer, no
+    dictionary is built until the publisher sends it.
+    Arguments:
+        channel -- the channel to be measured
+        publisher -- OriginPublisher writing the record to the server
+        timestamp -- callable returning the timestamp of a time in seconds
+            since the epoch, see TimeAlignment.originTimestamp
+        timestampKey -- name of the timestamp in the record
+    Returns:
+        -data: the published record, a Records.Record
+    """
+    start = time.time()
+    data = channel.measure()
+    end = time.time()
+    channel.stats.measure.add(end - start)
+    if isinstance(data, dict):
+        data = channel.newRecord(data)
+    t = end if channel.acquisitionTime is None else channel.acquisitionTime
+    data.stamp(t, timestamp(t), timestampKey)
+    if channel.alarms is not None:
+        channel.alarms.check(t, data)
+    if channel.adaptive is not None:
+        channel.period = channel.adaptive.update(t, data.values)
+    archiveOnly = False
+    if channel.rollups is not None:
+        channel.rollups.add(data, t, timestampKey, publisher)
+        archiveOnly = not channel.rollups.publishRaw
+    if channel.alignment is not None:
+        channel.alignment.add(channel, t, data, timestampKey, publisher)
+    records = [data] if channel.policy is None else channel.policy.filter(t, data)
+    for record in records:
+        if not publisher.publish(channel, record, archiveOnly):
+            print "publisher queue full, dropped record of " + channel.name
+    return data
@@ -10,153 +10,49 @@ Origin data server.
 '''
 TO DO:
     [ ] 1. Implement a GUI in pyqt5
-    [ ] 2. Implement and import the magSensor class
+    [x] 2. Implement and import the magSensor class
     [ ] 3. Determine failure conditions throughout and add corresponding ifs/trys
     [ ] 4. Fix PickoffMonitor.py to work in general for the NI DAQmx with any given set of inputs
-    [ ] 5. Make separate file setup for channel classes
-    [ ] 6. Make Device Monitor classes work with config files
+    [x] 5. Make separate file setup for channel classes
+    [x] 6. Make Device Monitor classes work with config files
 '''
 
 #!/usr/bin/env python
 import os
 import time
-import numpy as np
 import sys
-import PicosMonitor
-import PickoffMonitor
-import signal
-
-
-
-class channel(object):
-    """
-    A base class for all channels which connect to the server.
-    """
-    def __init__(self, name, dataType,server,dataNames):
-        """
-        Arguments:
-            name -- the name of the channel to be used
-            dataType -- the data type to be written to the server.
-                for options see ../lib/origin/origin_data_types.py
-                or origin-test-datatypes-binary
-            server -- the server class representing connection to Origin
-            dataNames -- the names of the different data sets to be sent over
-                this channel
-        """
-        self.name = "Hybrid_" + name
-        self.dataType = dataType
-        self.serv = server
-        self.records = {}
-        self.dataNames = dataNames
-        for dataName in dataNames:
-            self.records.update({dataName:dataType})
-        self.connection = self.connect()
-        self.data = {}
-        
-    def connect(self) :
-        """
-        lets the server know we going to be sending this type of data
-        """
-        print self.records
-        chan = self.serv.registerStream(
-                stream = self.name, 
-                records = self.records,
-                timeout = 30*1000)
-        return chan
-    def measure(self) :
-        """
-        Overwrite this funciton with something that returns your data
-        should return an list with the same dimensions as dataNames.
-        """
-        self.data = dict(zip(
-                self.dataNames,
-                np.random(1,len(self.dataNames)).tolist()
-                ))
-        return self.data
-    def hang(self):
-        """
-        Closes connection with the server. Returns status/error
-        """
-        self.connection.close()
-        
-class tempChannel(channel):
-    """
-    Class to deal with a channel opened to monitor the temperature
-    """
-    def __init__(self, name, dataType,server,dataNames,picos):
-        """
-        Arguments
-            picos -- object representing connection to picos TC-08 temperature
-                monitor
-        """
-        super(tempChannel,self).__init__(name, dataType,server,dataNames)
-        self.picos = picos
-    def measure(self) :
-        """
-        Determines the temperatures measured at different locations in hybrid.
-        saves them to data as a dictionary mapped to datanames (make sure you
-        get the order right)
-        """
-        self.data = self.picos.get_temp()
-        return self.data
-
-class I2VChannel(channel):
-    """
-    Class to deal with analog inputs from the NIDAQmx monitors
-    """
-    def __init__(self,name,dataType,server,dataNames,I2Vmonitor):
-        super(I2VChannel,self).__init__(name,dataType,server,dataNames)
-        self.I2Vmonitor = I2Vmonitor
-    def measure(self):
-        """
-        Calls the NIDAQ's measurement class, which should return an array of powers organized by the channel mapping
-        """
-        self.data = self.I2Vmonitor.get_powers()
-        return self.data
-    def hang(self) :
-        """
-        Closes the connection with the server. Returns status/error and closes open tasks in DAQmx
-        """
-        self.I2Vmonitor.close_task()
-        self.connection.close()
-        
-class magChannel(channel):
-    """
-    Class to deal with the magnetic field monitor near the science chamber
-    """
-    def __init__(self, name, dataType,server,dataNames,magSensor):
-        """
-        Arguments
-            magSensor -- represents connection to magnetic field sensor (Not 
-            yet installed)
-        """
-        super(tempChannel,self).__init__(name, dataType,server,dataNames)
-        self.magSensor = magSensor
-    def measure(self):
-        """
-        Determines the magnetic field measured by the sensor, saves it to data
-        as a dictionary mapped to datanames (make sure you get the order right)
-        """
-        self.data = dict(zip(
-                self.dataNames,
-                self.magSensor.getField()
-                ))
-        return self.data
-
-
-def closeAll (channels):
+import functools
+import ConfigParser
+from ChannelScheduler import ChannelScheduler
+from OriginPublisher import OriginPublisher
+from HybridChannels import statsChannel, closeAll, flushRollups, measureAndPublish
+from LoopStats import StatsServer
+from StreamArchive import Archive
+from DeviceWorkers import DeviceSupervisor, DeviceError
+from ChannelStartup import ChannelStartup
+from TimeAlignment import originTimestamp, load_alignment
+from Alarms import AlarmEngine
+
+
+def sendMeasurement(channel):
     """
-    closes all the channels in the argument.
+    Measures a channel, timestamps the data and hands it to the publisher,
+    which writes it to the server from its own thread.
+    Called by the scheduler from the channel's own worker thread.
     Arguments:
-        channels -- array of channels
+        channel -- the channel to be measured
     """
-    for channel in channels:
-        print "closing channel : " + channel.name
-        channel.hang()
+    print "sending " + channel.name
+    data = measureAndPublish(channel, publisher, timestamp, TIMESTAMP)
+    # the record itself is not printed, that would build its dictionary
+    print channel.name + " measured at %.3f" % data.time
         
-measurementPeriod = 10 #s
+measurementPeriod = 10 #s default, channels can set their own period
+statsPeriod = 60 #s between timing statistics published on the stats stream
+statsPort = None #port of the local http endpoint serving the statistics, None to disable
+archiveRecords = True #keep a local columnar archive of every record in archive/
 
-t0 = time.clock()
+t0 = time.time()
 #we must first find ourselves
 print 'finding ourselves'
 fullBinPath  = os.path.abspath(os.getcwd() + "/" + sys.argv[0])
@@ -171,23 +67,10 @@ print 'getting origin'
 from origin.client import server
 from origin import current_time, TIMESTAMP
 
-print 'initializing picos'
-#initialize the picos 
-tempChannels = {"Chamber" : 1,"Coils" : 2,"Near_Terminal" : 3}
-picosDLLPath = "C:\Program Files\Pico Technology\SDK\lib"
-picos = PicosMonitor.TC08USB(dll_path = picosDLLPath)
-print repr(picos.TC_ERRORS[picos.start_unit(tempChannels)])
-
-print 'initializing pickoff monitor'
-#initialize the pickoff monitor
-I2VChannels = {"X1" : 'ai4',
-               "X2" : 'ai2',
-               "Y1" : 'ai0',
-               "Y2" : 'ai1',
-               "Z1" : 'ai3',
-               "Z2" : 'ai5'}
-I2V = PickoffMonitor.NIDAQmxAI(I2VChannels)
-
+print 'reading monitor config'
+monitorConfig = ConfigParser.ConfigParser()
+monitorConfig.optionxform = str #keep the case of the thermocouple names
+monitorConfig.read(os.path.join(fullBasePath, "HybridMonitor.cfg"))
 
 print 'grabbing config file'
 if len(sys.argv) > 1:
@@ -198,55 +81,84 @@ if len(sys.argv) > 1:
 else:
     configfile = os.path.join(fullCfgPath, "origin-server.cfg")
 
-import ConfigParser
 config = ConfigParser.ConfigParser()
 print configfile
 config.read(configfile)
+# records are stamped with the time their device acquired them, in the
+# units of origin's timestamps
+timestamp = originTimestamp(lambda : current_time(config))
 
 # something that represents the connection to the server
 print 'grabbing server'
 serv = server(config)
+print 'begin communication'
+# records are sent in batches by the publisher's worker, so a slow server does
+# not hold up the measurements. While the server is unreachable records are
+# spooled to disk and replayed once it is back
+publisher = OriginPublisher(batchSize = 100, maxDelay = 1.0, maxQueue = 10000,
+                            spoolDirectory = os.path.join(fullBasePath, "spool"),
+                            timestampKey = TIMESTAMP,
+                            archive = Archive(os.path.join(fullBasePath, "archive"), TIMESTAMP)
+                                      if archiveRecords else None)
+publisher.start()
+# each channel is measured from its own thread on its own deadlines, a slow
+# device only delays its own channel
+# a failed or hung device worker only costs its channel that measurement
+scheduler = ChannelScheduler([], sendMeasurement, measurementPeriod,
+                             recoverable = (DeviceError,))
+scheduler.start()
+# restarts device workers which hung or died
+supervisor = DeviceSupervisor([])
+supervisor.start()
+# alarm rules of the channels, see [Alarms <channel>] in HybridMonitor.cfg.
+# Alarms are delivered from their own thread, not with the publisher's batches
+alarms = AlarmEngine()
+alarms.start()
+
 print 'opening channels'
-#open the channels
+# the channels of HybridMonitor.cfg are started concurrently, each one is
+# measured as soon as its device is open and its streams are registered
 channels = []
-channels.append(tempChannel("Temp","float",serv,tempChannels.keys(),picos))
-channels.append(I2VChannel("Beam_Balances","float",serv,I2VChannels.keys(),I2V))
-#    channels.append(magChannel("B","float",serv,["X,Y,Z"]))
-
-
-# This might need to be more complicated, but you get the gist. Keep sending records forever
-time.sleep(10)
-
-print 'begin communication'
-err = 0
-#TODO : Make timinig consistent despite wait blocks in monitor classes
-#TODO : Write data to channels in multiple threads once the number of channels gets large
-while True:
-    try:
-        #t1 = time.clock()
-        for channel in channels :
-            print "sending " + channel.name
-            print "Measured :" + repr(channel.measure())
-            ts = current_time(config)
-            data = channel.data
-            data.update({TIMESTAMP:ts})
-            try:
-                channel.connection.send(**channel.data)
-            except:
-                closeAll(channels)
-                err = 1
-                break
-            print(data)
-            #interrupt this with a keystroke and hang connection
-        if err == 1 :
-            break
-        time.sleep(measurementPeriod)
-        #FOR TIMING: 
-        #t2 = time.clock()
-        #deltaT = t2 - t1
-        #time.sleep(measurementPeriod - deltaT)
-        
-    except KeyboardInterrupt :
-        closeAll(channels)
-        raise KeyboardInterrupt
-        break
+def channelReady(chan):
+    # every queued record keeps its row until it is sent, as in Replay.py
+    chan.capacity = publisher.queue.maxsize + 2*publisher.batchSize
+    channels.append(chan)
+    scheduler.add(chan)
+    if chan.adaptive is not None:
+        # a transient in the DAQ's samples measures the channel right away
+        chan.adaptive.wake = functools.partial(scheduler.wake, chan)
+startup = ChannelStartup(monitorConfig, serv, channelReady, supervisor, alarms)
+startup.start()
+startup.join()
+# channels resampled onto a common time grid, see [Alignment] in HybridMonitor.cfg
+aligner = load_alignment(monitorConfig, channels, serv, timestamp)
+alarms.connect(serv, publisher, timestamp, TIMESTAMP)
+print 'channels started after %.1f s' % (time.time() - t0)
+
+# timing statistics of every channel and the publisher, published on their own
+# stream and written to HybridMonitor_stats.json
+statsServer = None
+if statsPort is not None:
+    statsServer = StatsServer(statsPort)
+    statsServer.start()
+channelReady(statsChannel("Stats","float",serv,list(channels),publisher,
+                          statsFile = os.path.join(fullBasePath, "HybridMonitor_stats.json"),
+                          statsServer = statsServer,
+                          period = statsPeriod))
+try:
+    while scheduler.is_running() and publisher.is_running():
+        time.sleep(1)
+except KeyboardInterrupt :
+    supervisor.stop()
+    scheduler.stop(measurementPeriod)
+    flushRollups(channels)
+    publisher.stop(measurementPeriod)
+    alarms.stop(measurementPeriod)
+    closeAll(channels)
+    raise KeyboardInterrupt
+supervisor.stop()
+scheduler.stop(measurementPeriod)
+flushRollups(channels)
+publisher.stop(measurementPeriod)
+alarms.stop(measurementPeriod)
+closeAll(channels)
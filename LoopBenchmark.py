@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+LoopBenchmark.py
+
+part of the Hybrid Parameter Monitor
+
+Runs the monitor's acquisition loop (scheduler, channels and publisher) against
+the simulated devices and a simulated Origin server, and reports per channel:
+    measure latency -- duration of channel.measure()
+    loop latency -- time from the start of a scheduled measurement until the
+        record is received by the server
+    period jitter -- deviation of the time between measurements from the
+        channel's period
+    rate -- records per second received by the server (and raw samples per
+        second per channel for the continuous DAQ)
+as well as the CPU use and peak memory of the process. With --alarm-high the
+pickoff powers are checked against alarm rules (Alarms.py), and the duration
+of a check and the latency from a sample to its alarm are reported. --mag
+adds the magnetic field sensor (MagSensor.py) sampling --mag-rate Hz. With
+--adaptive the pickoff channel's period is set by a rate controller
+(AdaptiveRate.py), --voltage-step changes the simulated voltages during the
+run to make a transient, and the channel's final period and number of
+transients are reported instead of its jitter.
+
+Usage:
+    python LoopBenchmark.py --duration 60 --json results.json
+    python LoopBenchmark.py --baseline results.json
+
+With --baseline the run is compared against an earlier --json output and the
+script exits with status 1 if any latency or jitter got worse by more than
+--tolerance.
+"""
+
+import argparse
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import MagSensor
+import PicosMonitor
+import PickoffMonitor
+from AdaptiveRate import RateController
+from Alarms import AlarmEngine, AlarmRules
+from ChannelScheduler import ChannelScheduler
+from DeviceWorkers import DeviceProcess, DeviceSupervisor, DeviceError
+from HybridChannels import tempChannel, I2VChannel, magChannel, statsChannel, closeAll, measureAndPublish
+from OriginPublisher import OriginPublisher
+from SimulatedDevices import SimulatedTC08DLL, SimulatedNIDAQmx, SimulatedServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TIMESTAMP = 'measurement_time'
+
+tempChannels = {"Chamber" : 1,"Coils" : 2,"Near_Terminal" : 3}
+I2VChannels = {"X1" : 'ai4',
+               "X2" : 'ai2',
+               "Y1" : 'ai0',
+               "Y2" : 'ai1',
+               "Z1" : 'ai3',
+               "Z2" : 'ai5'}
+
+magAxes = {"Bx" : 'ai8',
+           "By" : 'ai9',
+           "Bz" : 'ai10'}
+
+# metrics compared against a baseline, lower is better
+COMPARED = ('measure p95', 'loop p95', 'jitter std')
+
+
+def percentiles(values):
+    """
+    Returns the median, 95th percentile and maximum of values in seconds
+    """
+    if not values:
+        return {'p50' : None, 'p95' : None, 'max' : None}
+    values = np.asarray(values)
+    return {'p50' : float(np.percentile(values, 50)),
+            'p95' : float(np.percentile(values, 95)),
+            'max' : float(values.max())}
+
+
+class LoopBenchmark(object):
+    """
+    One benchmark run, see the module docstring
+    """
+    def __init__(self, args):
+        self.args = args
+        self._lock = threading.Lock()
+        self.started = {}
+        self.starts = {}
+        self.measureTimes = {}
+        self.loopTimes = {}
+
+    def task(self, channel):
+        """
+        The scheduler task, the same measure and publish path as HybridMonitor
+        with the timestamps recorded along the way
+        """
+        start = time.time()
+        def stamp(t):
+            ts = t
+            with self._lock:
+                self.started[(channel.name, ts)] = start
+            return ts
+        measureAndPublish(channel, self.publisher, stamp, TIMESTAMP)
+        self.measureTimes[channel.name].append(time.time() - start)
+        self.starts[channel.name].append(start)
+
+    def received(self, stream, data, t):
+        with self._lock:
+            start = self.started.pop((stream, data[TIMESTAMP]), None)
+        if start is not None:
+            self.loopTimes[stream].append(t - start)
+
+    def setup(self):
+        args = self.args
+        self.server = SimulatedServer(onReceive=self.received,
+                                      latency=args.server_latency,
+                                      jitter=args.server_jitter,
+                                      failureRate=args.server_failure_rate)
+        tc08 = SimulatedTC08DLL(units=args.tc08_units,
+                                conversionTime=args.tc08_conversion,
+                                jitter=args.device_jitter,
+                                failureRate=args.device_failure_rate)
+        if args.tc08_units > 1:
+            # the same three thermocouples on every unit
+            temps = dict((name + '_' + str(unit), (unit, channel))
+                         for unit in range(args.tc08_units)
+                         for name, channel in tempChannels.items())
+        else:
+            temps = tempChannels
+        # with --mag the pickoffs and the sensor are on the same card, with
+        # --continuous they share its task
+        self.daq = daq = SimulatedNIDAQmx(latency=args.daq_latency,
+                                          jitter=args.device_jitter,
+                                          failureRate=args.device_failure_rate,
+                                          tones=((60, 0.01), (180, 0.002)) if args.mag else ())
+        I2VOptions = {'continuous' : args.continuous,
+                      'sample_rate' : args.sample_rate,
+                      'every_n' : max(1, args.sample_rate//10),
+                      'nidaq' : daq}
+        I2VNames = PickoffMonitor.data_names(I2VChannels, args.continuous)
+        if args.device_processes:
+            self.picos = DeviceProcess(PicosMonitor.start_tc08, (temps,),
+                                       {'dll' : tc08, 'streaming' : args.tc08_streaming},
+                                       dataNames=temps.keys(), method='get_temp',
+                                       closeMethod='close_unit', name='TC-08')
+            self.I2V = DeviceProcess(PickoffMonitor.NIDAQmxAI, (I2VChannels,),
+                                     I2VOptions, dataNames=I2VNames,
+                                     method='get_powers', closeMethod='close_task',
+                                     name='NIDAQmx')
+            self.picos.start()
+            self.I2V.start()
+            self.supervisor = DeviceSupervisor([self.picos, self.I2V])
+        else:
+            self.picos = PicosMonitor.start_tc08(temps, dll=tc08,
+                                                 streaming=args.tc08_streaming)
+            self.I2V = PickoffMonitor.NIDAQmxAI(I2VChannels, **I2VOptions)
+            self.supervisor = DeviceSupervisor([])
+        self.channels = [tempChannel("Temp","float",self.server,temps.keys(),
+                                     self.picos,period=args.temp_period),
+                         I2VChannel("Beam_Balances","float",self.server,
+                                    I2VNames,self.I2V,
+                                    period=args.i2v_period)]
+        self.mag = None
+        if args.mag:
+            # 60 Hz mains pickup and its third harmonic on every input
+            self.mag = MagSensor.MagSensor(magAxes, sample_rate=args.mag_rate,
+                                           every_n=max(1, args.mag_rate//10),
+                                           nidaq=daq)
+            self.channels.append(magChannel("Mag","float",self.server,
+                                            MagSensor.data_names(magAxes),
+                                            self.mag,period=args.mag_period))
+        self.publisher = OriginPublisher(batchSize=args.batch_size,
+                                         maxDelay=args.max_delay)
+        self.alarms = AlarmEngine()
+        if args.alarm_high is not None:
+            rules = AlarmRules("Beam_Balances", I2VNames, high=args.alarm_high,
+                               hysteresis=args.alarm_hysteresis)
+            self.alarms.add(rules)
+            self.channels[1].alarms = rules
+            if args.continuous:
+                self.I2V.add_block_listener(rules.blockListener(self.I2V.mapNames))
+        if args.adaptive is not None:
+            controller = RateController("Beam_Balances", I2VNames, args.adaptive[0],
+                                        args.adaptive[1], deadband=args.adaptive_deadband)
+            self.channels[1].adaptive = controller
+            self.channels[1].period = controller.period
+            if args.continuous:
+                self.I2V.add_block_listener(controller.blockListener(self.I2V.mapNames))
+        self.channels.append(statsChannel("Stats","float",self.server,
+                                          list(self.channels),self.publisher,
+                                          statsFile=args.stats_file,
+                                          period=args.stats_period))
+        for channel in self.channels:
+            self.starts[channel.name] = []
+            self.measureTimes[channel.name] = []
+            self.loopTimes[channel.name] = []
+
+    def run(self):
+        """
+        Runs the loop for the configured duration and returns the results
+        """
+        self.setup()
+        # includes device worker processes once they are joined
+        cpu0 = sum(os.times()[:4])
+        t0 = time.time()
+        self.publisher.start()
+        self.supervisor.start()
+        self.alarms.start()
+        self.alarms.connect(self.server, self.publisher, lambda t: t, TIMESTAMP)
+        scheduler = ChannelScheduler(self.channels, self.task,
+                                     recoverable=(DeviceError,))
+        for channel in self.channels:
+            if channel.adaptive is not None:
+                channel.adaptive.wake = functools.partial(scheduler.wake, channel)
+        scheduler.start()
+        outage = self.args.server_outage
+        step = self.args.voltage_step
+        while time.time() - t0 < self.args.duration and scheduler.is_running():
+            if outage is not None and time.time() - t0 >= outage[0]:
+                print 'server outage of %g s' % outage[1]
+                self.server.outage(outage[1])
+                outage = None
+            if step is not None and time.time() - t0 >= step[0]:
+                print 'voltage step of %g V' % step[1]
+                self.daq.voltages = tuple(v + step[1] for v in self.daq.voltages)
+                step = None
+            time.sleep(0.1)
+        self.supervisor.stop()
+        scheduler.stop(10)
+        self.publisher.stop(10)
+        self.alarms.stop(10)
+        wall = time.time() - t0
+        acquired = getattr(self.I2V, 'acquired', None)
+        magAcquired = self.mag.daq.acquired if self.mag is not None else None
+        closeAll(self.channels)
+        cpu = sum(os.times()[:4]) - cpu0
+
+        results = {'duration' : wall,
+                   'cpu' : cpu/wall,
+                   'max rss kB' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+                   'publisher' : self.publisher.stats(),
+                   'missed deadlines' : dict(scheduler.missed),
+                   'skipped measurements' : dict(scheduler.failed),
+                   'channels' : {}}
+        if self.alarms.rules:
+            alarms = self.alarms.stats()
+            results['alarms'] = {'checks' : alarms['evaluations'],
+                                 'events' : alarms['events'],
+                                 'dropped' : alarms['dropped'],
+                                 'check p50' : alarms['evaluation']['p50'],
+                                 'check p95' : alarms['evaluation']['p95'],
+                                 'latency p50' : alarms['latency']['p50'],
+                                 'latency p95' : alarms['latency']['p95']}
+        for channel in self.channels:
+            period = scheduler.period(channel)
+            lateness = np.diff(self.starts[channel.name]) - period
+            measure = percentiles(self.measureTimes[channel.name])
+            loop = percentiles(self.loopTimes[channel.name])
+            results['channels'][channel.name] = {
+                'records' : self.server.streams[channel.name].received,
+                'rate' : self.server.streams[channel.name].received/wall,
+                'measure p50' : measure['p50'],
+                'measure p95' : measure['p95'],
+                'measure max' : measure['max'],
+                'loop p50' : loop['p50'],
+                'loop p95' : loop['p95'],
+                'loop max' : loop['max'],
+                'jitter std' : float(lateness.std()) if len(lateness) else None,
+                'jitter max' : float(abs(lateness).max()) if len(lateness) else None}
+            if channel.adaptive is not None:
+                # the period changes, the jitter against the last one is meaningless
+                adaptive = channel.adaptive.stats()
+                results['channels'][channel.name].update(
+                    {'jitter std' : None, 'jitter max' : None,
+                     'period' : adaptive['period'], 'transients' : adaptive['transients']})
+        if acquired is not None:
+            results['channels'][self.channels[1].name]['raw samples rate'] = acquired/wall
+        if magAcquired is not None:
+            results['channels']['Hybrid_Mag']['raw samples rate'] = magAcquired/wall
+        return results
+
+
+def report(results):
+    print 'duration %.1f s, cpu %.1f %%, max rss %s kB' % (
+        results['duration'], 100*results['cpu'], results['max rss kB'])
+    print 'publisher : ' + repr(results['publisher'])
+    print 'missed deadlines : ' + repr(results['missed deadlines'])
+    print 'skipped measurements : ' + repr(results['skipped measurements'])
+    if 'alarms' in results:
+        print 'alarms'
+        for key, value in sorted(results['alarms'].items()):
+            if value is None:
+                print '    %-18s -' % key
+            elif key.startswith('check '):
+                print '    %-18s %.1f us' % (key, 1e6*value)
+            elif key.startswith('latency'):
+                print '    %-18s %.3f ms' % (key, 1e3*value)
+            else:
+                print '    %-18s %d' % (key, value)
+    for name, metrics in sorted(results['channels'].items()):
+        print name
+        for key, value in sorted(metrics.items()):
+            if value is None:
+                print '    %-18s -' % key
+            elif key.startswith('measure') or key.startswith('loop') or key.startswith('jitter'):
+                print '    %-18s %.3f ms' % (key, 1e3*value)
+            else:
+                print '    %-18s %.1f' % (key, value)
+
+
+def compare(results, baseline, tolerance, floor=1e-3):
+    """
+    Returns a list of the metrics which got worse than the baseline by more
+    than the relative tolerance (and by more than floor seconds)
+    """
+    regressions = []
+    for name, metrics in results['channels'].items():
+        for key in COMPARED:
+            old = baseline['channels'].get(name, {}).get(key)
+            new = metrics.get(key)
+            if old is None or new is None:
+                continue
+            if new > old*(1 + tolerance) and new - old > floor:
+                regressions.append('%s %s : %.3f ms -> %.3f ms' % (name, key, 1e3*old, 1e3*new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the monitor loop against simulated devices')
+    parser.add_argument('--duration', type=float, default=30.0, help='run time in s')
+    parser.add_argument('--temp-period', type=float, default=2.0, help='TC-08 channel period in s')
+    parser.add_argument('--i2v-period', type=float, default=0.5, help='pickoff channel period in s')
+    parser.add_argument('--continuous', action='store_true', help='run the DAQ in continuous mode')
+    parser.add_argument('--sample-rate', type=int, default=1000, help='DAQ sample rate in Hz')
+    parser.add_argument('--mag', action='store_true', help='add the magnetic field sensor')
+    parser.add_argument('--mag-rate', type=int, default=10000, help='magnetic field sensor sample rate in Hz')
+    parser.add_argument('--mag-period', type=float, default=1.0, help='magnetic field channel period in s')
+    parser.add_argument('--device-processes', action='store_true', help='run each device in its own worker process')
+    parser.add_argument('--tc08-units', type=int, default=1, help='number of simulated TC-08 units, read in parallel')
+    parser.add_argument('--tc08-streaming', action='store_true', help='run the TC-08 in streaming mode')
+    parser.add_argument('--tc08-conversion', type=float, default=0.1, help='TC-08 conversion time per channel in s')
+    parser.add_argument('--daq-latency', type=float, default=0.005, help='DAQ read latency in s')
+    parser.add_argument('--device-jitter', type=float, default=0.0, help='device latency jitter in s')
+    parser.add_argument('--device-failure-rate', type=float, default=0.0, help='probability of a device call failing')
+    parser.add_argument('--server-latency', type=float, default=0.001, help='server send latency in s')
+    parser.add_argument('--server-jitter', type=float, default=0.0, help='server send jitter in s')
+    parser.add_argument('--server-failure-rate', type=float, default=0.0, help='probability of a send failing')
+    parser.add_argument('--server-outage', type=float, nargs=2, metavar=('AT', 'DURATION'),
+                        help='take the server down AT s into the run for DURATION s')
+    parser.add_argument('--alarm-high', type=float, help='alarm limit of the pickoff powers')
+    parser.add_argument('--alarm-hysteresis', type=float, default=0.0, help='hysteresis of the alarm limit')
+    parser.add_argument('--adaptive', type=float, nargs=2, metavar=('MIN', 'MAX'),
+                        help='adapt the pickoff channel period between MIN and MAX s')
+    parser.add_argument('--adaptive-deadband', type=float, default=0.05,
+                        help='change of a pickoff power which makes a transient')
+    parser.add_argument('--voltage-step', type=float, nargs=2, metavar=('AT', 'VOLTS'),
+                        help='add VOLTS to the simulated DAQ voltages AT s into the run')
+    parser.add_argument('--batch-size', type=int, default=100, help='publisher batch size')
+    parser.add_argument('--max-delay', type=float, default=0.1, help='publisher maximum batch delay in s')
+    parser.add_argument('--stats-period', type=float, default=5.0, help='period of the stats channel in s')
+    parser.add_argument('--stats-file', help='file the stats channel writes its statistics to')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results written by --json')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args(argv)
+    if args.device_processes and args.continuous and (args.alarm_high is not None or args.adaptive):
+        # as ChannelStartup, block listeners can not be added in a worker process
+        parser.error('--device-processes can not check the blocks of the continuous DAQ')
+    if args.mag and not args.continuous:
+        # as ChannelStartup, a triggered task can not share the sensor's card
+        parser.error('--mag needs --continuous, the sensor shares the DAQ with the pickoffs')
+    if args.device_processes and args.voltage_step:
+        parser.error('--voltage-step can not reach the DAQ of a worker process')
+
+    results = LoopBenchmark(args).run()
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION ' + regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
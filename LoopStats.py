@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+LoopStats.py
+
+part of the Hybrid Parameter Monitor
+
+Timing instrumentation of the acquisition loop. Every channel carries a
+ChannelStats with latency histograms that are filled by the scheduler, the
+measure task and the publisher:
+    measure -- duration of channel.measure()
+    send -- duration of connection.send() for one record
+    lateness -- how late a measurement started relative to its deadline
+    age -- time from the acquisition of a record until it was sent
+
+The statistics are published as their own Origin stream by
+HybridChannels.statsChannel, and can be written to a JSON file or pulled from
+a local http endpoint (StatsServer).
+"""
+
+import BaseHTTPServer
+import bisect
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of durations on logarithmic bins. Adding a value is a bisection
+    on the bin edges and an increment, so it is cheap enough for the hot path.
+    """
+    def __init__(self, lowest=1e-5, highest=100.0, binsPerDecade=10):
+        """
+        Arguments:
+            lowest -- upper edge of the first bin in seconds
+            highest -- lower edge of the overflow bin in seconds
+            binsPerDecade -- resolution of the histogram
+        """
+        decades = np.log10(highest/lowest)
+        self.edges = (lowest*np.logspace(0, decades, int(decades*binsPerDecade) + 1)).tolist()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0]*(len(self.edges) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def add(self, value):
+        """
+        Adds a duration in seconds
+        """
+        i = bisect.bisect_left(self.edges, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q, counts=None, maxValue=None):
+        """
+        Returns the upper edge of the bin holding the q-th percentile, so the
+        result is within one bin width above the true percentile
+        Arguments:
+            q -- percentile, 0 to 100
+            counts, maxValue -- copies of the bin counts and maximum to use
+                instead of the live ones
+        """
+        if counts is None:
+            counts, maxValue = self.counts, self.max
+        count = sum(counts)
+        if count == 0:
+            return None
+        rank = q/100.0*count
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.edges[i], maxValue) if i < len(self.edges) else maxValue
+        return maxValue
+
+    def snapshot(self, reset=False):
+        """
+        Returns a dictionary of the count, mean, 50th, 95th and 99th
+        percentiles and maximum in seconds
+        """
+        with self._lock:
+            counts, count, total, maxValue = list(self.counts), self.count, self.total, self.max
+            if reset:
+                self.counts = [0]*len(counts)
+                self.count = 0
+                self.total = 0.0
+                self.max = 0.0
+        return {'count' : count,
+                'mean' : total/count if count else None,
+                'p50' : self.percentile(50, counts, maxValue),
+                'p95' : self.percentile(95, counts, maxValue),
+                'p99' : self.percentile(99, counts, maxValue),
+                'max' : maxValue if count else None}
+
+
+class ChannelStats(object):
+    """
+    The latency histograms of one channel
+    """
+    METRICS = ('measure', 'send', 'lateness', 'age')
+
+    def __init__(self):
+        self.measure = LatencyHistogram()
+        self.send = LatencyHistogram()
+        self.lateness = LatencyHistogram()
+        self.age = LatencyHistogram()
+
+    def snapshot(self, reset=False):
+        return dict((metric, getattr(self, metric).snapshot(reset))
+                    for metric in self.METRICS)
+
+
+def writeStatsFile(path, snapshot):
+    """
+    Writes a snapshot as JSON, replacing the file in one step so readers never
+    see a partially written file
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+    if os.name == 'nt' and os.path.exists(path):
+        # rename does not replace existing files on windows
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+class StatsServer(object):
+    """
+    Local http endpoint returning the latest snapshot as JSON on GET
+    """
+    def __init__(self, port, host='127.0.0.1'):
+        """
+        Arguments:
+            port -- port to listen on
+            host -- interface to listen on, only the local machine by default
+        """
+        self.snapshot = {}
+        stats = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(stats.snapshot, indent=2, sort_keys=True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name="stats-server")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def update(self, snapshot):
+        self.snapshot = snapshot
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
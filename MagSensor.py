@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+MagSensor.py
+
+part of the Hybrid Parameter Monitor
+
+handles the three axis magnetic field sensor near the science chamber, read
+through the NI DAQmx analog inputs (PickoffMonitor.NIDAQmxAI in continuous
+mode, sharing the DAQ device's task with the other monitors on it)
+
+The axes are sampled continuously at kHz rates. Every block of samples is
+folded into a running Welch spectrum as it arrives (StreamingWelch): the
+blocks are cut into overlapping Hann windowed segments whose power spectra
+are summed, and only the last partial segment is kept. get_field() reports,
+for the samples since its previous call, the mean field of each axis, the
+broadband AC rms and the rms amplitude in narrow bands around the mains
+frequency and its harmonics. The raw samples are never stored, so memory
+does not grow with the sample rate or the reporting period.
+"""
+
+import threading
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from DeviceWorkers import DeviceError
+from PickoffMonitor import NIDAQmxAI, load_calibration
+from Records import value_order
+
+
+def load_mag_calibration(config, section='Mag Calibration'):
+    """
+    Reads the field calibration of the sensor's analog inputs from a
+    ConfigParser object, polynomial coefficients converting volts to field,
+    highest order first (see PickoffMonitor.load_calibration). Inputs
+    without calibration are reported in volts.
+    """
+    return load_calibration(config, section)
+
+
+def band_names(mains=60.0, harmonics=3):
+    """
+    Returns the names of the mains bands, e.g. 60Hz, 120Hz, 180Hz
+    """
+    return ['%gHz' % (mains*k) for k in range(1, harmonics + 1)]
+
+
+def data_names(axes, mains=60.0, harmonics=3):
+    """
+    Returns the names of the values returned by MagSensor.get_field() for the
+    given constructor arguments, without creating the task
+    """
+    names = []
+    for axis in axes.keys():
+        names.append(axis)
+        names.append(axis + '_rms')
+        names.extend(axis + '_' + band for band in band_names(mains, harmonics))
+    return names
+
+
+class StreamingWelch(object):
+    """
+    Welch power spectral density of several channels, accumulated block by
+    block. Segments overlap across blocks, so the result is the one of the
+    whole stream, not of each block.
+    """
+    def __init__(self, sample_rate, channels, segment, overlap=0.5):
+        """
+        Arguments:
+            sample_rate -- sample rate in Hz
+            channels -- number of channels (columns of the blocks)
+            segment -- samples per segment, the frequency resolution is
+                sample_rate/segment
+            overlap -- overlap of consecutive segments, fraction of segment
+        """
+        self.sample_rate = float(sample_rate)
+        self.channels = channels
+        self.segment = segment
+        self.step = max(1, segment - int(round(overlap*segment)))
+        # periodic Hann window, as used for spectral estimation
+        self.window = 0.5 - 0.5*np.cos(2*np.pi*np.arange(segment)/segment)
+        self.freqs = np.fft.rfftfreq(segment, 1.0/self.sample_rate)
+        self.df = self.sample_rate/segment
+        # density scaling, one sided: every bin but DC (and Nyquist) twice
+        self.scale = np.full(len(self.freqs), 2.0/(self.sample_rate*(self.window**2).sum()))
+        self.scale[0] /= 2
+        if segment % 2 == 0:
+            self.scale[-1] /= 2
+        self._tail = np.zeros((0, channels))
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new average. The partial segment is kept, so the next
+        average continues the stream seamlessly.
+        """
+        self.power = np.zeros((len(self.freqs), self.channels))
+        self.segments = 0
+
+    def add(self, block):
+        """
+        Adds a block of samples of shape (samples, channels)
+        """
+        data = np.concatenate((self._tail, block)) if len(self._tail) else np.asarray(block)
+        n = (len(data) - self.segment)//self.step + 1 if len(data) >= self.segment else 0
+        if n:
+            data = np.ascontiguousarray(data)
+            rows, cols = data.strides
+            segments = as_strided(data, shape=(n, self.segment, self.channels),
+                                  strides=(self.step*rows, rows, cols))
+            # constant detrend of every segment, then one FFT for all of them
+            segments = segments - segments.mean(axis=1)[:,None,:]
+            segments *= self.window[None,:,None]
+            spectra = np.fft.rfft(segments, axis=1)
+            self.power += (spectra.real**2 + spectra.imag**2).sum(axis=0)
+            self.segments += n
+        self._tail = data[n*self.step:].copy()
+
+    def psd(self):
+        """
+        Returns the averaged power spectral density, shape (freqs, channels),
+        in units**2/Hz. NaN if no segment was completed yet.
+        """
+        if not self.segments:
+            return np.full(self.power.shape, np.nan)
+        return self.power*(self.scale/self.segments)[:,None]
+
+    def band_matrix(self, bands):
+        """
+        Returns the matrix integrating a PSD over bands, so the band powers
+        of all channels are one product: band_matrix(bands).dot(psd())
+        Arguments:
+            bands -- list of (low, high) frequencies in Hz, inclusive
+        """
+        matrix = np.zeros((len(bands), len(self.freqs)))
+        for i, (low, high) in enumerate(bands):
+            matrix[i, (self.freqs >= low) & (self.freqs <= high)] = self.df
+        return matrix
+
+
+class MagSensor(object):
+    """
+    The magnetic field sensor, one analog input per axis
+    """
+    def __init__(self, axes, sample_rate=10000, every_n=1000, segment=None,
+                 overlap=0.5, mains=60.0, harmonics=3, bandwidth=4.0,
+                 calibration=None, nidaq=None, device_name='PXI2Slot6'):
+        """
+        Arguments:
+            axes -- dictionary of axis names to analog inputs, e.g.
+                {'Bx' : 'ai8', 'By' : 'ai9', 'Bz' : 'ai10'}
+            sample_rate -- sample clock rate in Hz
+            every_n -- samples per axis in each block handed over by the
+                driver
+            segment -- samples per Welch segment, sample_rate (1 Hz
+                resolution) by default
+            overlap -- overlap of the Welch segments, fraction of a segment
+            mains -- mains frequency in Hz
+            harmonics -- number of mains bands reported, the mains frequency
+                and its harmonics
+            bandwidth -- width in Hz of each mains band
+            calibration -- dictionary of analog input names to polynomial
+                coefficients converting volts to field, see
+                load_mag_calibration
+            nidaq -- already loaded driver to use instead of nicaiu.dll, e.g.
+                SimulatedDevices.SimulatedNIDAQmx
+            device_name -- name of the DAQ device in DAQmx. The sensor's
+                inputs are scanned by the device's shared task, together with
+                the other monitors on it
+        """
+        self.axes = list(axes.keys())
+        self.sample_rate = sample_rate
+        self.welch = StreamingWelch(sample_rate, len(self.axes),
+                                    segment or int(sample_rate), overlap)
+        self.bands = band_names(mains, harmonics)
+        centres = [mains*k for k in range(1, harmonics + 1)]
+        # the mains bands, then everything above DC for the broadband rms
+        self._bands = self.welch.band_matrix(
+            [(f - 0.5*bandwidth, f + 0.5*bandwidth) for f in centres] +
+            [(self.welch.df, np.inf)])
+        # time in seconds since the epoch the values of the latest
+        # get_field() were acquired at, the middle of the samples reported
+        self.acquisition_time = None
+        # the values of the latest get_field() in the order of data_names,
+        # one row per axis: mean, rms, then the mains bands
+        self._names = data_names(axes, mains, harmonics)
+        self._field = np.zeros((len(self.axes), 2 + len(self.bands)))
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._reset()
+        inputs = [axes[axis] for axis in self.axes]
+        self.daq = NIDAQmxAI(dict(axes), continuous=True, sample_rate=sample_rate,
+                             every_n=every_n, buffer_samples=every_n, window=every_n,
+                             calibration=calibration or {}, nidaq=nidaq,
+                             channellist=inputs, device_name=device_name)
+        # the blocks come in the order of the daq's channel map
+        self._columns = [self.daq.mapNames.index(axis) for axis in self.axes]
+        self.daq.add_block_listener(self._add_block)
+        # alarm checks (Alarms.py) can see the calibrated samples too
+        self.continuous = True
+        self.mapNames = list(self.daq.mapNames)
+
+    def add_block_listener(self, listener):
+        """
+        Registers a function called with every block of calibrated samples,
+        see PickoffMonitor.NIDAQmxAI.add_block_listener
+        """
+        self.daq.add_block_listener(listener)
+
+    def _reset(self):
+        self._sum = np.zeros(len(self.axes))
+        self._count = 0
+        self._first_time = None
+        self._last_time = None
+
+    def _add_block(self, times, block):
+        """
+        Called from the driver's thread with every block of samples
+        """
+        block = block[:,self._columns]
+        with self._lock:
+            self.welch.add(block)
+            self._sum += block.sum(axis=0)
+            self._count += len(block)
+            if self._first_time is None:
+                self._first_time = times[0]
+            self._last_time = times[-1]
+            if self.welch.segments:
+                self._ready.set()
+
+    def value_order(self, names):
+        """
+        Returns the index of the given names among data_names, for
+        get_field_into
+        """
+        return value_order(self._names, names)
+
+    def get_field(self, timeout=10.0):
+        """
+        Returns the field of the samples since the previous call: for each
+        axis the mean field under the axis name, the rms of its fluctuations
+        (axis_rms) and the rms amplitude in each mains band (e.g. axis_60Hz).
+        Right after the task started this waits for the first segment. Band
+        values are NaN if no segment was completed since the previous call.
+        """
+        self._measure_field(timeout)
+        return dict(zip(self._names, self._field.ravel().tolist()))
+
+    def get_field_into(self, out, order, timeout=10.0):
+        """
+        Measures like get_field, but writes the values into an array instead
+        of building a dictionary
+        Arguments:
+            out -- float array the values are written to
+            order -- the values of out, from value_order()
+        """
+        self._measure_field(timeout)
+        out[:] = self._field.ravel()[order]
+
+    def _measure_field(self, timeout):
+        if not self._ready.wait(timeout):
+            raise DeviceError("no magnetic field segment acquired yet")
+        with self._lock:
+            psd = self.welch.psd()
+            mean = self._sum/self._count if self._count else np.full(len(self.axes), np.nan)
+            if self._count:
+                self.acquisition_time = 0.5*(self._first_time + self._last_time)
+            self.welch.reset()
+            self._reset()
+        rms = np.sqrt(self._bands.dot(psd))
+        self._field[:,0] = mean
+        self._field[:,1] = rms[-1]
+        self._field[:,2:] = rms[:-1].T
+
+    def close_task(self):
+        self.daq.close_task()
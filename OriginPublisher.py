@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+OriginPublisher.py
+
+part of the Hybrid Parameter Monitor
+
+Write-behind publisher for the Origin streams. Channels hand their records to
+the publisher, which queues them and writes them to the server in batches from
+its own worker thread, so server latency never stalls a measurement.
+"""
+
+import collections
+import Queue
+import sys
+import threading
+import time
+
+from Records import asdicts
+from StreamSpool import StreamSpool
+
+
+class OriginPublisher(object):
+    """
+    Queues records from all channels and sends them from a single worker.
+
+    The worker waits for a first record, then keeps collecting until it either
+    has batchSize records or maxDelay seconds have passed since that first
+    record, and sends the batch grouped by stream. When the queue is full,
+    publish() either drops the new record right away or, if block is True,
+    waits up to blockTimeout seconds for space (backpressure) before dropping.
+
+    Every stream is supervised on its own. A stream whose send fails is
+    marked offline while the other streams carry on, and a reconnect thread
+    registers it with the server again (channel.reconnect()), first after
+    retryInterval seconds and then backing off up to maxRetryInterval between
+    attempts. The channel's device is not touched. With a spoolDirectory the
+    records of an offline stream go to a local StreamSpool, once the stream is
+    registered again the spool is replayed in chunks of replayChunk records
+    between live batches, so live data keeps flowing while the backlog
+    drains. Without a spool they are dropped.
+
+    Urgent records (the alarm states) skip the queue: they are sent with the
+    next batch the worker sends, which is cut short for them. All sends go
+    through the worker, the connections are never used from two threads.
+
+    Channels hand over Records.Record objects pointing at rows of their
+    buffers, they are turned into the dictionaries Origin takes one batch at
+    a time. A record whose row was reused before its batch was sent is
+    dropped and counted as overwritten.
+    """
+    def __init__(self, batchSize=100, maxDelay=1.0, maxQueue=10000,
+                 block=False, blockTimeout=None, spoolDirectory=None,
+                 timestampKey=None, retryInterval=0.2, maxRetryInterval=10.0,
+                 connectTimeout=5.0, replayChunk=1000,
+                 spoolSegmentBytes=1024*1024, spoolMaxSegments=64,
+                 archive=None):
+        """
+        Arguments:
+            batchSize -- maximum number of records sent per batch
+            maxDelay -- maximum time in seconds a record waits for its batch
+                to fill up
+            maxQueue -- maximum number of queued records
+            block -- if True publish() waits for space in a full queue,
+                otherwise the record is dropped
+            blockTimeout -- maximum wait in seconds when blocking, None waits
+                forever
+            spoolDirectory -- directory for the store-and-forward spools,
+                None disables spooling
+            timestampKey -- name of the records' timestamp field
+            retryInterval -- seconds before the first attempt to register an
+                offline stream again, doubled after every failed attempt
+            maxRetryInterval -- maximum seconds between attempts
+            connectTimeout -- seconds the server may take to register a stream
+            replayChunk -- maximum number of spooled records replayed per
+                stream between live batches
+            spoolSegmentBytes -- size of each spool segment file
+            spoolMaxSegments -- maximum number of segment files per stream
+            archive -- StreamArchive.Archive every record is also written to
+                before it is sent, None to disable
+        """
+        self.batchSize = batchSize
+        self.maxDelay = maxDelay
+        self.block = block
+        self.blockTimeout = blockTimeout
+        self.queue = Queue.Queue(maxQueue)
+        self._urgent = collections.deque()
+        self.spoolDirectory = spoolDirectory
+        self.timestampKey = timestampKey
+        self.retryInterval = retryInterval
+        self.maxRetryInterval = maxRetryInterval
+        self.connectTimeout = connectTimeout
+        self.replayChunk = replayChunk
+        self.spoolSegmentBytes = spoolSegmentBytes
+        self.spoolMaxSegments = spoolMaxSegments
+        self.archive = archive
+        self.spools = {}
+        self.offline = {}   # stream name : True once it is registered again
+        self._offlineLock = threading.Lock()
+        self._channels = {}
+        self.spooled = 0
+        self.replayed = 0
+        self.reconnects = 0
+        self.errors = []
+        self.enqueued = 0
+        self.sent = 0
+        self.batches = 0
+        self.dropped = 0
+        self.overwritten = 0
+        self.backpressure = 0
+        self._countLock = threading.Lock()
+        self._stop = threading.Event()
+        self._failed = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the worker thread
+        """
+        self._thread = threading.Thread(target=self._run, name="publisher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, channel, data, archiveOnly=False, urgent=False):
+        """
+        Queues a record to be sent over the channel's connection.
+        Returns True if the record was queued, False if it was dropped.
+        Arguments:
+            channel -- the channel the record belongs to
+            data -- Records.Record or dictionary of dataNames (and
+                timestamp) to values. The publisher keeps a reference, do not
+                modify it afterwards
+            archiveOnly -- if True the record is only written to the archive,
+                not sent to the server
+            urgent -- if True the record is not queued behind the others but
+                sent right away, it is never dropped
+        """
+        item = (channel, data, time.time(), archiveOnly)
+        if urgent:
+            with self._countLock:
+                # one wake up per batch of urgent records is enough
+                wake = not self._urgent
+                self._urgent.append(item)
+                self.enqueued += 1
+            if wake:
+                try:
+                    # a full queue keeps the worker busy anyway
+                    self.queue.put_nowait(None)
+                except Queue.Full:
+                    pass
+            return True
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            if not self.block:
+                with self._countLock:
+                    self.dropped += 1
+                return False
+            with self._countLock:
+                self.backpressure += 1
+            try:
+                self.queue.put(item, True, self.blockTimeout)
+            except Queue.Full:
+                with self._countLock:
+                    self.dropped += 1
+                return False
+        with self._countLock:
+            self.enqueued += 1
+        return True
+
+    def _takeUrgent(self):
+        """
+        Returns the urgent records published so far
+        """
+        with self._countLock:
+            items = list(self._urgent)
+            self._urgent.clear()
+        return items
+
+    def _collect(self, wait=True):
+        """
+        Returns the next batch of records, or an empty list if nothing
+        arrived within maxDelay (or right away if wait is False). Urgent
+        records come first and end the wait for the batch to fill up.
+        """
+        urgent = self._takeUrgent()
+        if urgent:
+            return urgent
+        try:
+            item = self.queue.get(wait, self.maxDelay)
+        except Queue.Empty:
+            return self._takeUrgent()
+        if item is None:
+            return self._takeUrgent()
+        batch = [item]
+        deadline = time.time() + self.maxDelay
+        while len(batch) < self.batchSize:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    item = self.queue.get(True, remaining)
+                else:
+                    item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is None:
+                return self._takeUrgent() + batch
+            batch.append(item)
+        return batch
+
+    def _spool(self, channel):
+        """
+        Returns the spool of the channel's stream, opening it (and picking up
+        records left by a previous run) the first time the stream is seen
+        """
+        spool = self.spools.get(channel.name)
+        if spool is None and self.spoolDirectory is not None:
+            spool = StreamSpool(self.spoolDirectory, channel.name,
+                                self.spoolSegmentBytes, self.spoolMaxSegments,
+                                self.timestampKey)
+            self.spools[channel.name] = spool
+            self._channels[channel.name] = channel
+        return spool
+
+    def _goOffline(self, channel):
+        """
+        Marks a stream offline and starts registering it again
+        """
+        print "stream " + channel.name + " unreachable : " + repr(sys.exc_info()[1])
+        with self._offlineLock:
+            self.offline[channel.name] = False
+        thread = threading.Thread(target=self._reconnect, args=(channel,),
+                                  name="reconnect-" + channel.name)
+        thread.daemon = True
+        thread.start()
+
+    def _reconnect(self, channel):
+        """
+        Registers an offline stream again, backing off between attempts
+        """
+        delay = self.retryInterval
+        while not self._stop.wait(delay):
+            try:
+                channel.reconnect(self.connectTimeout)
+            except Exception:
+                print "stream " + channel.name + " still unreachable : " + repr(sys.exc_info()[1])
+                delay = min(2*delay, self.maxRetryInterval)
+                continue
+            print "stream " + channel.name + " registered again"
+            with self._countLock:
+                self.reconnects += 1
+            with self._offlineLock:
+                if channel.name in self.spools:
+                    # back online once the spool replays
+                    self.offline[channel.name] = True
+                else:
+                    del self.offline[channel.name]
+            return
+
+    def _send(self, batch):
+        streams = {}
+        order = []
+        # the dictionaries of the whole batch are built at once
+        payloads = asdicts([data for channel, data, queued, archiveOnly in batch])
+        overwritten = payloads.count(None)
+        if overwritten:
+            with self._countLock:
+                self.overwritten += overwritten
+                self.dropped += overwritten
+        # the age of a record counts from its acquisition time, that of a
+        # dictionary (rollups, aligned records) from when it was queued
+        batch = [(channel, data, queued if getattr(record, 'time', None) is None else record.time,
+                  archiveOnly)
+                 for (channel, record, queued, archiveOnly), data in zip(batch, payloads)
+                 if data is not None]
+        if self.archive is not None:
+            for channel, data, acquired, archiveOnly in batch:
+                self.archive.append(channel, data)
+        for channel, data, acquired, archiveOnly in batch:
+            if archiveOnly:
+                continue
+            if channel.name not in streams:
+                streams[channel.name] = (channel, [])
+                order.append(channel.name)
+            streams[channel.name][1].append((data, acquired))
+        for name in order:
+            channel, records = streams[name]
+            spool = self._spool(channel)
+            stats = getattr(channel, 'stats', None)
+            sent = 0
+            if name not in self.offline:
+                send = channel.connection.send
+                try:
+                    for data, acquired in records:
+                        start = time.time()
+                        send(**data)
+                        sent += 1
+                        if stats is not None:
+                            end = time.time()
+                            stats.send.add(end - start)
+                            stats.age.add(end - acquired)
+                except Exception:
+                    self._goOffline(channel)
+            self.sent += sent
+            if spool is None:
+                with self._countLock:
+                    self.dropped += len(records) - sent
+                continue
+            for data, acquired in records[sent:]:
+                spool.append(data)
+            self.spooled += len(records) - sent
+        self.batches += 1
+
+    def _replay(self):
+        """
+        Replays one chunk of every spool whose stream is reachable.
+        Returns True if any spool still has records waiting to be replayed.
+        """
+        backlog = False
+        for name, spool in self.spools.items():
+            if self.offline.get(name) is False:
+                continue
+            records = spool.peek(self.replayChunk)
+            if not records:
+                with self._offlineLock:
+                    self.offline.pop(name, None)
+                continue
+            channel = self._channels[name]
+            send = channel.connection.send
+            sent = 0
+            try:
+                for data in records:
+                    send(**data)
+                    sent += 1
+            except Exception:
+                self._goOffline(channel)
+            spool.commit(sent)
+            self.replayed += sent
+            if sent == len(records):
+                if name in self.offline:
+                    print "stream " + name + " back online, replaying spool"
+                    with self._offlineLock:
+                        del self.offline[name]
+                backlog = backlog or len(spool) > 0
+        return backlog
+
+    def _run(self):
+        backlog = False
+        while True:
+            batch = self._collect(not backlog)
+            if batch:
+                try:
+                    self._send(batch)
+                except Exception:
+                    print "publisher failed to send, stopping"
+                    self.errors.append(sys.exc_info())
+                    self._failed.set()
+                    return
+            elif self._stop.is_set():
+                break
+            backlog = self._replay()
+        for spool in self.spools.values():
+            spool.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def is_running(self):
+        """
+        Returns False once the worker has failed to send a batch
+        """
+        return not self._failed.is_set()
+
+    def stats(self):
+        """
+        Returns a dictionary of the publisher's counters
+        """
+        return {'depth' : self.queue.qsize(),
+                'enqueued' : self.enqueued,
+                'sent' : self.sent,
+                'batches' : self.batches,
+                'dropped' : self.dropped,
+                'overwritten' : self.overwritten,
+                'backpressure' : self.backpressure,
+                'spooled' : self.spooled,
+                'replayed' : self.replayed,
+                'spool depth' : sum(len(spool) for spool in list(self.spools.values())),
+                'spool dropped' : sum(spool.dropped for spool in list(self.spools.values())),
+                'reconnects' : self.reconnects,
+                'offline' : sorted(list(self.offline.keys()))}
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker after it has sent what is left in the queue, waiting
+        at most timeout seconds
+        """
+        self._stop.set()
+        try:
+            # wakes the worker instead of waiting for maxDelay
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            pass
+        if self._thread is not None:
+            self._thread.join(timeout)
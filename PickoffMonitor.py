@@ -18,8 +18,400 @@ logger = logging.getLogger(__name__)
 #from cs_errors import PauseError
 from ctypes import *
 import numpy
+import threading
 import time
+import traceback
 
+from DeviceWorkers import DeviceError
+from Records import value_order
+
+def load_calibration(config, section='Pickoff Calibration'):
+    """
+    Reads the pickoff calibration from a ConfigParser object. Each option of
+    the section maps an analog input to its polynomial coefficients, highest
+    order first, so a linear calibration reads "ai0 = gain, offset".
+    Arguments:
+        config -- ConfigParser object
+        section -- name of the section holding the calibration
+    Returns:
+        -calibration: dictionary of analog input names to coefficient tuples,
+            empty if the section is missing. Types : {String : (float,...)}
+    """
+    calibration = {}
+    if not config.has_section(section):
+        return calibration
+    for chan,value in config.items(section):
+        calibration[chan.lower()] = tuple(float(c) for c in value.split(','))
+    return calibration
+
+def data_names(channelMap, continuous=False, reductions=('mean',)):
+    """
+    Returns the names of the values returned by NIDAQmxAI.get_powers() for
+    the given constructor arguments, without creating the task
+    """
+    names = list(channelMap.keys())
+    if not continuous:
+        return names
+    dataNames = []
+    for reduction in reductions:
+        if reduction == 'mean':
+            dataNames.extend(names)
+        else:
+            dataNames.extend(key + '_' + reduction for key in names)
+    return dataNames
+
+def recalibration(channelMap, old, new, reductions=('mean',)):
+    """
+    Returns how to convert powers measured with one linear calibration into
+    the powers of another, e.g. to replay archived records after the pickoffs
+    were calibrated again. The reductions of a window convert like its
+    samples, except std which is only scaled.
+    Arguments:
+        channelMap -- dictionary of names to analog input channels
+        old, new -- dictionaries of analog inputs to (gain, offset), see
+            load_calibration. Missing inputs use NIDAQmxAI.DEFAULT_CALIBRATION
+        reductions -- reductions of the records, see data_names
+    Returns:
+        -conversion: dictionary of the names of data_names() to (scale, shift),
+            new power = scale*old power + shift
+    """
+    conversion = {}
+    for name,chan in channelMap.items():
+        coefficients = []
+        for calibration in (old, new):
+            c = calibration.get(chan, NIDAQmxAI.DEFAULT_CALIBRATION.get(chan, (1.0, 0.0)))
+            if len(c) != 2:
+                raise ValueError('only linear calibrations can be converted, ' + chan + ' has ' + repr(c))
+            coefficients.append(c)
+        (oldGain, oldOffset), (newGain, newOffset) = coefficients
+        scale = newGain/oldGain
+        for reduction in reductions:
+            if reduction == 'mean':
+                conversion[name] = (scale, newOffset - scale*oldOffset)
+            elif reduction == 'std':
+                conversion[name + '_std'] = (abs(scale), 0.0)
+            else:
+                conversion[name + '_' + reduction] = (scale, newOffset - scale*oldOffset)
+    return conversion
+
+# int32 (*)(TaskHandle, int32 everyNsamplesEventType, uInt32 nSamples, void *callbackData)
+EveryNSamplesEventCallbackPtr = CFUNCTYPE(c_int32, c_ulong, c_int32, c_uint32, c_void_p)
+
+# the shared tasks of the DAQ devices, by device name
+_shared_tasks = {}
+_shared_tasks_lock = threading.Lock()
+
+def shared_task(device_name, nidaq=None):
+    """
+    Returns the SharedAITask of a DAQ device, creating it the first time
+    Arguments:
+        device_name -- name of the device in DAQmx, e.g. PXI2Slot6
+        nidaq -- already loaded driver to use instead of nicaiu.dll, used
+            when the task is created
+    """
+    with _shared_tasks_lock:
+        task = _shared_tasks.get(device_name)
+        if task is None:
+            task = SharedAITask(device_name, nidaq)
+            _shared_tasks[device_name] = task
+        return task
+
+
+class Subscription(object):
+    """
+    The inputs of one logical monitor in a SharedAITask. columns selects
+    them in the task's scan, a slice (a view of the buffer) if they are
+    scanned next to each other. Each of the subscription's samples is the
+    mean of decimation consecutive samples of the task.
+    """
+    def __init__(self, inputs, sample_rate, every_n, buffer_samples, listener):
+        self.inputs = list(inputs)
+        self.sample_rate = sample_rate
+        self.every_n = every_n
+        self.buffer_samples = buffer_samples
+        self.listener = listener
+        self.columns = None
+        self.decimation = 1
+        self.ready = threading.Event()  # set once samples arrived
+
+
+class SharedAITask(object):
+    """
+    One continuous analog input task per DAQ device, scanning the inputs of
+    all logical monitors on the device (e.g. the pickoffs and the magnetic
+    field sensor) in a single pass. Samples are interleaved by scan into a
+    buffer of shape (samples, inputs); each monitor subscribes to its inputs
+    and reads or is handed its columns of it as views, without copies.
+
+    The buffer is written twice, at its position and one buffer length
+    further, so the latest samples are always one contiguous block. The
+    task runs at the highest sample rate of its subscribers, the others see
+    the means of k consecutive samples, a box filter against aliasing. The
+    groups of k samples are counted from the start of the task, the same in
+    read() and in the blocks handed to listeners. A new subscriber restarts the task with the union of
+    the inputs, once, when the channels are started.
+    """
+    def __init__(self, device_name, nidaq=None):
+        """
+        Arguments:
+            device_name -- name of the device in DAQmx, e.g. PXI2Slot6
+            nidaq -- already loaded driver to use instead of nicaiu.dll
+        """
+        self.device_name = device_name
+        self.nidaq = windll.nicaiu if nidaq is None else nidaq
+        self.subscriptions = []
+        self.inputs = []
+        self.sample_rate = None
+        self.every_n = None
+        self.buffer_samples = None
+        self.taskHandle = c_ulong(0)
+        self.acquired = 0       # samples per input since the task was created
+        self.restarts = 0
+        self._config_lock = threading.Lock()
+        # held by the callback while it writes, never while the task stops
+        self._lock = threading.Lock()
+        self._everyNCallback = EveryNSamplesEventCallbackPtr(self._every_n_samples)
+
+    def CHK(self, err, func):
+        if err<0:
+            buf_size = 1000
+            buf = create_string_buffer('\000'*buf_size)
+            self.nidaq.DAQmxGetErrorString(err,byref(buf),buf_size)
+            raise DeviceError('nidaq call %s failed with error %d: %s'%(func,err,repr(buf.value)))
+
+    def subscribe(self, inputs, sample_rate, every_n, buffer_samples, listener=None):
+        """
+        Adds the inputs of a logical monitor and (re)starts the task.
+        Arguments:
+            inputs -- analog inputs of the monitor, e.g. ['ai8','ai9']
+            sample_rate -- the monitor's sample rate in Hz, it has to divide
+                the highest sample rate on the device
+            every_n -- samples of the monitor per block handed to listener
+            buffer_samples -- samples of the monitor kept for read()
+            listener -- called from the driver's thread with every block, as
+                listener(times, block), block being the monitor's columns
+                of shape (samples, inputs) valid during the call, a view
+                unless the monitor's samples are decimated
+        Returns:
+            -subscription: Subscription to read() and unsubscribe()
+        """
+        subscription = Subscription(inputs, sample_rate, every_n, buffer_samples, listener)
+        with self._config_lock:
+            self._configure(self.subscriptions + [subscription])
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a monitor. The others keep the task running as it is, it
+        stops and clears with its last monitor.
+        """
+        with self._config_lock:
+            remaining = [s for s in self.subscriptions if s is not subscription]
+            if remaining:
+                with self._lock:
+                    self.subscriptions = remaining
+                return
+            self._stop()
+            self.subscriptions = []
+        with _shared_tasks_lock:
+            if _shared_tasks.get(self.device_name) is self:
+                del _shared_tasks[self.device_name]
+
+    def _configure(self, subscriptions):
+        """
+        Lays out the scan of the subscriptions' inputs and starts the task on
+        it, stopping the running one first. If the new task does not start,
+        the previous subscriptions get their task back before the error is
+        raised.
+        """
+        rate = max(s.sample_rate for s in subscriptions)
+        for s in subscriptions:
+            if rate % s.sample_rate:
+                raise ValueError('sample rate %g Hz on %s does not divide %g Hz'
+                                 % (s.sample_rate, self.device_name, rate))
+        previous = self.subscriptions
+        self._stop()
+        try:
+            self._layout(subscriptions)
+            self._start()
+        except Exception:
+            self._clear()
+            with self._lock:
+                self.subscriptions = []
+            if previous:
+                try:
+                    self._layout(previous)
+                    self._start()
+                except Exception:
+                    print 'restarting the shared task on %s failed' % self.device_name
+                    traceback.print_exc()
+                    self._clear()
+            raise
+
+    def _layout(self, subscriptions):
+        """
+        Lays out the scan of the subscriptions' inputs and the buffers, while
+        the task is stopped
+        """
+        rate = max(s.sample_rate for s in subscriptions)
+        inputs = []
+        for s in subscriptions:
+            inputs.extend(chan for chan in s.inputs if chan not in inputs)
+        for s in subscriptions:
+            s.ready.clear()
+            s.decimation = int(rate//s.sample_rate)
+            columns = [inputs.index(chan) for chan in s.inputs]
+            if columns == range(columns[0], columns[0] + len(columns)):
+                s.columns = slice(columns[0], columns[0] + len(columns))
+            else:
+                # shared with an earlier monitor, not next to each other
+                s.columns = numpy.array(columns)
+        every_n = min(s.every_n*s.decimation for s in subscriptions)
+        # a block completes groups of decimated samples begun in the one
+        # before, they have to be in the ring too
+        buffer_samples = max(max(s.buffer_samples*s.decimation for s in subscriptions),
+                             every_n + max(s.decimation for s in subscriptions))
+        with self._lock:
+            self.subscriptions = subscriptions
+            self.inputs = inputs
+            self.sample_rate = rate
+            self.every_n = every_n
+            self.buffer_samples = buffer_samples
+            self.ring = numpy.zeros((2*buffer_samples,len(inputs)),dtype=numpy.float64)
+            self._scratch = numpy.zeros((every_n,len(inputs)),dtype=numpy.float64)
+            self._head = 0      # next row of the ring to be written
+            self._filled = 0    # samples in the ring since the task started
+            self._blockTime = None  # arrival time of the latest sample
+
+    def _start(self):
+        self.CHK(self.nidaq.DAQmxCreateTask("",byref(self.taskHandle)),"CreateTask")
+        print "Shared task handle on {}: {} ({})".format(self.device_name, self.taskHandle.value,
+                                                         ", ".join(self.inputs))
+        self.CHK(self.nidaq.DAQmxCreateAIVoltageChan(self.taskHandle,
+                                                    c_char_p(", ".join(self.device_name + "/" + chan
+                                                                       for chan in self.inputs)),
+                                                    "",
+                                                    NIDAQmxAI.DAQmx_Val_RSE,
+                                                    c_double(-5.0),
+                                                    c_double(5.0),
+                                                    NIDAQmxAI.DAQmx_Val_Volts,
+                                                    None),"CreateAIVoltageChan")
+        # in continuous mode the sample count only sizes the driver's buffer
+        self.CHK(self.nidaq.DAQmxCfgSampClkTiming(self.taskHandle,
+                                                  "",
+                                                  c_double(self.sample_rate),
+                                                  NIDAQmxAI.DAQmx_Val_Rising,
+                                                  NIDAQmxAI.DAQmx_Val_ContSamps,
+                                                  c_uint64(self.buffer_samples)),"CfgSampClkTiming")
+        self.CHK(self.nidaq.DAQmxRegisterEveryNSamplesEvent(self.taskHandle,
+                                                           NIDAQmxAI.DAQmx_Val_Acquired_Into_Buffer,
+                                                           c_uint32(self.every_n),
+                                                           0,
+                                                           self._everyNCallback,
+                                                           None),"RegisterEveryNSamplesEvent")
+        self.CHK(self.nidaq.DAQmxStartTask(self.taskHandle),"StartTask")
+
+    def _stop(self):
+        if self.taskHandle.value == 0:
+            return
+        self.CHK(self.nidaq.DAQmxStopTask(self.taskHandle),"Stopping Task")
+        self.CHK(self.nidaq.DAQmxClearTask(self.taskHandle),"Clearing Task")
+        self.taskHandle = c_ulong(0)
+        self.restarts += 1
+
+    def _clear(self):
+        """
+        Clears a task which failed to start, errors are ignored
+        """
+        if self.taskHandle.value != 0:
+            self.nidaq.DAQmxClearTask(self.taskHandle)
+            self.taskHandle = c_ulong(0)
+
+    def _every_n_samples(self, taskHandle, eventType, nSamples, callbackData):
+        """
+        Called from the driver's thread whenever every_n new samples are in
+        the driver's buffer. Copies them into the ring buffer and hands each
+        subscriber its columns.
+        """
+        read = c_int32()
+        err = self.nidaq.DAQmxReadAnalogF64(taskHandle,
+                                            self.every_n,
+                                            c_double(0.0),
+                                            NIDAQmxAI.DAQmx_Val_GroupByScanNumber,
+                                            self._scratch.ctypes.data,
+                                            self._scratch.size,
+                                            byref(read),None)
+        if err < 0:
+            print 'nidaq call ReadAnalogF64 failed in callback with error %d'%err
+            return 0
+        n = read.value
+        block = self._scratch[:n]
+        with self._lock:
+            first = self._filled
+            rows = (self._head + numpy.arange(n)) % self.buffer_samples
+            self.ring[rows] = block
+            self.ring[rows + self.buffer_samples] = block
+            self._head = (self._head + n) % self.buffer_samples
+            self._filled += n
+            self.acquired += n
+            # the newest sample was just clocked in, the sample clock dates
+            # the older ones
+            self._blockTime = time.time()
+            blockTime = self._blockTime
+            end = self._head + self.buffer_samples
+        for s in self.subscriptions:
+            s.ready.set()
+            if s.listener is None:
+                continue
+            # the subscriber's samples completed by this block, the means of
+            # the groups of k of the task's, only the ring is written by
+            # this thread
+            k = s.decimation
+            m = (first + n)//k - first//k
+            if m == 0:
+                continue
+            lag = (first + n) % k
+            if k == 1:
+                samples = block[:, s.columns]
+            else:
+                samples = self.ring[end - lag - m*k:end - lag, s.columns]
+                samples = samples.reshape(m, k, -1).mean(axis=1)
+            times = blockTime - (lag + (m - 1 - numpy.arange(m))*k
+                                 + 0.5*(k - 1))/float(self.sample_rate)
+            try:
+                s.listener(times, samples)
+            except Exception:
+                # the driver must not see an exception in its callback
+                print 'block listener failed in callback'
+                traceback.print_exc()
+        return 0
+
+    def read(self, subscription, n, func, timeout=10.0):
+        """
+        Calls func with the latest n samples of a subscription, shape
+        (samples, inputs) oldest first, while the buffer is locked. They are
+        a view of the buffer unless the subscription's samples are decimated.
+        Right after the task started this waits for the first block.
+        Returns:
+            -result: what func returned
+            -time: acquisition time of the middle of the samples in seconds
+                since the epoch, None if there were no samples
+        """
+        subscription.ready.wait(timeout)
+        with self._lock:
+            k = subscription.decimation
+            # the newest samples of an incomplete group are left out, like in
+            # the blocks handed to the listeners
+            lag = self._filled % k
+            n = min(n, (min(self._filled, self.buffer_samples) - lag)//k)
+            end = self._head + self.buffer_samples - lag
+            if n <= 0:
+                return func(self.ring[end:end, subscription.columns]), None
+            view = self.ring[end - n*k:end, subscription.columns]
+            if k > 1:
+                view = view.reshape(n, k, -1).mean(axis=1)
+            t = self._blockTime - (lag + 0.5*(n*k - 1))/float(self.sample_rate)
+            return func(view), t
 
 
 class NIDAQmxAI():
@@ -35,31 +427,157 @@ class NIDAQmxAI():
     DAQmx_Val_Rising = 10280
     DAQmx_Val_Falling = 10171
     DAQmx_Val_FiniteSamps = 10178
+    DAQmx_Val_ContSamps = 10123
+    DAQmx_Val_Acquired_Into_Buffer = 1
     DAQmx_Val_GroupByChannel = 0
     DAQmx_Val_GroupByScanNumber = 1
     DAQmx_Val_ChanPerLine = 0
     applyFormula = False
+    # power = gain*voltage + offset, used for inputs missing from the config
+    DEFAULT_CALIBRATION = {'ai0' : (1.016, -.0021),
+                           'ai1' : (0.935, .0172),
+                           'ai2' : (0.422, -0.001),
+                           'ai3' : (0.447, .0009),
+                           'ai4' : (0.685, 0.00556),
+                           'ai5' : (2.008, .0284)}
+    REDUCTIONS = {'mean' : numpy.mean,
+                  'std' : numpy.std,
+                  'min' : numpy.min,
+                  'max' : numpy.max}
 
-    def __init__(self,channelMap):
-        self.DeviceName = "PXI2Slot6"
+    def __init__(self,channelMap,continuous=False,sample_rate=1000,
+                 every_n=100,buffer_samples=10000,window=1000,
+                 reductions=('mean',),calibration=None,nidaq=None,
+                 channellist=None,device_name='PXI2Slot6'):
+        """
+        Arguments:
+            channelMap -- dictionary of names to analog input channels
+            continuous -- when True the device's shared task samples
+                continuously into a ring buffer, and get_powers() reduces the
+                latest window instead of taking a new triggered measurement
+            sample_rate -- sample clock rate in Hz
+            every_n -- continuous mode only, number of samples per channel
+                read into the ring buffer by each every-N-samples callback
+            buffer_samples -- continuous mode only, length of the ring buffer
+                in samples per channel
+            window -- continuous mode only, number of latest samples per
+                channel reduced by get_powers()
+            reductions -- continuous mode only, reductions reported for each
+                channel, any of 'mean', 'std', 'min' and 'max'. 'mean' is
+                reported under the channel name, the others as name_reduction
+            calibration -- dictionary of analog input names to polynomial
+                coefficients, highest order first (see load_calibration).
+                Inputs missing from it use DEFAULT_CALIBRATION, or are read
+                in volts if they are not in DEFAULT_CALIBRATION either
+            nidaq -- already loaded driver to use instead of nicaiu.dll, e.g.
+                SimulatedDevices.SimulatedNIDAQmx
+            channellist -- analog inputs read by the task, ai0 to ai5 (the
+                pickoffs) by default
+            device_name -- name of the DAQ device in DAQmx. In continuous
+                mode all monitors of a device share one task, see
+                SharedAITask
+        """
+        self.DeviceName = device_name
+        self.continuous = continuous
         self.samples_per_measurement = 2
-        self.sample_rate = 1000
-        self.triggerSource = '/PXI2Slot6/PFI0'
+        self.sample_rate = sample_rate
+        self.every_n = every_n
+        self.buffer_samples = max(buffer_samples, window, every_n)
+        self.window = window
+        for reduction in reductions:
+            if reduction not in self.REDUCTIONS:
+                raise ValueError('unknown reduction : ' + repr(reduction))
+        self.reductions = reductions
+        self.triggerSource = '/' + device_name + '/PFI0'
         self.triggerEdge = 'Rising'
-        self.formula = [lambda v : 1.016*v-.0021,
-                        lambda v : 0.935*v+.0172,
-                        lambda v : 0.422*v-0.001,
-                        lambda v : 0.447*v+.0009,
-                        lambda v : 0.685*v+0.00556,
-                        lambda v : 2.008*v+.0284]
         
-        self.nidaq = windll.nicaiu
+        self.nidaq = windll.nicaiu if nidaq is None else nidaq
         self.DAQmx_Val_Cfg_Default = c_long(-1)
         self.taskHandle = c_ulong(0)
         self.channelMap = channelMap
-        self.channellist = ['ai0','ai1','ai2','ai3','ai4','ai5']
+        self.channellist = channellist or ['ai0','ai1','ai2','ai3','ai4','ai5']
         self.mychans = self.channelString()
+        self.setCalibration(calibration or {})
+        # the channel map is resolved to column indices once, get_powers()
+        # then demultiplexes with a single fancy index
+        self.mapNames = list(self.channelMap.keys())
+        self.mapIndex = numpy.array([self.channellist.index(value)
+                                     for value in self.channelMap.values()])
+        # the values of the latest measurement in the order of dataNames(),
+        # each reduction writes its part in place
+        self._names = self.dataNames()
+        self._powers = numpy.zeros(len(self._names))
+        width = len(self.mapNames)
+        self._reductionOut = [(self.REDUCTIONS[reduction], self._powers[i*width:(i+1)*width])
+                              for i,reduction in enumerate(self.reductions)]
+        # time in seconds since the epoch the values of the latest
+        # get_powers() were acquired at, the middle of the samples reduced
+        self.acquisition_time = None
+        # called with every block of samples in continuous mode
+        self._blockListeners = []
+        self.shared = None          # continuous mode, the device's SharedAITask
+        self.subscription = None
         self.prepareTask()
+
+    def dataNames(self):
+        """
+        Returns the names of the values returned by get_powers()
+        """
+        return data_names(self.channelMap, self.continuous, self.reductions)
+
+    def add_block_listener(self, listener):
+        """
+        Continuous mode only, registers a function called from the driver's
+        thread with every block of every_n samples as they arrive, e.g. the
+        alarm checks of Alarms.py.
+        Arguments:
+            listener -- called as listener(times, block), times being the
+                acquisition times of the samples in seconds since the epoch
+                and block the calibrated powers, an array of shape
+                (samples, channels) in the order of mapNames
+        """
+        if not self.continuous:
+            raise ValueError('block listeners need continuous mode')
+        self._blockListeners.append(listener)
+
+    def setCalibration(self, calibration):
+        """
+        Builds the coefficient array used by calibrate().
+        Arguments:
+            calibration -- dictionary of analog input names to polynomial
+                coefficients, highest order first
+        """
+        coefficients = []
+        for chan in self.channellist:
+            coefficients.append(calibration.get(chan, self.DEFAULT_CALIBRATION.get(chan, (1.0, 0.0))))
+        order = max(len(c) for c in coefficients)
+        # shape (order, channels), order being the number of coefficients of
+        # the longest polynomial, shorter ones are zero padded
+        self.coefficients = numpy.zeros((order,len(self.channellist)),dtype=numpy.float64)
+        for i,c in enumerate(coefficients):
+            self.coefficients[order-len(c):,i] = c
+        self.gain = self.coefficients[-2] if order > 1 else numpy.zeros(len(self.channellist))
+        self.offset = self.coefficients[-1]
+
+    def calibrate(self, block):
+        """
+        Converts a block of voltages to powers for all channels at once.
+        Arguments:
+            block -- array of shape (samples, channels) in channellist order
+        Returns:
+            -powers: array of the same shape as block
+        """
+        if len(self.coefficients) == 2:
+            powers = block*self.gain
+            powers += self.offset
+            return powers
+        # Horner's scheme, one whole block operation per polynomial order
+        powers = numpy.empty(block.shape,dtype=numpy.float64)
+        powers[...] = self.coefficients[0]
+        for c in self.coefficients[1:]:
+            powers *= block
+            powers += c
+        return powers
         
     def channelString(self):
         mychans = ""
@@ -81,12 +599,15 @@ class NIDAQmxAI():
             self.nidaq.DAQmxGetExtendedErrorInfo(byref(bufV),bufV_size)
             print 'nidaq call %s failed with error %d: %s'%(func,err,repr(buf.value))
             print 'nidaq call %s failed with verbose error %d: %s'%(func,err,repr(bufV.value))
-            raise ValueError
+            raise DeviceError('nidaq call %s failed with error %d: %s'%(func,err,repr(buf.value)))
 
 
     def prepareTask(self,trig = True):
         
         try :
+            if self.continuous:
+                self.prepareContinuous()
+                return
             if self.taskHandle.value != 0:
                 self.nidaq.DAQmxStopTask(self.taskHandle)
                 self.nidaq.DAQmxClearTask(self.taskHandle)
@@ -97,7 +618,7 @@ class NIDAQmxAI():
             self.CHK(self.nidaq.DAQmxCreateTask("",byref(self.taskHandle)),"CreateTask")
             
             print "Task Handle: {}".format(self.taskHandle.value)
-            
+
             #initialize data location
             self.data = numpy.zeros((self.samples_per_measurement*len(self.channellist),),dtype=numpy.float64)
             
@@ -130,8 +651,103 @@ class NIDAQmxAI():
         except KeyboardInterrupt as e :
             self.close_task()
             raise KeyboardInterrupt
-    
+
+    def prepareContinuous(self):
+        """
+        Subscribes the channels to the shared continuous task of the device
+        (SharedAITask), which samples all monitors of the device at once into
+        a ring buffer. The task is started once and never re-armed.
+        """
+        self.shared = shared_task(self.DeviceName, self.nidaq)
+        self.subscription = self.shared.subscribe(self.channellist, self.sample_rate,
+                                                  self.every_n, self.buffer_samples,
+                                                  self._every_n_samples)
+
+    @property
+    def acquired(self):
+        """
+        Continuous mode only, samples per channel acquired by the shared task
+        for this monitor, None in triggered mode
+        """
+        if self.subscription is None:
+            return None
+        return self.shared.acquired//self.subscription.decimation
+
+    def _every_n_samples(self, times, block):
+        """
+        Called from the driver's thread with every block of samples of the
+        shared task, a view of this monitor's columns. Calibrates them for the
+        block listeners.
+        """
+        if self._blockListeners:
+            block = self.calibrate(block)[:,self.mapIndex]
+            for listener in self._blockListeners:
+                listener(times, block)
+
+    def latest_window(self):
+        """
+        Returns a copy of the latest window of raw samples, shape
+        (samples, channels) in the order of channellist, oldest first, and
+        sets acquisition_time to the time of the middle of the window.
+        Right after the task started this waits for the first block.
+        """
+        block, t = self.shared.read(self.subscription, self.window, numpy.array)
+        if t is not None:
+            self.acquisition_time = t
+        return block
+
+    def value_order(self, names):
+        """
+        Returns the index of the given names among dataNames(), for
+        get_powers_into
+        """
+        return value_order(self._names, names)
+
+    def _window_powers(self):
+        """
+        Calibrates the latest window of samples and reduces it into _powers.
+        Returns immediately with whatever is in the ring buffer.
+        """
+        # calibrated straight from the view of the shared buffer, the
+        # calibration makes the only copy
+        block, t = self.shared.read(self.subscription, self.window,
+                                    lambda view: self.calibrate(view)[:,self.mapIndex])
+        if len(block) == 0:
+            raise DeviceError("no samples acquired yet")
+        self.acquisition_time = t
+        for reduce,out in self._reductionOut:
+            reduce(block,axis=0,out=out)
+
+    def get_window_powers(self):
+        """
+        Calibrates the latest window of samples and reduces it. Returns
+        immediately with whatever is in the ring buffer.
+        """
+        self._window_powers()
+        return dict(zip(self._names,self._powers.tolist()))
+
     def get_powers(self) :
+        self._measure_powers()
+        return dict(zip(self._names,self._powers.tolist()))
+
+    def get_powers_into(self, out, order):
+        """
+        Measures like get_powers, but writes the values into an array instead
+        of building a dictionary
+        Arguments:
+            out -- float array the values are written to
+            order -- the values of out, from value_order()
+        """
+        self._measure_powers()
+        out[:] = self._powers[order]
+
+    def _measure_powers(self):
+        """
+        Measures the powers into _powers, in the order of dataNames()
+        """
+        if self.continuous:
+            self._window_powers()
+            return
         try :
             read = c_int32()
             print "reading out in triggered mode"
@@ -142,6 +758,7 @@ class NIDAQmxAI():
                                            self.data.ctypes.data,
                                            len(self.data),
                                            byref(read),None)
+            readTime = time.time()
             if self.nidaq.DAQmxWaitUntilTaskDone(self.taskHandle, c_double(4.0)) < 0:
                 print "reading out in auto mode"
                 self.nidaq.DAQmxStopTask(self.taskHandle)
@@ -154,31 +771,33 @@ class NIDAQmxAI():
                                             self.data.ctypes.data,
                                             len(self.data),
                                             byref(read),None),"ReadAnalogF64")
+                readTime = time.time()
                 if self.nidaq.DAQmxWaitUntilTaskDone(self.taskHandle, c_double(4.0)) < 0:
-                    print "Something went wrong."
-                    raise ValueError
+                    raise DeviceError("triggered measurement did not finish")
       
             self.nidaq.DAQmxStopTask(self.taskHandle)
             self.CHK(self.nidaq.DAQmxCfgDigEdgeStartTrig(self.taskHandle,
                                                             c_char_p(self.triggerSource),
                                                             c_int32(self.DAQmx_Val_Rising)),"CfgDigEdgeStartTrig_Rising")
             self.CHK(self.nidaq.DAQmxStartTask(self.taskHandle),"Restarting triggered task")
-            powers_usort = {}
-            for i,chan in enumerate(self.channellist):
-                powers_usort.update({chan:self.formula[i](self.data[i])})
-            print powers_usort
-            
-            powers = {}
-            print self.channelMap
-            for key,value in self.channelMap.iteritems() :
-                print key,value
-                powers.update({key:powers_usort[value]})
-            return powers
+            # data is interleaved by scan, so rows are samples and columns
+            # follow channellist
+            block = self.data.reshape((self.samples_per_measurement,len(self.channellist)))
+            # the read returns once the last sample is in, the mean is taken
+            # over the samples clocked in before it
+            self.acquisition_time = readTime - 0.5*(self.samples_per_measurement - 1)/self.sample_rate
+            self._powers[:] = self.calibrate(block).mean(axis=0)[self.mapIndex]
         except KeyboardInterrupt as e :
             self.close_task()
             raise KeyboardInterrupt
             
     def close_task(self) :
+        if self.continuous:
+            print 'Leaving shared DAQmx task of ' + self.DeviceName
+            if self.subscription is not None:
+                self.shared.unsubscribe(self.subscription)
+                self.subscription = None
+            return
         print 'Closing DAQmx task'
         self.CHK(self.nidaq.DAQmxStopTask(self.taskHandle),"Stopping Task")
         self.CHK(self.nidaq.DAQmxClearTask(self.taskHandle),"Clearing Task")
\ No newline at end of file
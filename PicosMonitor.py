@@ -3,9 +3,10 @@ Created on Wed Mar 07 17:09:54 2018
 
 @Author: Juan Bohorquez
 Based on code by scls19fr from picotech tech support forum
-Currently only supports one device
 
-Class to control communication with the Picos TC-08 temperature monitor
+Class to control communication with the Picos TC-08 temperature monitor.
+TC08USB drives a single unit, TC08Manager opens every attached unit and reads
+them in parallel, with each thermocouple mapped to a (unit, channel) pair.
 """
 #!/usr/bin/env python
 # coding: utf8
@@ -14,6 +15,97 @@ import ctypes
 from ctypes import *
 import numpy as np
 import os
+import Queue
+import threading
+import time
+import traceback
+
+from DeviceWorkers import DeviceError
+
+
+def load_thermocouples(config, section='Thermocouples'):
+    """
+    Reads the thermocouple map of a TC08Manager from a ConfigParser object.
+    Each option maps a thermocouple name to "unit, channel", where unit is the
+    serial number of a TC-08 or its position among the attached units sorted
+    by serial number.
+    Use a ConfigParser with optionxform = str to keep the case of the names.
+    Arguments:
+        config -- ConfigParser object
+        section -- name of the section holding the map
+    Returns:
+        -channelMap: dictionary of thermocouple names to (unit, channel), empty
+            if the section is missing. Types : {String : (String or int, int)}
+    """
+    channelMap = {}
+    if not config.has_section(section):
+        return channelMap
+    for name,value in config.items(section):
+        unit,channel = [part.strip() for part in value.split(',')]
+        channelMap[name] = (int(unit) if unit.isdigit() else unit, int(channel))
+    return channelMap
+
+
+class StreamBlocks(object):
+    """
+    Gathers the streamed readings of several thermocouples into blocks of
+    whole rows for block listeners (e.g. the alarm checks of Alarms.py). Each
+    thermocouple is pulled from the driver on its own, a row is complete once
+    every thermocouple has its reading, the rest waits for the next pull.
+    """
+    def __init__(self, names, capacity):
+        """
+        Arguments:
+            names -- thermocouple names, the columns of the blocks
+            capacity -- readings kept per thermocouple while a row waits for
+                the others, the oldest are dropped beyond it
+        """
+        self.names = list(names)
+        self.listeners = []
+        self._temp = np.zeros((len(self.names), capacity))
+        self._times = np.zeros((len(self.names), capacity))
+        self._counts = np.zeros(len(self.names), dtype=int)
+
+    def add(self, i, temps, times):
+        """
+        Adds the readings of thermocouple i and their times in seconds since
+        the epoch
+        """
+        capacity = self._temp.shape[1]
+        n = min(len(temps), capacity)
+        count = self._counts[i]
+        if count + n > capacity:
+            keep = capacity - n
+            self._temp[i,:keep] = self._temp[i,count-keep:count]
+            self._times[i,:keep] = self._times[i,count-keep:count]
+            count = keep
+        self._temp[i,count:count+n] = temps[len(temps)-n:]
+        self._times[i,count:count+n] = times[len(times)-n:]
+        self._counts[i] = count + n
+
+    def emit(self):
+        """
+        Hands the complete rows to the listeners, as listener(times, block)
+        with block of shape (readings, thermocouples)
+        """
+        rows = self._counts.min()
+        if rows == 0:
+            return
+        block = self._temp[:,:rows].T
+        times = self._times[:,:rows].mean(axis=0)
+        for listener in self.listeners:
+            try:
+                listener(times, block)
+            except Exception:
+                # a failing check must not fail the measurement
+                print 'block listener failed'
+                traceback.print_exc()
+        for i in np.flatnonzero(self._counts > rows):
+            count = self._counts[i]
+            self._temp[i,:count-rows] = self._temp[i,rows:count]
+            self._times[i,:count-rows] = self._times[i,rows:count]
+        self._counts -= rows
+
 
 class TC08USB(object):
     TC_ERRORS = {
@@ -41,13 +133,17 @@ class TC08USB(object):
         'KELVIN' : 2,
         'RANKINE' : 3
     }
-    def __init__(self, dll_path=""):
+    def __init__(self, dll_path="", dll=None):
         """
         Arguments:
             dll_path -- string indicating the location of the dll to be loaded        
+            dll -- already loaded driver to use instead of usbtc08.dll, e.g.
+                SimulatedDevices.SimulatedTC08DLL
         """
-        dll_filename = os.path.join(dll_path, 'usbtc08.dll')
-        self._dll = ctypes.windll.LoadLibrary(dll_filename)
+        if dll is None:
+            dll_filename = os.path.join(dll_path, 'usbtc08.dll')
+            dll = ctypes.windll.LoadLibrary(dll_filename)
+        self._dll = dll
         
         self._handle = None # handle for device
         
@@ -55,6 +151,15 @@ class TC08USB(object):
         self._overflow_flags = np.zeros( (1,), dtype=np.int16)
         
         self._units = self.TC_UNITS['CENTIGRADE']
+
+        self.streaming = False
+        # time in seconds since the epoch the latest get_temp() readings were
+        # converted at
+        self.acquisition_time = None
+        # in streaming mode every reading is handed to the block listeners
+        self.continuous = False
+        self._blocks = None     # StreamBlocks of this unit's listeners
+        self._blockSink = None  # StreamBlocks and its column of each stream channel
         
     def open_unit(self):
         self._handle = self._dll.usb_tc08_open_unit()
@@ -70,13 +175,33 @@ class TC08USB(object):
         return(self._dll.usb_tc08_get_single(self._handle, self._temp.ctypes.data, self._overflow_flags.ctypes.data, self._units))
 
     def close_unit(self):
+        if self.streaming:
+            self.stop_streaming()
         return(self._dll.usb_tc08_close_unit(self._handle))
+
+    def get_minimum_interval_ms(self):
+        return(self._dll.usb_tc08_get_minimum_interval_ms(self._handle))
+
+    def run(self, interval_ms):
+        return(self._dll.usb_tc08_run(self._handle, c_int32(interval_ms)))
+
+    def stop(self):
+        return(self._dll.usb_tc08_stop(self._handle))
         
     def close_other_unit(self,otherHandle)    :
         return(self._dll.usb_tc08_close_unit(otherHandle))
         
     def get_last_error(self):
         return(self._dll.usb_tc08_get_last_error(self._handle))
+
+    def get_unit_info(self, line=4):
+        '''
+        Returns a line of the unit's info as a string, by default its batch
+        and serial number
+        '''
+        info = create_string_buffer(256)
+        self._dll.usb_tc08_get_unit_info2(self._handle, info, c_int16(len(info)), c_int16(line))
+        return info.value
         
     def __getitem__(self, channel):
         return(self._temp[channel])
@@ -97,8 +222,6 @@ class TC08USB(object):
             tc_type -- char indicating the thermocouple type being used
         '''
         
-        self.chanList = channels
-        
         if self.open_unit() < 1:
             i = 0
             #a unit can remain open and have an active handle which is not self.handle
@@ -111,16 +234,48 @@ class TC08USB(object):
                 if self.close_other_unit(i) == 1 :
                     self.open_unit()
             if self._handle < 0 :
-                return self.printError('Error opeining unit : ')
-                
+                return self.print_error('Error opeining unit : ')
+
+        return self.setup_unit(channels,mains,tc_type)
+
+    def setup_unit(self,channels,mains = 60,tc_type = 'k'):
+        '''
+        Sets up an open unit, see start_unit
+        Returns 0 if there are no errors, returns error code otherwise
+        '''
+        self.chanList = channels
+
         if self.set_mains(mains) == 0 :
-            return self.printError('Error setting mains rejection : ')
+            return self.print_error('Error setting mains rejection : ')
         
         for channel in channels.values() :
             if self.set_channel(channel,tc_type) < 1 :
-                return self.printError('Error setting channel ' + str(channel) + ' : ')
+                return self.print_error('Error setting channel ' + str(channel) + ' : ')
             
         return 0
+    def convert(self):
+        """
+        Queries the Picos USB TC08 to measure the temperatures, or pulls the
+        latest streamed readings. They are left in _temp, indexed by channel
+        """
+        if self.streaming:
+            self.get_temp_stream()
+            # right after streaming started, wait for the first conversions
+            tries = 0
+            while not self._stream_seen.all() and tries < 10:
+                time.sleep(self.interval_ms*1e-3)
+                self.get_temp_stream()
+                tries += 1
+            if not self._stream_seen.all():
+                # rather than reporting the zeros the readings start with
+                missing = [name for name,seen in zip(self.stream_names, self._stream_seen) if not seen]
+                raise DeviceError('no streamed reading of ' + ', '.join(missing) + ' yet')
+        else:
+            start = time.time()
+            self.get_single()
+            # the channels are converted one after the other during the call
+            self.acquisition_time = 0.5*(start + time.time())
+
     def get_temp(self):
         """
         Queries the Picos USB TC08 to measure the temperatures then generates a
@@ -129,8 +284,403 @@ class TC08USB(object):
             -data: a dictionary with keys indicating what temperature is being measured
                 and values with the temperature in Centigrade. Types : {String : np.float_32}
         """
-        self.get_single()
+        self.convert()
         data = {}
         for key,value in self.chanList.iteritems():
             data.update({key:self._temp[value]})
-        return data
\ No newline at end of file
+        return data
+
+    def value_order(self, names):
+        """
+        Returns the index of the given thermocouple names for get_temp_into
+        """
+        return np.array([self.chanList[name] for name in names], dtype=int)
+
+    def get_temp_into(self, out, order):
+        """
+        Measures the temperatures like get_temp, but writes them into an
+        array instead of building a dictionary
+        Arguments:
+            out -- float array the temperatures are written to
+            order -- the thermocouples of out, from value_order()
+        """
+        self.convert()
+        out[:] = self._temp[order]
+
+    def start_streaming(self, interval_ms=None, buffer_length=600):
+        '''
+        Starts the unit converting continuously in the background. The
+        readings are then pulled with get_temp_stream(), and get_temp() no
+        longer waits for a conversion.
+        Returns 0 if there are no errors, returns error code otherwise
+        Arguments:
+            interval_ms -- sampling interval in ms, defaults to the shortest
+                interval the unit supports with the enabled channels
+            buffer_length -- readings per channel pulled at most per call,
+                the driver itself buffers 600 readings per channel
+        '''
+        if interval_ms is None:
+            interval_ms = self.get_minimum_interval_ms()
+        channels = sorted(self.chanList.values())
+        self.stream_names = [key for key,value in sorted(self.chanList.iteritems(), key=lambda item: item[1])]
+        self.stream_channels = channels
+        self.stream_temp = np.zeros((len(channels),buffer_length), dtype=np.float32)
+        self.stream_times_ms = np.zeros((len(channels),buffer_length), dtype=np.int32)
+        self.stream_overflow = np.zeros((len(channels),), dtype=np.int16)
+        self.stream_counts = np.zeros((len(channels),), dtype=np.int32)
+        self._stream_seen = np.zeros((len(channels),), dtype=bool)
+        self._stream_latest = np.zeros((len(channels),), dtype=np.float64)
+        self.interval_ms = self.run(interval_ms)
+        if self.interval_ms == 0:
+            return self.print_error('Error starting streaming : ')
+        # driver times are ms since the run started
+        self.stream_t0 = time.time()
+        self.streaming = True
+        self.continuous = True
+        self.mapNames = list(self.stream_names)
+        return 0
+
+    def add_block_listener(self, listener):
+        '''
+        Streaming mode only, registers a function called with every reading
+        pulled by get_temp_stream(), so alarm checks see all of them and not
+        only the latest
+        Arguments:
+            listener -- called as listener(times, block), times being the
+                times of the readings in seconds since the epoch and block an
+                array of shape (readings, thermocouples) in the order of
+                mapNames, valid during the call
+        '''
+        if not self.streaming:
+            raise ValueError('block listeners need streaming mode')
+        if self._blocks is None:
+            self._blocks = StreamBlocks(self.mapNames, 4*self.stream_temp.shape[1])
+            self._blockSink = (self._blocks, range(len(self.mapNames)))
+        self._blocks.listeners.append(listener)
+
+    def get_temp_stream(self):
+        '''
+        Pulls every pending reading of each channel in one driver call per
+        channel into the preallocated stream arrays. The latest reading of
+        each channel is also stored where get_single() puts it.
+        Returns:
+            -counts: array of the number of new readings per channel, in the
+                order of stream_names. The readings are in
+                stream_temp[i,:counts[i]], their times in ms since the start
+                of streaming in stream_times_ms[i,:counts[i]], and
+                stream_overflow[i] is set if any of them overflowed
+        '''
+        buffer_length = self.stream_temp.shape[1]
+        for i,channel in enumerate(self.stream_channels):
+            n = self._dll.usb_tc08_get_temp(self._handle,
+                                            self.stream_temp[i].ctypes.data,
+                                            self.stream_times_ms[i].ctypes.data,
+                                            c_int32(buffer_length),
+                                            self.stream_overflow[i:].ctypes.data,
+                                            c_int16(channel),
+                                            c_int16(self._units),
+                                            c_int16(0))
+            if n < 0:
+                raise DeviceError('Error reading channel ' + str(channel) + ' : ' +
+                                  self.TC_ERRORS[self.get_last_error()])
+            self.stream_counts[i] = n
+            if n > 0:
+                self._temp[channel] = self.stream_temp[i,n-1]
+                self._stream_latest[i] = self.stream_t0 + self.stream_times_ms[i,n-1]*1e-3
+                self._stream_seen[i] = True
+                if self._blockSink is not None:
+                    blocks,columns = self._blockSink
+                    blocks.add(columns[i], self.stream_temp[i,:n], self.stream_timestamps(i))
+        if self._stream_seen.any():
+            self.acquisition_time = float(self._stream_latest[self._stream_seen].mean())
+        if self._blocks is not None:
+            self._blocks.emit()
+        return self.stream_counts
+
+    def stream_timestamps(self, i):
+        '''
+        Returns the times of the latest readings of stream channel i in
+        seconds since the epoch
+        '''
+        return self.stream_t0 + self.stream_times_ms[i,:self.stream_counts[i]]*1e-3
+
+    def stop_streaming(self):
+        self.streaming = False
+        return self.stop()
+
+class TC08Manager(object):
+    """
+    All TC-08 units attached to the computer, used like a single TC08USB with
+    more channels. Each thermocouple is mapped to a (unit, channel) pair, and
+    every unit is read by its own worker thread so a measurement takes as long
+    as the slowest unit instead of the sum of all units.
+    """
+    TC_ERRORS = TC08USB.TC_ERRORS
+
+    def __init__(self, dll_path="", dll=None):
+        """
+        Arguments:
+            dll_path -- string indicating the location of the dll to be loaded
+            dll -- already loaded driver to use instead of usbtc08.dll, e.g.
+                SimulatedDevices.SimulatedTC08DLL
+        """
+        if dll is None:
+            dll_filename = os.path.join(dll_path, 'usbtc08.dll')
+            dll = ctypes.windll.LoadLibrary(dll_filename)
+        self._dll = dll
+        self.units = []     # open units, sorted by serial number
+        self.serials = []
+        self.active = []    # units with thermocouples mapped to them
+        self.chanList = {}
+        self.acquisition_time = None
+        self.continuous = False     # see TC08USB.add_block_listener
+        self._blocks = None
+        self._temps = np.zeros((0, 9))  # latest readings of the active units
+        self._workers = []
+        self._results = Queue.Queue()
+
+    def open_units(self):
+        '''
+        Opens every attached unit
+        Returns 0 if there are no errors, returns error code otherwise
+        '''
+        units = []
+        while True:
+            unit = TC08USB(dll=self._dll)
+            handle = unit.open_unit()
+            if handle == 0:
+                break
+            if handle < 0:
+                for opened in units:
+                    opened.close_unit()
+                return unit.print_error('Error opening unit : ')
+            units.append(unit)
+        if not units:
+            # a unit can remain open under a handle we lost, which prevents
+            # opening it again. Close those handles and try once more
+            for i in range(1, 31):
+                if self._dll.usb_tc08_close_unit(i) == 1:
+                    unit = TC08USB(dll=self._dll)
+                    if unit.open_unit() > 0:
+                        units.append(unit)
+            if not units:
+                print 'No units detected'
+                return 10
+        serials = [tc08.get_unit_info() for tc08 in units]
+        order = sorted(range(len(units)), key=lambda i: serials[i])
+        self.units = [units[i] for i in order]
+        self.serials = [serials[i] for i in order]
+        return 0
+
+    def unit_index(self, unit):
+        '''
+        Returns the position of a unit given by serial number or position
+        '''
+        for i,serial in enumerate(self.serials):
+            if str(unit).lower() == serial.lower():
+                return i
+        if isinstance(unit, int) and 0 <= unit < len(self.units):
+            return unit
+        raise ValueError('no TC-08 unit ' + repr(unit) + ', attached units : ' + ', '.join(self.serials))
+
+    def start_unit(self,channels,mains = 60,tc_type = 'k'):
+        '''
+        Opens and sets up every attached unit. Units without thermocouples
+        mapped to them are closed again.
+        Returns 0 if there are no errors, returns error code otherwise
+        Arguments:
+            channels -- dictionary of thermocouple names to (unit, channel),
+                unit being a serial number or a position, see load_thermocouples
+            mains -- frequency for mains rejection, 50 of 60 Hz
+            tc_type -- char indicating the thermocouple type being used
+        '''
+        error = self.open_units()
+        if error:
+            return error
+        self.chanList = channels
+        unitChannels = [{} for unit in self.units]
+        try:
+            for name,(unit,channel) in channels.iteritems():
+                unitChannels[self.unit_index(unit)][name] = channel
+        except ValueError:
+            for unit in self.units:
+                unit.close_unit()
+            raise
+        self.active = []
+        for i,(unit,unitChans) in enumerate(zip(self.units, unitChannels)):
+            if not unitChans:
+                unit.close_unit()
+                continue
+            error = unit.setup_unit(unitChans,mains,tc_type)
+            if error:
+                # the failed unit is closed by print_error
+                for other in self.units[i+1:]:
+                    other.close_unit()
+                self.close_unit()
+                return error
+            self.active.append(unit)
+        self._temps = np.zeros((len(self.active), 9))
+        self._startWorkers()
+        return 0
+
+    def _startWorkers(self):
+        if len(self.active) < 2:
+            return
+        for unit in self.active:
+            requests = Queue.Queue()
+            worker = threading.Thread(target=self._work, args=(unit, requests),
+                                      name="tc08-" + str(unit._handle))
+            worker.daemon = True
+            worker.start()
+            self._workers.append((worker, requests))
+
+    def _work(self, unit, requests):
+        """
+        Worker thread of one unit, calls the requested method of the unit and
+        hands back its result or exception
+        """
+        while True:
+            method = requests.get()
+            if method is None:
+                return
+            try:
+                self._results.put((unit, getattr(unit, method)(), None))
+            except Exception as e:
+                self._results.put((unit, None, e))
+
+    def _call(self, method):
+        """
+        Calls a method of all active units at once
+        Returns:
+            -results: list of the results, in the order of the active units
+        """
+        if not self._workers:
+            return [getattr(unit, method)() for unit in self.active]
+        for worker,requests in self._workers:
+            requests.put(method)
+        results = {}
+        error = None
+        for i in range(len(self._workers)):
+            unit,result,e = self._results.get()
+            results[unit] = result
+            error = error or e
+        if error is not None:
+            raise error
+        return [results[tc08] for tc08 in self.active]
+
+    def get_temp(self):
+        """
+        Measures the temperatures on all units in parallel
+        Returns:
+            -data: a dictionary with keys indicating what temperature is being measured
+                and values with the temperature in Centigrade. Types : {String : np.float_32}
+        """
+        data = {}
+        for unitData in self._call('get_temp'):
+            data.update(unitData)
+        self.acquisition_time = float(np.mean([unit.acquisition_time for unit in self.active]))
+        if self._blocks is not None:
+            self._blocks.emit()
+        return data
+
+    def value_order(self, names):
+        """
+        Returns the index of the given thermocouple names for get_temp_into
+        """
+        order = []
+        for name in names:
+            unit,channel = self.chanList[name]
+            position = self.active.index(self.units[self.unit_index(unit)])
+            order.append(position*self._temps.shape[1] + channel)
+        return np.array(order, dtype=int)
+
+    def get_temp_into(self, out, order):
+        """
+        Measures the temperatures on all units in parallel, like get_temp,
+        but writes them into an array instead of building a dictionary
+        Arguments:
+            out -- float array the temperatures are written to
+            order -- the thermocouples of out, from value_order()
+        """
+        self._call('convert')
+        for i,unit in enumerate(self.active):
+            self._temps[i] = unit._temp
+        out[:] = self._temps.ravel()[order]
+        self.acquisition_time = float(np.mean([unit.acquisition_time for unit in self.active]))
+        if self._blocks is not None:
+            self._blocks.emit()
+
+    def start_streaming(self, interval_ms=None, buffer_length=600):
+        '''
+        Starts streaming on every active unit, see TC08USB.start_streaming
+        Returns 0 if there are no errors, returns error code otherwise
+        '''
+        for unit in self.active:
+            error = unit.start_streaming(interval_ms, buffer_length)
+            if error:
+                return error
+        self.continuous = True
+        self.mapNames = [name for unit in self.active for name in unit.stream_names]
+        return 0
+
+    def add_block_listener(self, listener):
+        '''
+        Streaming mode only, registers a function called with the readings of
+        all units pulled by a measurement, see TC08USB.add_block_listener.
+        The units' rows are matched up by their order.
+        '''
+        if not self.continuous:
+            raise ValueError('block listeners need streaming mode')
+        if self._blocks is None:
+            self._blocks = StreamBlocks(self.mapNames, 4*self.active[0].stream_temp.shape[1])
+            for unit in self.active:
+                unit._blockSink = (self._blocks, [self.mapNames.index(name) for name in unit.stream_names])
+        self._blocks.listeners.append(listener)
+
+    def close_unit(self):
+        '''
+        Stops the workers and closes all units
+        Returns 1 if every unit closed, 0 otherwise
+        '''
+        for worker,requests in self._workers:
+            requests.put(None)
+        for worker,requests in self._workers:
+            worker.join()
+        self._workers = []
+        closed = 1
+        for unit in self.active:
+            if unit.close_unit() != 1:
+                closed = 0
+        self.active = []
+        return closed
+
+
+def start_tc08(channels, dll_path="", dll=None, streaming=False, mains=60, tc_type='k'):
+    """
+    Opens and starts the TC-08, e.g. as the factory of a
+    DeviceWorkers.DeviceProcess. Raises ValueError if that fails.
+    Arguments:
+        channels -- dictionary of thermocouple names to channels for a single
+            unit, or to (unit, channel) for a TC08Manager
+        dll_path, dll -- see TC08USB
+        streaming -- start the unit(s) in streaming mode
+        mains, tc_type -- see TC08USB.start_unit
+    Returns:
+        -picos: the started TC08USB or TC08Manager
+    """
+    if any(isinstance(value, tuple) for value in channels.values()):
+        picos = TC08Manager(dll_path=dll_path, dll=dll)
+    else:
+        picos = TC08USB(dll_path=dll_path, dll=dll)
+    error = picos.start_unit(channels, mains, tc_type)
+    if not error and streaming:
+        error = picos.start_streaming()
+    if error:
+        # the units opened so far, and the workers of a manager, would keep
+        # the units busy for the next attempt
+        try:
+            picos.close_unit()
+        except Exception:
+            traceback.print_exc()
+        raise ValueError('TC-08 failed to start : ' + picos.TC_ERRORS[error])
+    return picos
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Records.py
+
+part of the Hybrid Parameter Monitor
+
+Compact records of the channels' measurements. Instead of building a new
+dictionary for every measurement, each channel owns a RecordBuffer, a ring of
+preallocated rows with one float64 per dataName. The device writes its values
+straight into the next row (e.g. TC08USB.get_temp_into), and what travels
+through the pipeline (alarm checks, rollups, alignment, reporting policy,
+publisher) is a Record: a small object pointing at that row, with the
+record's acquisition time and timestamp.
+
+Dictionaries are only built by the publisher, for a whole batch at once, right
+before the records are sent to Origin (asdicts). A Record can still be read
+like a dictionary of dataNames (and timestamp) to values.
+
+Rows are reused capacity records later. A record whose row was reused before
+it was sent is stale, the publisher drops it and counts it.
+"""
+
+import numpy as np
+
+
+class Record(object):
+    """
+    A record of a channel, pointing at a row of the channel's RecordBuffer.
+    Read like a dictionary of dataNames, and the timestamp once stamp() was
+    called, to values.
+    """
+    __slots__ = ('buffer', 'row', 'seq', 'values', 'time', 'timestamp', 'timestampKey')
+
+    def __init__(self, buffer, row, seq):
+        self.buffer = buffer
+        self.row = row
+        self.seq = seq
+        self.values = buffer.rows[row]  # in the order of the buffer's dataNames
+        self.time = None                # acquisition time in seconds since the epoch
+        self.timestamp = None
+        self.timestampKey = None
+
+    def stamp(self, t, timestamp, timestampKey):
+        """
+        Sets the acquisition time and the timestamp of the record
+        Arguments:
+            t -- acquisition time in seconds since the epoch
+            timestamp -- the timestamp sent to Origin
+            timestampKey -- name of the timestamp in the record
+        """
+        self.time = t
+        self.timestamp = timestamp
+        self.timestampKey = timestampKey
+
+    def stale(self):
+        """
+        Returns True if the record's row was reused by a newer record
+        """
+        return self.buffer.seqs[self.row] != self.seq
+
+    def __getitem__(self, name):
+        if name == self.timestampKey and name is not None:
+            return self.timestamp
+        return float(self.values[self.buffer.index[name]])
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        if self.timestampKey is None:
+            return list(self.buffer.dataNames)
+        return self.buffer.dataNames + [self.timestampKey]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.buffer.dataNames) + (self.timestampKey is not None)
+
+    def __contains__(self, name):
+        return name in self.buffer.index or (name == self.timestampKey and name is not None)
+
+    def asdict(self):
+        """
+        Returns the record as a dictionary of dataNames and timestamp to values
+        """
+        data = dict(zip(self.buffer.dataNames, self.values.tolist()))
+        if self.timestampKey is not None:
+            data[self.timestampKey] = self.timestamp
+        return data
+
+    def __repr__(self):
+        # no dictionary, records can be printed in the measurement loop
+        return 'Record(time=%r, values=%r)' % (self.time, self.values)
+
+
+class RecordBuffer(object):
+    """
+    Ring of preallocated rows holding the records of a channel. Only the
+    channel's measuring thread takes new records.
+    """
+    def __init__(self, dataNames, capacity=1024):
+        """
+        Arguments:
+            dataNames -- names of the values of a record, the columns of the rows
+            capacity -- number of rows, a record has to be sent before
+                capacity newer records are taken
+        """
+        self.dataNames = list(dataNames)
+        self.index = dict((name, i) for i, name in enumerate(self.dataNames))
+        self.capacity = capacity
+        self.values = np.zeros((capacity, len(self.dataNames)))
+        # views of the rows are made once, not for every record
+        self.rows = list(self.values)
+        # number of the record each row holds
+        self.seqs = np.full(capacity, -1, dtype=np.int64)
+        self.taken = 0
+
+    def next(self):
+        """
+        Returns a new Record on the oldest row, to be filled in place. The
+        record which held the row before becomes stale.
+        """
+        seq = self.taken
+        row = seq % self.capacity
+        self.seqs[row] = seq
+        self.taken = seq + 1
+        return Record(self, row, seq)
+
+    def fill(self, data):
+        """
+        Returns a new Record holding the values of a dictionary of dataNames
+        to values, for channels which measure dictionaries. Missing values are
+        NaN.
+        """
+        record = self.next()
+        values = record.values
+        for i, name in enumerate(self.dataNames):
+            values[i] = data.get(name, np.nan)
+        return record
+
+
+def value_order(deviceNames, dataNames):
+    """
+    Returns the positions of dataNames among the names of a device's values,
+    so values[order] puts the device's values in the order of dataNames
+    """
+    position = dict((name, i) for i, name in enumerate(deviceNames))
+    return np.array([position[name] for name in dataNames], dtype=int)
+
+
+def asdicts(records):
+    """
+    Returns the dictionaries of a batch of records as sent to Origin. The
+    rows of all records of a buffer are gathered at once. Dictionaries in the
+    batch (e.g. rollup records) are passed on as they are.
+    Arguments:
+        records -- list of Records and dictionaries
+    Returns:
+        -dicts: list of the dictionaries in the order of records, None for
+            stale records
+    """
+    dicts = list(records)
+    groups = {}
+    for i, record in enumerate(records):
+        if isinstance(record, Record):
+            groups.setdefault(record.buffer, []).append(i)
+    for buffer, positions in groups.items():
+        rows = np.array([records[i].row for i in positions])
+        values = buffer.values[rows].tolist()
+        # the rows are copied before checking they were not reused meanwhile
+        seqs = buffer.seqs[rows].tolist()
+        names = buffer.dataNames
+        for i, row, seq in zip(positions, values, seqs):
+            record = records[i]
+            if seq != record.seq:
+                dicts[i] = None
+                continue
+            data = dict(zip(names, row))
+            if record.timestampKey is not None:
+                data[record.timestampKey] = record.timestamp
+            dicts[i] = data
+    return dicts
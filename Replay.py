@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+Replay.py
+
+part of the Hybrid Parameter Monitor
+
+Feeds archived records (StreamArchive.py) back through the channel pipeline.
+The channels of HybridMonitor.cfg are started as usual, with their alarm
+rules, rollups, reporting policies and alignment, but each device is replaced
+by an ArchiveDevice handing out the archived records of the channel's stream.
+The records of all channels are measured and published in time order, as
+fast as the pipeline takes them or at --speed times real time, and keep their
+original timestamps.
+
+Targets:
+    server -- a SimulatedServer standing in for Origin, to load test the
+        publishing path (see --server-latency)
+    archive -- a new local archive in --output, e.g. to backfill the streams
+        and their rollups after the pickoffs were calibrated again. With
+        --recalibrate the pickoff powers are converted from the calibration
+        of that config to the one of --config
+
+Usage:
+    python Replay.py --archive archive --target server
+    python Replay.py --archive archive --channels Beam_Balances
+        --start 1530000000 --stop 1530086400 --target archive
+        --output backfill --recalibrate HybridMonitor_old.cfg
+
+Reports the records replayed per second, sustained over the whole run
+including the publisher draining its queue.
+"""
+
+import argparse
+import ConfigParser
+import heapq
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import PickoffMonitor
+from Alarms import AlarmEngine
+from ChannelStartup import ChannelStartup
+from HybridChannels import closeAll, flushRollups, measureAndPublish
+from OriginPublisher import OriginPublisher
+from Records import value_order
+from SimulatedDevices import SimulatedServer
+from StreamArchive import StreamArchive, Archive, TIMESTAMP as ARCHIVE_TIMESTAMP
+from TimeAlignment import timestampScale, load_alignment
+
+TIMESTAMP = 'measurement_time'
+
+
+class ArchiveDevice(object):
+    """
+    Stands in for the device of a channel, handing out the archived records of
+    its stream one per measurement. Answers to the measuring methods of the
+    device modules (get_temp_into, get_powers_into, get_field_into).
+    """
+    def __init__(self, archive, start=None, stop=None, conversion=None, chunk=4096):
+        """
+        Arguments:
+            archive -- StreamArchive of the channel's stream
+            start, stop -- time range in seconds since the epoch, None for an
+                open end
+            conversion -- dictionary of dataNames to (scale, shift) applied
+                to the archived values, see PickoffMonitor.recalibration
+            chunk -- number of rows read from the archive at once
+        """
+        self.stream = archive.stream
+        self.names = list(archive.dataNames)
+        self.chunk = chunk
+        stamps = archive.query(columns=[])[ARCHIVE_TIMESTAMP]
+        # the archive keeps the timestamps in origin's units
+        self.scale = timestampScale(stamps[0]) if len(stamps) else 1.0
+        data = archive.query(None if start is None else start*self.scale,
+                             None if stop is None else stop*self.scale)
+        self.stamps = data[ARCHIVE_TIMESTAMP]
+        self.columns = [data[name] for name in self.names]
+        self._scale = np.ones(len(self.names))
+        self._shift = np.zeros(len(self.names))
+        for name, (scale, shift) in (conversion or {}).items():
+            if name in self.names:
+                self._scale[self.names.index(name)] = scale
+                self._shift[self.names.index(name)] = shift
+        self.converted = conversion is not None
+        self.position = 0
+        self._first = 0
+        self._rows = np.zeros((0, len(self.names)))
+        self.stamp = None
+        self.acquisition_time = None
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def next_time(self):
+        """
+        Returns the time in seconds since the epoch of the next record, None
+        once all were read
+        """
+        if self.position >= len(self.stamps):
+            return None
+        return float(self.stamps[self.position])/self.scale
+
+    def value_order(self, names):
+        missing = [name for name in names if name not in self.names]
+        if missing:
+            raise ValueError('archive of ' + self.stream + ' has no ' + ', '.join(missing))
+        return value_order(self.names, names)
+
+    def _load(self, first):
+        """
+        Reads the chunk of rows starting at first from the memory mapped columns
+        """
+        last = min(first + self.chunk, len(self.stamps))
+        rows = np.empty((last - first, len(self.names)))
+        for i, column in enumerate(self.columns):
+            rows[:,i] = column[first:last]
+        if self.converted:
+            rows *= self._scale
+            rows += self._shift
+        self._first = first
+        self._rows = rows
+
+    def read_into(self, out, order):
+        """
+        Writes the next archived record into an array and sets
+        acquisition_time to its time
+        Arguments:
+            out -- float array the values are written to
+            order -- the values of out, from value_order()
+        """
+        i = self.position
+        if i >= len(self.stamps):
+            raise ValueError('all records of ' + self.stream + ' were replayed')
+        if not self._first <= i < self._first + len(self._rows):
+            self._load(i)
+        out[:] = self._rows[i - self._first][order]
+        stamp = float(self.stamps[i])
+        # timestamps in ms, us, ns or 2**-32 s are integers in origin
+        self.stamp = stamp if self.scale == 1.0 else int(round(stamp))
+        self.acquisition_time = stamp/self.scale
+        self.position = i + 1
+
+    get_temp_into = get_powers_into = get_field_into = read_into
+
+    def timestamp(self, t):
+        """
+        Returns the archived timestamp of the record read last, the
+        timestamp function of measureAndPublish
+        """
+        return self.stamp
+
+    def close(self):
+        pass
+
+    close_unit = close_task = close
+
+
+class ReplayStartup(ChannelStartup):
+    """
+    Starts the channels of a config with ArchiveDevices instead of their
+    devices
+    """
+    def __init__(self, config, server, onReady, alarms, directory, start=None,
+                 stop=None, oldCalibration=None):
+        """
+        Arguments:
+            config, server, onReady, alarms -- see ChannelStartup
+            directory -- directory of the archives replayed
+            start, stop -- see ArchiveDevice
+            oldCalibration -- pickoff calibration the archived records were
+                measured with (see PickoffMonitor.load_calibration), they are
+                converted to the calibration of config. None replays them
+                as they are
+        """
+        super(ReplayStartup, self).__init__(config, server, onReady, alarms=alarms)
+        self.directory = directory
+        self.startTime = start
+        self.stopTime = stop
+        self.oldCalibration = oldCalibration
+        self.devices = {}   # channel name : its ArchiveDevice
+
+    def openDevice(self, name, section, spec):
+        conversion = None
+        if self.oldCalibration is not None and self.config.get(section, 'device') == 'PickoffMonitor':
+            conversion = PickoffMonitor.recalibration(spec.args[0], self.oldCalibration,
+                                                      spec.kwargs['calibration'],
+                                                      spec.kwargs.get('reductions', ('mean',)))
+        archive = StreamArchive(self.directory, "Hybrid_" + name)
+        device = ArchiveDevice(archive, self.startTime, self.stopTime, conversion)
+        with self._lock:
+            self.devices[archive.stream] = device
+        return device
+
+
+class Replay(object):
+    """
+    One replay, see the module docstring
+    """
+    def __init__(self, args):
+        self.args = args
+        self.channels = []
+
+    def setup(self):
+        args = self.args
+        config = ConfigParser.ConfigParser()
+        config.optionxform = str
+        if not config.read(args.config):
+            raise ValueError('can not read ' + args.config)
+        oldCalibration = None
+        if args.recalibrate:
+            old = ConfigParser.ConfigParser()
+            old.optionxform = str
+            if not old.read(args.recalibrate):
+                raise ValueError('can not read ' + args.recalibrate)
+            oldCalibration = PickoffMonitor.load_calibration(old)
+        self.server = SimulatedServer(latency=args.server_latency if args.target == 'server' else 0.0)
+        archive = Archive(args.output, TIMESTAMP) if args.target == 'archive' else None
+        # publish() waits for space instead of dropping, the replay runs at
+        # the pace of the publisher
+        self.publisher = OriginPublisher(batchSize=args.batch_size, maxDelay=0.1,
+                                         maxQueue=args.queue, block=True,
+                                         timestampKey=TIMESTAMP, archive=archive)
+        self.alarms = AlarmEngine()
+        names = None if args.channels is None else [n.strip() for n in args.channels.split(',')]
+        startup = ReplayStartup(config, self.server, self.channels.append, self.alarms,
+                                args.archive, args.start, args.stop, oldCalibration)
+        startup.start(names)
+        startup.join()
+        if not self.channels:
+            raise ValueError('no channel to replay')
+        self.devices = [startup.devices[chan.name] for chan in self.channels]
+        for chan in self.channels:
+            # every queued record keeps its row until it is sent
+            chan.capacity = args.queue + 2*args.batch_size
+        # aligned records and alarm states get timestamps in the units of
+        # the archive
+        scale = self.devices[0].scale
+        if scale == 1.0:
+            self.timestamp = lambda t: t
+        else:
+            self.timestamp = lambda t: int(round(t*scale))
+        load_alignment(config, self.channels, self.server, self.timestamp)
+
+    def run(self):
+        """
+        Replays the records and returns the results
+        """
+        self.setup()
+        args = self.args
+        devices = self.devices
+        queue = [(device.next_time(), i) for i, device in enumerate(devices)
+                 if device.next_time() is not None]
+        heapq.heapify(queue)
+        replayed = dict((chan.name, 0) for chan in self.channels)
+        self.publisher.start()
+        self.alarms.start()
+        self.alarms.connect(self.server, self.publisher, self.timestamp, TIMESTAMP)
+        cpu0 = sum(os.times()[:4])
+        t0 = time.time()
+        first = queue[0][0] if queue else None
+        while queue:
+            t, i = heapq.heappop(queue)
+            if args.speed > 0:
+                wait = t0 + (t - first)/args.speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            chan, device = self.channels[i], devices[i]
+            measureAndPublish(chan, self.publisher, device.timestamp, TIMESTAMP)
+            replayed[chan.name] += 1
+            t = device.next_time()
+            if t is not None:
+                heapq.heappush(queue, (t, i))
+        loop = time.time() - t0
+        # the last buckets of the rollups are sent too
+        flushRollups(self.channels)
+        self.publisher.stop()
+        self.alarms.stop(10)
+        wall = time.time() - t0
+        cpu = sum(os.times()[:4]) - cpu0
+        closeAll(self.channels)
+
+        total = sum(replayed.values())
+        results = {'records' : total,
+                   'duration' : wall,
+                   'rate' : total/wall if wall > 0 else None,
+                   'loop rate' : total/loop if loop > 0 else None,
+                   'cpu' : cpu/wall if wall > 0 else None,
+                   'publisher' : self.publisher.stats(),
+                   'channels' : {}}
+        for chan in self.channels:
+            results['channels'][chan.name] = {'replayed' : replayed[chan.name]}
+        for name, stream in self.server.streams.items():
+            results['channels'].setdefault(name, {})['received'] = stream.received
+        if self.alarms.rules:
+            results['alarm events'] = self.alarms.stats()['events']
+        return results
+
+
+def report(results):
+    print '%d records in %.2f s, %.0f records/s sustained (%.0f records/s through the channels), cpu %.1f %%' % (
+        results['records'], results['duration'], results['rate'] or 0,
+        results['loop rate'] or 0, 100*(results['cpu'] or 0))
+    print 'publisher : ' + repr(results['publisher'])
+    if 'alarm events' in results:
+        print 'alarm events : %d' % results['alarm events']
+    for name, counts in sorted(results['channels'].items()):
+        print '%-32s ' % name + ', '.join('%s %d' % item for item in sorted(counts.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay archived records through the channel pipeline')
+    parser.add_argument('--archive', default='archive', help='directory of the archived streams')
+    parser.add_argument('--config', default='HybridMonitor.cfg', help='monitor config of the channels')
+    parser.add_argument('--channels', help='comma separated channels to replay, all by default')
+    parser.add_argument('--start', type=float, help='start of the time range, s since the epoch')
+    parser.add_argument('--stop', type=float, help='end of the time range, s since the epoch')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='multiple of real time to replay at, 0 for as fast as possible')
+    parser.add_argument('--target', choices=('server', 'archive'), default='server',
+                        help='stand-in Origin server or a local archive')
+    parser.add_argument('--output', help='directory of the archive written with --target archive')
+    parser.add_argument('--recalibrate', help='config holding the pickoff calibration the records were archived with')
+    parser.add_argument('--server-latency', type=float, default=0.0, help='stand-in server send latency in s')
+    parser.add_argument('--batch-size', type=int, default=100, help='publisher batch size')
+    parser.add_argument('--queue', type=int, default=1000, help='publisher queue length')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args(argv)
+    if args.target == 'archive':
+        if args.output is None:
+            parser.error('--target archive needs --output')
+        if os.path.abspath(args.output) == os.path.abspath(args.archive):
+            parser.error('--output has to differ from --archive')
+
+    results = Replay(args).run()
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+ReportingPolicy.py
+
+part of the Hybrid Parameter Monitor
+
+Per channel policies deciding which records are sent to the server, so slowly
+varying signals do not produce a full record every cycle:
+
+    absolute deadband -- report when a value moved more than a fixed amount
+        from the last reported value
+    relative deadband -- report when a value moved more than a fraction of
+        the last reported value
+    heartbeat -- report at least every heartbeat seconds
+    swinging door -- report only the points needed to reconstruct the signal
+        by linear interpolation within a given deviation
+
+All tests run on arrays across the channel's dataNames, a record is reported
+when any of its values calls for it. For the swinging door the doors of all
+values are tracked together and the whole record is the archived point.
+
+Policies are read from HybridMonitor.cfg, one section per channel:
+
+    [Reporting Temp]
+    absolute = 0.05
+    absolute.coils = 0.2
+    heartbeat = 600
+"""
+
+import numpy as np
+
+SETTINGS = ('absolute', 'relative', 'heartbeat', 'swinging_door')
+
+
+def load_policy(config, name, dataNames):
+    """
+    Reads the reporting policy of a channel from a ConfigParser object.
+    Settings apply to all dataNames, "setting.dataname" overrides one of them.
+    Arguments:
+        config -- ConfigParser object
+        name -- name of the channel, the section is "Reporting <name>"
+        dataNames -- the channel's dataNames
+    Returns:
+        -policy: ReportingPolicy, or None if the channel has no section
+    """
+    section = 'Reporting ' + name
+    if not config.has_section(section):
+        return None
+    settings = {}
+    for option, value in config.items(section):
+        setting, _, dataName = option.partition('.')
+        setting = setting.lower()
+        if setting not in SETTINGS:
+            raise ValueError('unknown reporting setting ' + repr(option) + ' in ' + section)
+        if setting == 'heartbeat':
+            settings[setting] = float(value)
+            continue
+        perName = settings.setdefault(setting, {})
+        if not dataName:
+            perName[None] = float(value)
+            continue
+        for candidate in dataNames:
+            # ConfigParser lower cases option names unless told otherwise
+            if candidate.lower() == dataName.lower():
+                perName[candidate] = float(value)
+    for setting, perName in settings.items():
+        if setting != 'heartbeat':
+            default = perName.pop(None, None)
+            settings[setting] = [perName.get(key, default) for key in dataNames]
+    return ReportingPolicy(dataNames, **settings)
+
+
+class ReportingPolicy(object):
+    """
+    Filters the records of one channel
+    """
+    def __init__(self, dataNames, absolute=None, relative=None, heartbeat=None,
+                 swinging_door=None):
+        """
+        Arguments:
+            dataNames -- the channel's dataNames
+            absolute -- absolute deadband, a number or a list with one entry
+                per dataName (None entries disable it for that dataName)
+            relative -- relative deadband, as a fraction of the last reported
+                value, like absolute
+            heartbeat -- maximum time in seconds between reported records
+            swinging_door -- compression deviation of the swinging door, like
+                absolute
+        Without deadbands and swinging door every record is reported.
+        """
+        self.dataNames = list(dataNames)
+        absolute = self._setting(absolute)
+        relative = self._setting(relative)
+        door = self._setting(swinging_door)
+        # dataNames without any deadband never trigger a report on their own
+        self._noBand = np.isnan(absolute) & np.isnan(relative)
+        self.deadband = not self._noBand.all()
+        self.absolute = np.nan_to_num(absolute)
+        self.relative = np.nan_to_num(relative)
+        self.swingingDoor = not np.isnan(door).all()
+        self.door = np.where(np.isnan(door), np.inf, door)
+        self.heartbeat = heartbeat
+        self._values = np.zeros(len(self.dataNames))
+        self.last = None        # last reported values
+        self.lastTime = None    # time of the last reported record
+        self.reported = 0
+        self.suppressed = 0
+        self._resetDoor(None, None)
+
+    def _setting(self, value):
+        """
+        Returns a setting as an array across dataNames, NaN where it is
+        disabled
+        """
+        if value is None:
+            value = np.nan
+        if np.isscalar(value):
+            return np.full(len(self.dataNames), float(value))
+        return np.array([np.nan if v is None else v for v in value], dtype=np.float64)
+
+    def _resetDoor(self, t, values):
+        self.doorTime = t
+        self.doorValues = None if values is None else values.copy()
+        self.slopeHigh = np.full(len(self.dataNames), np.inf)
+        self.slopeLow = np.full(len(self.dataNames), -np.inf)
+        self.held = None
+
+    def _report(self, t, values, data, records):
+        records.append(data)
+        self.last = values.copy()
+        self.lastTime = t
+        self.reported += 1
+
+    def filter(self, t, data):
+        """
+        Returns the records to be reported after a new record arrived.
+        Arguments:
+            t -- time of the record in seconds
+            data -- the channel's record, a Records.Record
+        Returns:
+            -records: list of records to send, in order. Empty if the record
+                is suppressed, it can hold a record held back by the swinging
+                door before the new one
+        """
+        values = self._values
+        values[:] = data.values
+        records = []
+        if self.last is None:
+            self._report(t, values, data, records)
+            self._resetDoor(t, values)
+            return records
+
+        if self.swingingDoor:
+            dt = t - self.doorTime
+            if dt > 0:
+                # the line from the door's point to this one has to pass
+                # within the deviation of every point in between, otherwise
+                # the previous point is needed and the doors restart from it
+                slope = (values - self.doorValues)/dt
+                if self.held is not None and ((slope > self.slopeHigh) | (slope < self.slopeLow)).any():
+                    heldTime, heldValues, heldData = self.held
+                    self._report(heldTime, heldValues, heldData, records)
+                    self._resetDoor(heldTime, heldValues)
+                    dt = t - heldTime
+                self.slopeHigh = np.minimum(self.slopeHigh, (values + self.door - self.doorValues)/dt)
+                self.slopeLow = np.maximum(self.slopeLow, (values - self.door - self.doorValues)/dt)
+            self.held = (t, values.copy(), data)
+
+        report = (self.heartbeat is not None and t - self.lastTime >= self.heartbeat)
+        if self.deadband and not report:
+            band = np.maximum(self.absolute, self.relative*np.abs(self.last))
+            band[self._noBand] = np.inf
+            report = (np.abs(values - self.last) > band).any()
+        if not self.deadband and not self.swingingDoor:
+            report = True
+        if report:
+            self._report(t, values, data, records)
+            self._resetDoor(t, values)
+        elif not records:
+            self.suppressed += 1
+        return records
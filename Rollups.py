@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Rollups.py
+
+part of the Hybrid Parameter Monitor
+
+Multi-resolution rollups of a channel's records. A RollupStage sits between
+channel.measure() and the publisher and keeps running count, mean, std, min
+and max of every dataName over fixed time buckets at several resolutions
+(e.g. 1 s, 10 s, 1 min). Each sample updates all buckets in O(1), with one
+vector operation across the channel's dataNames. When a sample falls into a
+new bucket the finished one is published on its own stream, named after the
+channel and the resolution (Hybrid_Beam_Balances_10s, ...).
+
+Dashboards can then read the coarse streams cheaply, while the raw records
+are kept in the local archive (and optionally still sent to the server).
+"""
+
+import numpy as np
+
+from HybridChannels import channel
+
+
+def resolutionLabel(resolution):
+    """
+    Returns a stream suffix for a resolution in seconds, e.g. 10s or 1min
+    """
+    if resolution >= 60 and resolution % 60 == 0:
+        return '%dmin' % (resolution // 60)
+    if resolution == int(resolution):
+        return '%ds' % resolution
+    return '%gs' % resolution
+
+
+class Rollup(object):
+    """
+    Running aggregates of a set of values over buckets of one resolution.
+
+    The sums are taken relative to the first sample of the bucket, so the
+    variance does not lose precision to large offsets (e.g. temperatures).
+    """
+    def __init__(self, resolution, dataNames):
+        """
+        Arguments:
+            resolution -- bucket length in seconds
+            dataNames -- names of the aggregated values
+        """
+        self.resolution = resolution
+        self.dataNames = list(dataNames)
+        n = len(self.dataNames)
+        self.bucket = None
+        self.count = 0
+        self.stamp = None
+        self.recordStamp = None
+        self.shift = np.zeros(n)
+        self.sum = np.zeros(n)
+        self.sumsq = np.zeros(n)
+        self.min = np.zeros(n)
+        self.max = np.zeros(n)
+        self._delta = np.zeros(n)
+        self.names = {}
+        for reduction in ('mean', 'std', 'min', 'max'):
+            self.names[reduction] = [name + '_' + reduction for name in self.dataNames]
+
+    def recordNames(self):
+        """
+        Returns the names of the values in the records returned by add()
+        """
+        names = []
+        for reduction in ('mean', 'std', 'min', 'max'):
+            names.extend(self.names[reduction])
+        return names + ['count']
+
+    def add(self, t, stamp, values):
+        """
+        Adds a sample.
+        Arguments:
+            t -- time of the sample in seconds, selects the bucket
+            stamp -- timestamp of the sample as published, the last one of a
+                bucket becomes the timestamp of its record
+            values -- array of the values, in the order of dataNames
+        Returns:
+            -record: dictionary of the aggregates of the previous bucket if
+                this sample started a new one, otherwise None. Its timestamp
+                is left in recordStamp
+        """
+        bucket = int(t // self.resolution)
+        record = None
+        if bucket != self.bucket:
+            if self.count:
+                record = self.record()
+                self.recordStamp = self.stamp
+            self.bucket = bucket
+            self.count = 0
+            self.shift[:] = values
+            self.sum[:] = 0
+            self.sumsq[:] = 0
+            self.min[:] = values
+            self.max[:] = values
+        np.subtract(values, self.shift, out=self._delta)
+        self.sum += self._delta
+        self._delta *= self._delta
+        self.sumsq += self._delta
+        np.minimum(self.min, values, out=self.min)
+        np.maximum(self.max, values, out=self.max)
+        self.count += 1
+        self.stamp = stamp
+        return record
+
+    def flush(self):
+        """
+        Ends the current bucket before it is complete, when the channel stops
+        Returns:
+            -record: dictionary of the aggregates of the bucket, None if it
+                has no samples. Its timestamp is left in recordStamp
+        """
+        if not self.count:
+            return None
+        record = self.record()
+        self.recordStamp = self.stamp
+        self.bucket = None
+        self.count = 0
+        return record
+
+    def record(self):
+        """
+        Returns the aggregates of the current bucket as a dictionary, without
+        a timestamp
+        """
+        mean = self.sum/self.count
+        std = np.sqrt(np.maximum(self.sumsq/self.count - mean*mean, 0))
+        record = {'count' : self.count}
+        record.update(zip(self.names['mean'], (self.shift + mean).tolist()))
+        record.update(zip(self.names['std'], std.tolist()))
+        record.update(zip(self.names['min'], self.min.tolist()))
+        record.update(zip(self.names['max'], self.max.tolist()))
+        return record
+
+
+class rollupChannel(channel):
+    """
+    Class representing the stream of one rollup resolution of a channel. It is
+    not scheduled, the RollupStage publishes its records.
+    """
+    def __init__(self, name, dataType, server, rollup):
+        """
+        Arguments
+            rollup -- the Rollup whose records go to this stream
+        """
+        self.rollup = rollup
+        super(rollupChannel,self).__init__(name, dataType,server,rollup.recordNames())
+
+    def measure(self):
+        return self.data
+
+
+class RollupStage(object):
+    """
+    The rollups of one channel at several resolutions
+    """
+    def __init__(self, chan, server, resolutions=(1, 10, 60), publishRaw=True,
+                 dataType="float"):
+        """
+        Arguments:
+            chan -- the channel whose records are rolled up
+            server -- the server class representing connection to Origin
+            resolutions -- bucket lengths in seconds, one stream each
+            publishRaw -- if False the raw records of the channel are only
+                archived locally, only the rollups are sent to the server
+            dataType -- data type of the rollup streams
+        """
+        self.dataNames = list(chan.dataNames)
+        self.publishRaw = publishRaw
+        self.channels = []
+        # where add() publishes, for the buckets left at flush()
+        self.publisher = None
+        self.timestampKey = None
+        short = chan.name[len("Hybrid_"):]
+        for resolution in resolutions:
+            rollup = Rollup(resolution, self.dataNames)
+            self.channels.append(rollupChannel(short + '_' + resolutionLabel(resolution),
+                                               dataType, server, rollup))
+
+    def add(self, data, t, timestampKey, publisher):
+        """
+        Adds a record of the channel to all rollups and publishes the buckets
+        it completes.
+        Arguments:
+            data -- the channel's record, a Records.Record
+            t -- time of the record in seconds
+            timestampKey -- name of the timestamp in the record
+            publisher -- OriginPublisher the rollup records are handed to
+        """
+        self.publisher = publisher
+        self.timestampKey = timestampKey
+        # the rollups copy what they need, the record's row can be read as it is
+        values = data.values
+        stamp = data.timestamp
+        for chan in self.channels:
+            record = chan.rollup.add(t, stamp, values)
+            if record is not None:
+                record[timestampKey] = chan.rollup.recordStamp
+                publisher.publish(chan, record)
+
+    def flush(self):
+        """
+        Publishes the buckets not completed yet, so the records of the last
+        seconds before the channel stops are not lost. The publisher has to
+        be still running.
+        """
+        if self.publisher is None:
+            return
+        for chan in self.channels:
+            record = chan.rollup.flush()
+            if record is not None:
+                record[self.timestampKey] = chan.rollup.recordStamp
+                self.publisher.publish(chan, record)
+
+    def hang(self):
+        self.flush()
+        for chan in self.channels:
+            chan.hang()
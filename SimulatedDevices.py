@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+SimulatedDevices.py
+
+part of the Hybrid Parameter Monitor
+
+Stand-ins for the vendor drivers and the Origin server so the monitor can be
+run and timed without the lab hardware (e.g. on Linux):
+
+    SimulatedTC08DLL -- replaces usbtc08.dll, pass it to PicosMonitor.TC08USB
+    SimulatedNIDAQmx -- replaces nicaiu.dll, pass it to PickoffMonitor.NIDAQmxAI
+    SimulatedServer -- replaces origin.client.server
+
+The drivers expose the same functions as the DLLs, with the same arguments
+(ctypes objects, byref() references and raw buffer addresses), so the Device
+Monitor classes run their real code paths against them. Every simulated call
+can be given a latency, a gaussian jitter on that latency and a failure rate.
+"""
+
+import ctypes
+import math
+import random
+import threading
+import time
+
+import numpy as np
+
+
+def _value(arg):
+    """
+    Returns the python value of a ctypes argument
+    """
+    return arg.value if hasattr(arg, 'value') else arg
+
+
+def _ref(arg):
+    """
+    Returns the ctypes object behind a byref() argument
+    """
+    return getattr(arg, '_obj', arg)
+
+
+class SimulatedLatency(object):
+    """
+    Latency, jitter and failure injection shared by all simulated devices
+    """
+    def __init__(self, latency=0.0, jitter=0.0, failureRate=0.0, seed=None):
+        """
+        Arguments:
+            latency -- mean duration of a call in seconds
+            jitter -- standard deviation of the duration in seconds
+            failureRate -- probability of a call failing
+            seed -- seed for the random number generator
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+
+    def delay(self, extra=0.0):
+        """
+        Sleeps for one call's duration plus extra seconds
+        """
+        self.calls += 1
+        duration = extra + self.latency
+        if self.jitter:
+            duration += self.random.gauss(0, self.jitter)
+        if duration > 0:
+            time.sleep(duration)
+
+    def fail(self):
+        """
+        Returns True if this call should fail
+        """
+        if self.failureRate and self.random.random() < self.failureRate:
+            self.failures += 1
+            return True
+        return False
+
+
+class SimulatedTC08DLL(SimulatedLatency):
+    """
+    Simulated usbtc08.dll. Thermocouples read a baseline temperature with a
+    slow sinusoidal drift and gaussian noise, channel 0 is the cold junction.
+    A conversion takes conversionTime per enabled channel (plus the cold
+    junction), like the real unit, on top of the call latency.
+    """
+    def __init__(self, units=1, conversionTime=0.1, baseline=22.0, drift=0.5,
+                 driftPeriod=600.0, noise=0.02, **kwargs):
+        """
+        Arguments:
+            units -- number of attached units
+            conversionTime -- conversion time in seconds per channel
+            baseline -- mean temperature in Centigrade
+            drift -- amplitude of the temperature drift
+            driftPeriod -- period of the temperature drift in seconds
+            noise -- standard deviation of the temperature noise
+            latency, jitter, failureRate, seed -- see SimulatedLatency
+        """
+        super(SimulatedTC08DLL, self).__init__(**kwargs)
+        self.units = units
+        self.conversionTime = conversionTime
+        self.baseline = baseline
+        self.drift = drift
+        self.driftPeriod = driftPeriod
+        self.noise = noise
+        self.handles = {}   # handle : set of enabled channels
+        self.runs = {}      # handle : [start time, interval in s, readings fetched per channel]
+        self.lastError = 0
+        self._nextUnit = 1
+
+    def temperatures(self, handle, t):
+        """
+        Returns the 9 simulated temperatures of a unit at time t
+        """
+        phase = 2*math.pi*t/self.driftPeriod
+        temps = [self.baseline + self.drift*math.sin(phase + 0.3*channel + handle)
+                 + self.random.gauss(0, self.noise)
+                 for channel in range(9)]
+        return temps
+
+    def usb_tc08_open_unit(self):
+        if self.fail():
+            self.lastError = 7
+            return -1
+        if self._nextUnit > self.units:
+            return 0
+        handle = self._nextUnit
+        self._nextUnit += 1
+        self.handles[handle] = set()
+        return handle
+
+    def usb_tc08_close_unit(self, handle):
+        handle = _value(handle)
+        if self.handles.pop(handle, None) is None:
+            return 0
+        return 1
+
+    def usb_tc08_set_mains(self, handle, value):
+        return 1
+
+    def usb_tc08_set_channel(self, handle, channel, tc_type):
+        handle = _value(handle)
+        if handle not in self.handles:
+            self.lastError = 3
+            return 0
+        self.handles[handle].add(_value(channel))
+        return 1
+
+    def usb_tc08_get_single(self, handle, temp, overflow_flags, units):
+        handle = _value(handle)
+        self.delay(self.conversionTime*(len(self.handles.get(handle, ())) + 1))
+        if handle not in self.handles or self.fail():
+            self.lastError = 7
+            return 0
+        buf = (ctypes.c_float*9).from_address(temp)
+        buf[:] = self.temperatures(handle, time.time())
+        ctypes.c_int16.from_address(overflow_flags).value = 0
+        return 1
+
+    def usb_tc08_get_last_error(self, handle):
+        return self.lastError
+
+    def usb_tc08_get_unit_info2(self, handle, string, string_length, line):
+        """
+        Only the batch and serial number line is simulated, e.g. SIM01/001
+        """
+        handle = _value(handle)
+        if handle not in self.handles:
+            self.lastError = 3
+            return 0
+        info = 'SIM%02d/%03d' % (handle, handle) if _value(line) == 4 else ''
+        info = info[:_value(string_length) - 1]
+        _ref(string).value = info
+        return len(info)
+
+    def usb_tc08_get_minimum_interval_ms(self, handle):
+        handle = _value(handle)
+        return int(1000*self.conversionTime*(len(self.handles.get(handle, ())) + 1))
+
+    def usb_tc08_run(self, handle, interval_ms):
+        handle = _value(handle)
+        if handle not in self.handles:
+            self.lastError = 3
+            return 0
+        interval_ms = max(_value(interval_ms), self.usb_tc08_get_minimum_interval_ms(handle))
+        self.runs[handle] = [time.time(), interval_ms*1e-3, {}]
+        return interval_ms
+
+    def usb_tc08_stop(self, handle):
+        return 1 if self.runs.pop(_value(handle), None) is not None else 0
+
+    def usb_tc08_get_temp(self, handle, temp, times, length, overflow, channel,
+                          units, fill_missing):
+        """
+        Returns the readings converted since the last call, at most length and
+        at most the 600 the real driver buffers
+        """
+        handle = _value(handle)
+        channel = _value(channel)
+        length = _value(length)
+        self.delay()
+        if handle not in self.runs or self.fail():
+            self.lastError = 5 if handle in self.handles else 3
+            return -1
+        t0, interval, fetched = self.runs[handle]
+        total = int((time.time() - t0)//interval)
+        first = max(fetched.get(channel, 0), total - 600)
+        n = min(total - first, length)
+        fetched[channel] = first + n
+        readingTimes = t0 + interval*(np.arange(first, first + n) + 1)
+        buf = (ctypes.c_float*length).from_address(temp)
+        msBuf = (ctypes.c_int32*length).from_address(times)
+        for i, t in enumerate(readingTimes):
+            buf[i] = self.temperatures(handle, t)[channel]
+            msBuf[i] = int(round((t - t0)*1000))
+        ctypes.c_int16.from_address(overflow).value = 0
+        return n
+
+
+class _SimulatedTask(object):
+    def __init__(self):
+        self.channels = 0
+        self.rate = 1000.0
+        self.continuous = False
+        self.samples = 0
+        self.triggered = False
+        self.running = False
+        self.status = 0
+        self.acquired = 0   # samples per channel handed out since start
+        self.t0 = None
+        self.everyN = None
+        self.thread = None
+
+
+class SimulatedNIDAQmx(SimulatedLatency):
+    """
+    Simulated nicaiu.dll analog input. Each channel reads a constant voltage
+    with gaussian noise, plus optional sine tones on the sample clock (e.g.
+    mains pickup for the magnetic field sensor). Finite reads take as long as the samples would take
+    at the sample clock rate, a triggered read misses its trigger with
+    probability triggerMissRate and then times out. Continuous tasks call the
+    registered every-N-samples callback from a driver thread at the rate the
+    samples would arrive.
+    """
+    DAQmxErrorSamplesNotYetAvailable = -200284
+    DAQmxErrorWaitUntilDoneDoesNotIndicateDone = -200560
+    DAQmxErrorSimulatedFailure = -50103
+
+    def __init__(self, voltages=(0.5, 0.6, 1.1, 1.0, 0.7, 0.25), noise=0.005,
+                 triggerMissRate=0.0, tones=(), **kwargs):
+        """
+        Arguments:
+            voltages -- mean voltage of each analog input, repeated if the
+                task has more channels
+            noise -- standard deviation of the voltage noise
+            triggerMissRate -- probability of a triggered read missing the
+                trigger
+            tones -- (frequency in Hz, amplitude in V) of sine waves added to
+                every channel
+            latency, jitter, failureRate, seed -- see SimulatedLatency
+        """
+        super(SimulatedNIDAQmx, self).__init__(**kwargs)
+        self.voltages = voltages
+        self.noise = noise
+        self.triggerMissRate = triggerMissRate
+        self.tones = tones
+        self.tasks = {}
+        self._nextHandle = 1
+        self._noise = np.random.RandomState(kwargs.get('seed'))
+
+    def _samples(self, task, n):
+        voltages = np.resize(np.asarray(self.voltages, dtype=np.float64), task.channels)
+        samples = voltages + self.noise*self._noise.standard_normal((n, task.channels))
+        if self.tones:
+            t = (task.acquired + np.arange(n))/task.rate
+            for frequency, amplitude in self.tones:
+                samples += amplitude*np.sin(2*np.pi*frequency*t)[:,None]
+        return samples
+
+    def _task(self, handle):
+        return self.tasks[_value(handle)]
+
+    def DAQmxCreateTask(self, name, handle):
+        _ref(handle).value = self._nextHandle
+        self.tasks[self._nextHandle] = _SimulatedTask()
+        self._nextHandle += 1
+        return 0
+
+    def DAQmxCreateAIVoltageChan(self, handle, channels, *args):
+        self._task(handle).channels += len(_value(channels).split(','))
+        return 0
+
+    def DAQmxCfgSampClkTiming(self, handle, source, rate, edge, mode, samples):
+        task = self._task(handle)
+        task.rate = float(_value(rate))
+        task.continuous = _value(mode) == 10123
+        task.samples = _value(samples)
+        return 0
+
+    def DAQmxCfgDigEdgeStartTrig(self, handle, source, edge):
+        self._task(handle).triggered = True
+        return 0
+
+    def DAQmxDisableStartTrig(self, handle):
+        self._task(handle).triggered = False
+        return 0
+
+    def DAQmxRegisterEveryNSamplesEvent(self, handle, eventType, n, options, callback, data):
+        self._task(handle).everyN = (_value(n), callback)
+        return 0
+
+    def DAQmxStartTask(self, handle):
+        task = self._task(handle)
+        task.running = True
+        task.acquired = 0
+        task.t0 = time.time()
+        if task.continuous and task.everyN is not None:
+            task.thread = threading.Thread(target=self._everyN,
+                                           args=(_value(handle), task))
+            task.thread.daemon = True
+            task.thread.start()
+        return 0
+
+    def _everyN(self, handle, task):
+        n, callback = task.everyN
+        blocks = 0
+        while task.running:
+            blocks += 1
+            wait = task.t0 + blocks*n/task.rate - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            if task.running:
+                callback(handle, 1, n, None)
+
+    def DAQmxStopTask(self, handle):
+        task = self._task(handle)
+        task.running = False
+        if task.thread is not None and task.thread is not threading.current_thread():
+            task.thread.join()
+        task.thread = None
+        return 0
+
+    def DAQmxClearTask(self, handle):
+        self.DAQmxStopTask(handle)
+        del self.tasks[_value(handle)]
+        return 0
+
+    def DAQmxReadAnalogF64(self, handle, n, timeout, fill, data, size, read, reserved):
+        task = self._task(handle)
+        n = _value(n)
+        timeout = _value(timeout)
+        _ref(read).value = 0
+        if not task.continuous:
+            if task.triggered and self.random.random() < self.triggerMissRate:
+                time.sleep(timeout)
+                task.status = self.DAQmxErrorSamplesNotYetAvailable
+                return task.status
+            self.delay(n/task.rate)
+        if self.fail():
+            task.status = self.DAQmxErrorSimulatedFailure
+            return task.status
+        n = min(n, _value(size)//task.channels)
+        buf = (ctypes.c_double*(n*task.channels)).from_address(data)
+        buf[:] = self._samples(task, n).ravel().tolist()
+        task.acquired += n
+        _ref(read).value = n
+        task.status = 0
+        return 0
+
+    def DAQmxWaitUntilTaskDone(self, handle, timeout):
+        status = self._task(handle).status
+        if status < 0:
+            return self.DAQmxErrorWaitUntilDoneDoesNotIndicateDone
+        return 0
+
+    def DAQmxGetErrorString(self, err, buf, size):
+        _ref(buf).value = 'simulated error %d' % _value(err)
+        return 0
+
+    def DAQmxGetExtendedErrorInfo(self, buf, size):
+        _ref(buf).value = 'simulated failure'
+        return 0
+
+
+class SimulatedStream(object):
+    """
+    Connection to a stream of the SimulatedServer
+    """
+    def __init__(self, server, stream, records):
+        self.server = server
+        self.stream = stream
+        self.records = records
+        self.received = 0
+        self.closed = False
+
+    def send(self, **data):
+        self.server.delay()
+        if self.closed or self.server.fail():
+            raise IOError('simulated server failed to receive ' + self.stream)
+        self.received += 1
+        if self.server.onReceive is not None:
+            self.server.onReceive(self.stream, data, time.time())
+
+    def close(self):
+        self.closed = True
+
+
+class SimulatedServer(SimulatedLatency):
+    """
+    Local stand-in for origin.client.server. Streams accept records after the
+    configured latency and count them, onReceive(stream, data, time) is called
+    for every received record if it is set.
+    """
+    def __init__(self, onReceive=None, **kwargs):
+        """
+        Arguments:
+            onReceive -- callable called with the stream name, the record and
+                the receive time of every record
+            latency, jitter, failureRate, seed -- see SimulatedLatency
+        """
+        super(SimulatedServer, self).__init__(**kwargs)
+        self.onReceive = onReceive
+        self.streams = {}
+        self.downUntil = 0
+
+    def outage(self, duration):
+        """
+        Takes the server down for duration seconds, breaking the connections
+        of all registered streams, which have to be registered again
+        """
+        self.downUntil = time.time() + duration
+        for connection in self.streams.values():
+            connection.closed = True
+
+    def registerStream(self, stream, records, timeout=None):
+        self.delay()
+        if time.time() < self.downUntil:
+            raise IOError('simulated server is down')
+        connection = SimulatedStream(self, stream, records)
+        previous = self.streams.get(stream)
+        if previous is not None:
+            # count the records of a stream across registrations
+            connection.received = previous.received
+        self.streams[stream] = connection
+        return connection
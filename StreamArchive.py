@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+StreamArchive.py
+
+part of the Hybrid Parameter Monitor
+
+Optional local archive of the published records, so recent history can be
+looked at on site without going through the Origin server.
+
+Each stream is a directory of append-only column files of little endian
+float64, one for the timestamps and one per dataName, plus a sparse index
+holding the timestamp of every indexEvery-th row:
+
+    <directory>/<stream>/columns.json   names of the columns
+    <directory>/<stream>/timestamp.f64  timestamps, in the records' units
+    <directory>/<stream>/<dataName>.f64 values
+    <directory>/<stream>/index.f64      (timestamp, row) pairs
+
+Timestamps are assumed to increase within a stream. Reads memory map the
+columns, a time range query bisects the sparse index and then only the
+indexEvery rows at either end of the range, and returns views of the maps.
+
+Usage:
+    archive = StreamArchive('archive', 'Hybrid_Temp')
+    data = archive.query(t0, t1)
+    data['timestamp'], data['Coils']
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+TIMESTAMP = 'timestamp'
+
+
+class StreamArchive(object):
+    """
+    The archive of a single stream
+    """
+    def __init__(self, directory, stream, dataNames=None, indexEvery=1024):
+        """
+        Opens the archive of a stream, creating it if dataNames are given.
+        Arguments:
+            directory -- directory holding the archives of all streams
+            stream -- name of the stream
+            dataNames -- names of the value columns, only needed to create a
+                new archive
+            indexEvery -- number of rows between entries of the sparse index
+        """
+        self.path = os.path.join(directory, stream)
+        self.stream = stream
+        self.indexEvery = indexEvery
+        self._lock = threading.Lock()
+        self._files = None
+        columnsFile = os.path.join(self.path, 'columns.json')
+        if os.path.exists(columnsFile):
+            with open(columnsFile) as f:
+                self.dataNames = [str(name) for name in json.load(f)]
+            if dataNames is not None and sorted(dataNames) != sorted(self.dataNames):
+                raise ValueError('archive of ' + stream + ' has columns ' + repr(self.dataNames))
+        elif dataNames is not None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.dataNames = list(dataNames)
+            with open(columnsFile, 'w') as f:
+                json.dump(self.dataNames, f)
+        else:
+            raise ValueError('no archive of ' + stream + ' in ' + directory)
+        self.columns = [TIMESTAMP] + self.dataNames
+        self.rows = self._recover()
+        index = self._read('index', 2)
+        self._index = np.array(index, dtype=np.float64) if len(index) else np.zeros((0,2))
+
+    def _column(self, name):
+        return os.path.join(self.path, name + '.f64')
+
+    def _recover(self):
+        """
+        Returns the number of complete rows. Columns left longer than the others
+        by a crash in the middle of an append are cut back.
+        """
+        sizes = []
+        for name in self.columns:
+            path = self._column(name)
+            sizes.append(os.path.getsize(path)//8 if os.path.exists(path) else 0)
+        rows = min(sizes)
+        for name, size in zip(self.columns, sizes):
+            if size > rows:
+                with open(self._column(name), 'r+b') as f:
+                    f.truncate(rows*8)
+        path = self._column('index')
+        if os.path.exists(path):
+            # drop torn entries and entries of rows which were cut back
+            entries = min(os.path.getsize(path)//16,
+                          (rows + self.indexEvery - 1)//self.indexEvery)
+            with open(path, 'r+b') as f:
+                f.truncate(entries*16)
+        return rows
+
+    def _read(self, name, width=1):
+        path = self._column(name)
+        if not os.path.exists(path) or os.path.getsize(path) < 8*width:
+            return np.zeros((0,) if width == 1 else (0, width))
+        rows = os.path.getsize(path)//(8*width)
+        shape = (rows,) if width == 1 else (rows, width)
+        return np.memmap(path, dtype='<f8', mode='r', shape=shape)
+
+    def append(self, timestamp, data):
+        """
+        Appends a row.
+        Arguments:
+            timestamp -- the row's timestamp
+            data -- dictionary of dataNames to values, missing values are
+                stored as NaN
+        """
+        with self._lock:
+            if self._files is None:
+                self._files = [open(self._column(name), 'ab') for name in self.columns]
+                self._indexFile = open(self._column('index'), 'ab')
+            values = [timestamp] + [data.get(name, np.nan) for name in self.dataNames]
+            for f, value in zip(self._files, np.array(values, dtype='<f8')):
+                f.write(value.tobytes())
+            if self.rows % self.indexEvery == 0:
+                entry = np.array([timestamp, self.rows], dtype='<f8')
+                self._indexFile.write(entry.tobytes())
+                self._index = np.vstack((self._index, entry))
+            self.rows += 1
+
+    def flush(self):
+        with self._lock:
+            if self._files is not None:
+                for f in self._files + [self._indexFile]:
+                    f.flush()
+
+    def close(self):
+        with self._lock:
+            if self._files is not None:
+                for f in self._files + [self._indexFile]:
+                    f.close()
+                self._files = None
+
+    def query(self, start=None, stop=None, columns=None):
+        """
+        Returns the rows with start <= timestamp < stop.
+        Arguments:
+            start, stop -- time range, None for an open end
+            columns -- dataNames to return, all by default
+        Returns:
+            -data: dictionary of 'timestamp' and the dataNames to read only
+                arrays, views of the memory mapped columns
+        """
+        self.flush()
+        with self._lock:
+            rows = self.rows
+            index = self._index
+        timestamps = self._read(TIMESTAMP)[:rows]
+        first = 0 if start is None else self._bisect(timestamps, index, start, rows)
+        last = rows if stop is None else self._bisect(timestamps, index, stop, rows)
+        data = {TIMESTAMP : timestamps[first:last]}
+        for name in (self.dataNames if columns is None else columns):
+            data[name] = self._read(name)[first:last]
+        return data
+
+    def _bisect(self, timestamps, index, t, rows):
+        """
+        Returns the first row with timestamp >= t, using the sparse index to
+        pick the block of indexEvery rows to search
+        """
+        block = np.searchsorted(index[:,0], t, 'left') - 1 if len(index) else -1
+        if block < 0:
+            lo = 0
+        else:
+            lo = int(index[block,1])
+        hi = min(rows, lo + self.indexEvery + 1) if block + 1 < len(index) else rows
+        return lo + int(np.searchsorted(timestamps[lo:hi], t, 'left'))
+
+
+class Archive(object):
+    """
+    The archives of all streams in a directory, created as records arrive.
+    Used by the publisher to archive every record it receives.
+    """
+    def __init__(self, directory, timestampKey, indexEvery=1024):
+        """
+        Arguments:
+            directory -- directory holding the archives
+            timestampKey -- name of the timestamp in the records
+            indexEvery -- number of rows between entries of the sparse indices
+        """
+        self.directory = directory
+        self.timestampKey = timestampKey
+        self.indexEvery = indexEvery
+        self.streams = {}
+
+    def append(self, channel, data):
+        """
+        Archives a record of a channel
+        """
+        archive = self.streams.get(channel.name)
+        if archive is None:
+            archive = StreamArchive(self.directory, channel.name,
+                                    channel.dataNames, self.indexEvery)
+            self.streams[channel.name] = archive
+        archive.append(data[self.timestampKey], data)
+
+    def open(self, stream):
+        """
+        Returns the archive of a stream for queries
+        """
+        return self.streams.get(stream) or StreamArchive(self.directory, stream)
+
+    def flush(self):
+        for archive in list(self.streams.values()):
+            archive.flush()
+
+    def close(self):
+        for archive in list(self.streams.values()):
+            archive.close()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+StreamSpool.py
+
+part of the Hybrid Parameter Monitor
+
+Local store-and-forward spool used by the publisher while the Origin server is
+unreachable. Each stream gets a set of append-only segment files which are
+memory mapped, records are fixed size binary rows so appending and replaying
+is a copy into or out of the map.
+
+Segment layout:
+    header (HEADER_SIZE bytes) : magic, record size, write position, read
+        position, struct format and field names of the records
+    records : packed back to back from HEADER_SIZE to the end of the file
+
+The write position in the header is only advanced after a record has been
+copied into the map, so a record torn by a crash is simply never read. The
+read position is only advanced once replayed records have been sent, so a crash
+during replay sends some records twice rather than losing them.
+"""
+
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+
+HEADER_SIZE = 4096
+MAGIC = 'HYBSPOOL'
+# magic, record size, write position, read position, length of the json
+# description of the records
+HEADER = struct.Struct('<8sIQQI')
+
+
+class SpoolSegment(object):
+    """
+    One memory mapped segment file
+    """
+    def __init__(self, path, size=None, fmt=None, fields=None):
+        """
+        Opens an existing segment, or creates a new one if fmt and fields are
+        given.
+        Arguments:
+            path -- file name of the segment
+            size -- total file size in bytes, new segments only
+            fmt -- struct format of one record, new segments only
+            fields -- names of the record's fields, new segments only
+        """
+        self.path = path
+        if fields is not None:
+            self._file = open(path, 'w+b')
+            self._file.seek(size - 1)
+            self._file.write('\0')
+            self._file.flush()
+            self.map = mmap.mmap(self._file.fileno(), size)
+            description = json.dumps({'format' : fmt, 'fields' : fields})
+            if HEADER.size + len(description) > HEADER_SIZE:
+                raise ValueError('too many fields for a spool segment : ' + path)
+            self.record = struct.Struct(fmt)
+            self.fields = list(fields)
+            self.write = HEADER_SIZE
+            self.read = HEADER_SIZE
+            self.map[HEADER.size:HEADER.size+len(description)] = description
+            HEADER.pack_into(self.map, 0, MAGIC, self.record.size,
+                             self.write, self.read, len(description))
+        else:
+            self._file = open(path, 'r+b')
+            size = os.path.getsize(path)
+            self.map = mmap.mmap(self._file.fileno(), size)
+            magic, recordSize, self.write, self.read, length = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError('not a spool segment : ' + path)
+            description = json.loads(self.map[HEADER.size:HEADER.size+length])
+            self.record = struct.Struct(str(description['format']))
+            self.fields = [str(field) for field in description['fields']]
+        self.size = size
+
+    def full(self):
+        return self.write + self.record.size > self.size
+
+    def pending(self):
+        """
+        Returns the number of records appended but not yet replayed
+        """
+        return (self.write - self.read) // self.record.size
+
+    def append(self, values):
+        """
+        Copies a record into the map, then publishes it by advancing the
+        write position in the header
+        """
+        self.record.pack_into(self.map, self.write, *values)
+        self.write += self.record.size
+        struct.pack_into('<Q', self.map, 12, self.write)
+
+    def peek(self, n):
+        """
+        Returns up to n of the oldest unreplayed records as tuples
+        """
+        records = []
+        offset = self.read
+        end = min(self.write, self.read + n*self.record.size)
+        while offset < end:
+            records.append(self.record.unpack_from(self.map, offset))
+            offset += self.record.size
+        return records
+
+    def commit(self, n):
+        """
+        Marks the n oldest unreplayed records as replayed
+        """
+        self.read = min(self.write, self.read + n*self.record.size)
+        struct.pack_into('<Q', self.map, 20, self.read)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+class StreamSpool(object):
+    """
+    The spool of a single stream, a bounded set of segments in a directory.
+
+    When the spool would grow beyond maxSegments segments the oldest segment is
+    deleted, its unreplayed records are counted in dropped.
+    """
+    def __init__(self, directory, stream, segmentBytes=1024*1024,
+                 maxSegments=64, timestampKey=None):
+        """
+        Arguments:
+            directory -- directory holding the segment files, created if needed
+            stream -- name of the stream, used to name the segments
+            segmentBytes -- size of each segment file in bytes
+            maxSegments -- maximum number of segment files, this bounds the
+                disk usage to about segmentBytes*maxSegments
+            timestampKey -- name of the timestamp field, stored as an unsigned
+                64 bit integer. All other fields are stored as doubles
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.stream = stream
+        self.segmentBytes = segmentBytes
+        self.maxSegments = maxSegments
+        self.timestampKey = timestampKey
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self.segments = []
+        # pick up whatever a previous run left behind
+        for path in sorted(glob.glob(self._path('*'))):
+            try:
+                self.segments.append(SpoolSegment(path))
+            except (ValueError, EnvironmentError) as e:
+                print "skipping unreadable spool segment " + path + " : " + repr(e)
+                continue
+            self._sequence = int(path.split('.')[-2]) + 1
+
+    def _path(self, sequence):
+        if sequence == '*':
+            return os.path.join(self.directory, self.stream + '.*.spool')
+        return os.path.join(self.directory, '%s.%08d.spool' % (self.stream, sequence))
+
+    def _newSegment(self, fields):
+        fmt = '<' + ''.join('Q' if field == self.timestampKey else 'd'
+                            for field in fields)
+        segment = SpoolSegment(self._path(self._sequence), self.segmentBytes,
+                               fmt, fields)
+        self._sequence += 1
+        self.segments.append(segment)
+        while len(self.segments) > self.maxSegments:
+            oldest = self.segments.pop(0)
+            self.dropped += oldest.pending()
+            print "spool for " + self.stream + " full, dropping " + oldest.path
+            oldest.remove()
+        return segment
+
+    def append(self, data):
+        """
+        Spools a record.
+        Arguments:
+            data -- dictionary of field names to values. Missing values of an
+                existing segment's fields are stored as NaN
+        """
+        with self._lock:
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or segment.full() or not set(data) <= set(segment.fields):
+                segment = self._newSegment(sorted(data.keys()))
+            segment.append([data.get(field, float('nan')) for field in segment.fields])
+
+    def _removeReplayed(self):
+        """
+        Deletes the fully replayed segments at the start of the spool, but
+        not the last one while records can still be appended to it. Called
+        holding the lock.
+        """
+        while self.segments and self.segments[0].pending() == 0 and \
+                (len(self.segments) > 1 or self.segments[0].full()):
+            self.segments.pop(0).remove()
+
+    def peek(self, n):
+        """
+        Returns up to n of the oldest spooled records as dictionaries
+        """
+        with self._lock:
+            # a segment may have been replayed to its end before newer
+            # segments were started
+            self._removeReplayed()
+            if not self.segments:
+                return []
+            segment = self.segments[0]
+            fields = segment.fields
+            return [dict(zip(fields, values)) for values in segment.peek(n)]
+
+    def commit(self, n):
+        """
+        Removes the n oldest records, returned by the last peek(), once they
+        have been sent. Fully replayed segments are deleted.
+        """
+        with self._lock:
+            if not self.segments:
+                return
+            self.segments[0].commit(n)
+            self._removeReplayed()
+
+    def __len__(self):
+        with self._lock:
+            return sum(segment.pending() for segment in self.segments)
+
+    def flush(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.flush()
+                segment.close()
+            self.segments = []
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+TimeAlignment.py
+
+part of the Hybrid Parameter Monitor
+
+Records are timestamped with the time their device acquired them (the sample
+clock of the DAQ, the conversion times of the TC-08), not the time they were
+sent. Channels still sample at their own times and rates, so to correlate
+them a GridAligner resamples several channels onto a common time grid by
+linear interpolation and publishes the aligned values as one stream:
+
+    [Alignment]
+    channels = Temp, Beam_Balances
+    interval = 1
+
+publishes Hybrid_Aligned with Temp_Coils, Beam_Balances_X1, ... every second
+of acquisition time. A grid point is published once every channel has a
+sample at or after it, so it is interpolated rather than extrapolated.
+"""
+
+import math
+import threading
+import time
+
+import numpy as np
+
+from HybridChannels import channel
+
+# units of timestamps, in timestamps per second
+SCALES = (1.0, 1e3, 1e6, 1e9, 2.0**32)
+
+
+def timestampScale(sample, t=None):
+    """
+    Returns the units of a timestamp among SCALES, in timestamps per second
+    Arguments:
+        sample -- a timestamp
+        t -- its time in seconds since the epoch, roughly, now by default
+    """
+    t = time.time() if t is None else t
+    return min(SCALES, key=lambda s: abs(math.log(float(sample)/(t*s))))
+
+
+def originTimestamp(now):
+    """
+    Returns a function converting times in seconds since the epoch into the
+    timestamps returned by now(), e.g. origin's current_time. Their units are
+    recognized among SCALES.
+    Arguments:
+        now -- callable returning the current timestamp
+    """
+    t = time.time()
+    sample = now()
+    scale = timestampScale(sample, t)
+    if isinstance(sample, (int, long)):
+        return lambda t: int(round(t*scale))
+    return lambda t: t*scale
+
+
+def interpolate(grid, times, values):
+    """
+    Linearly interpolates all columns of values at the grid times at once.
+    Arguments:
+        grid -- array of the times to interpolate at
+        times -- increasing array of the sample times
+        values -- array of shape (samples, columns)
+    Returns:
+        -resampled: array of shape (len(grid), columns), NaN at grid times
+            outside the sampled range
+    """
+    out = np.empty((len(grid), values.shape[1]))
+    out.fill(np.nan)
+    if len(times) == 0:
+        return out
+    if len(times) == 1:
+        out[grid == times[0]] = values[0]
+        return out
+    upper = np.clip(np.searchsorted(times, grid, 'right'), 1, len(times) - 1)
+    lower = upper - 1
+    span = times[upper] - times[lower]
+    weight = np.where(span > 0, (grid - times[lower])/np.where(span > 0, span, 1), 0)
+    out[:] = values[lower] + weight[:,None]*(values[upper] - values[lower])
+    out[(grid < times[0]) | (grid > times[-1])] = np.nan
+    return out
+
+
+class alignedChannel(channel):
+    """
+    Class representing the stream of aligned records. It is not scheduled,
+    the GridAligner publishes its records.
+    """
+    def measure(self):
+        return self.data
+
+
+class GridAligner(object):
+    """
+    Resamples the records of several channels onto a common time grid
+    """
+    def __init__(self, name, channels, server, interval, timestamp,
+                 maxLag=60.0, dataType="float"):
+        """
+        Arguments:
+            name -- name of the aligned stream
+            channels -- the channels to align
+            server -- the server class representing connection to Origin
+            interval -- spacing of the grid in seconds
+            timestamp -- callable returning the timestamp of a time in seconds
+                since the epoch, see originTimestamp
+            maxLag -- a channel whose latest sample is more than maxLag
+                seconds older than the newest sample of any channel does not
+                hold up the grid, its values are NaN until it catches up
+            dataType -- data type of the aligned stream
+        """
+        self.interval = interval
+        self.timestamp = timestamp
+        self.maxLag = maxLag
+        self.members = list(channels)
+        self._index = {}
+        self._columns = []
+        names = []
+        for i, chan in enumerate(self.members):
+            self._index[chan.name] = i
+            short = chan.name[len("Hybrid_"):]
+            self._columns.append(slice(len(names), len(names) + len(chan.dataNames)))
+            names.extend(short + '_' + dataName for dataName in chan.dataNames)
+        self.dataNames = names
+        self.channel = alignedChannel(name, dataType, server, names)
+        self._times = [[] for chan in self.members]
+        self._values = [[] for chan in self.members]
+        self.next = None    # next grid time to publish
+        self._first = None
+        self._lock = threading.Lock()
+
+    def add(self, chan, t, data, timestampKey, publisher):
+        """
+        Adds a record of one of the channels and publishes the grid points it
+        completes.
+        Arguments:
+            chan -- the channel the record belongs to
+            t -- acquisition time of the record in seconds since the epoch
+            data -- the channel's record, a Records.Record
+            timestampKey -- name of the timestamp in the record
+            publisher -- OriginPublisher the aligned records are handed to
+        """
+        i = self._index[chan.name]
+        # the record's row is reused later, the aligner keeps a copy
+        values = data.values.copy()
+        with self._lock:
+            times = self._times[i]
+            if times and t <= times[-1]:
+                return
+            times.append(t)
+            self._values[i].append(values)
+            if self.next is None:
+                self._first = t
+                self.next = math.ceil(t/self.interval)*self.interval
+            records = self._align(timestampKey)
+        for record in records:
+            publisher.publish(self.channel, record)
+
+    def _align(self, timestampKey):
+        """
+        Returns the records of the grid points every channel has caught up to
+        """
+        # a channel which did not report yet holds up the grid like one whose
+        # last sample came with the first sample of all
+        latest = [times[-1] if times else self._first for times in self._times]
+        newest = max(latest)
+        current = [newest - t <= self.maxLag for t in latest]
+        end = min(t for t, ok in zip(latest, current) if ok)
+        if end < self.next:
+            return []
+        grid = self.next + self.interval*np.arange(int((end - self.next)//self.interval) + 1)
+        aligned = np.empty((len(grid), len(self.dataNames)))
+        aligned.fill(np.nan)
+        for i, ok in enumerate(current):
+            if not ok or not self._times[i]:
+                continue
+            aligned[:,self._columns[i]] = interpolate(grid, np.array(self._times[i]),
+                                                      np.array(self._values[i]))
+        self.next = grid[-1] + self.interval
+        # keep the last sample before the next grid point for interpolating it
+        for i, times in enumerate(self._times):
+            keep = max(0, np.searchsorted(times, self.next, 'right') - 1)
+            del times[:keep]
+            del self._values[i][:keep]
+        records = []
+        for g, row in zip(grid, aligned.tolist()):
+            record = dict(zip(self.dataNames, row))
+            record[timestampKey] = self.timestamp(g)
+            records.append(record)
+        return records
+
+    def hang(self):
+        self.channel.hang()
+
+
+def load_alignment(config, channels, server, timestamp, section='Alignment'):
+    """
+    Creates the GridAligner configured in a ConfigParser object and attaches
+    it to its channels. Options of the section:
+        channels -- names of the channels to align, e.g. Temp, Beam_Balances
+        interval -- spacing of the grid in seconds
+        max_lag -- see GridAligner, 60 s by default
+        stream -- name of the aligned stream, Aligned by default
+    Arguments:
+        config -- ConfigParser object
+        channels -- the started channels
+        server -- the server class representing connection to Origin
+        timestamp -- see GridAligner
+        section -- name of the section
+    Returns:
+        -aligner: GridAligner, or None if the section is missing
+    """
+    if not config.has_section(section):
+        return None
+    byName = dict((chan.name, chan) for chan in channels)
+    members = []
+    for name in config.get(section, 'channels').split(','):
+        name = "Hybrid_" + name.strip()
+        if name not in byName:
+            print "channel " + name + " is not running, not aligned"
+            continue
+        members.append(byName[name])
+    if not members:
+        return None
+    maxLag = config.getfloat(section, 'max_lag') if config.has_option(section, 'max_lag') else 60.0
+    stream = config.get(section, 'stream') if config.has_option(section, 'stream') else 'Aligned'
+    aligner = GridAligner(stream, members, server, config.getfloat(section, 'interval'),
+                          timestamp, maxLag)
+    for chan in members:
+        chan.alignment = aligner
+    return aligner
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of reading rate controllers from the config
+"""
+
+import ConfigParser
+import io
+
+import numpy as np
+import pytest
+
+import PickoffMonitor
+from AdaptiveRate import RateController, load_adaptive
+
+
+def config(text):
+    parser = ConfigParser.RawConfigParser()
+    parser.readfp(io.BytesIO(text))
+    return parser
+
+
+ADAPTIVE = """
+[Adaptive Beam_Balances]
+min_period = 0.5
+max_period = 10
+deadband = 0.01
+"""
+
+
+def test_block_names_have_to_be_data_names():
+    inputs = {'X1' : 'ai4', 'X2' : 'ai2'}
+    blockNames = inputs.keys()
+    cfg = config(ADAPTIVE)
+    dataNames = PickoffMonitor.data_names(inputs, True, ('mean', 'std'))
+    controller = load_adaptive(cfg, 'Beam_Balances', dataNames, blockNames=blockNames)
+    controller.blockListener(blockNames)
+    dataNames = PickoffMonitor.data_names(inputs, True, ('std', 'max'))
+    with pytest.raises(ValueError) as error:
+        load_adaptive(cfg, 'Beam_Balances', dataNames, blockNames=blockNames)
+    assert 'X1' in str(error.value)
+    assert load_adaptive(cfg, 'Beam_Balances', dataNames) is not None
+
+
+def test_nan_record_does_not_disable_transients():
+    controller = RateController('Temp', ['Coils', 'Chamber'], min_period=1, max_period=10,
+                                deadband=0.5)
+    controller.update(0, np.array([20.0, np.nan]))
+    controller.update(10, np.array([np.nan, 21.0]))
+    for t in range(20, 100, 10):
+        controller.update(t, np.array([20.0, 21.0]))
+    assert controller.period == 10 and controller.transients == 0
+    assert np.isfinite(controller._mean).all() and np.isfinite(controller._var).all()
+    assert controller.update(100, np.array([20.0, 23.0])) == 1
+    assert controller.update(110, np.array([25.0, 23.0])) == 1
+    assert controller.transients == 1
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the alarm rules' hysteresis state machine (Alarms.py)
+"""
+
+import numpy as np
+
+from Alarms import AlarmEngine, AlarmRules, _settle
+
+
+def settle(block, high=1.0, hysteresis=0.2, active=False, latch=False):
+    block = np.asarray(block, dtype=np.float64)[:,None]
+    return _settle(block > high, block < high - hysteresis,
+                   np.array([active]), np.array([latch]))
+
+
+def reference(block, high=1.0, hysteresis=0.2, active=False, latch=False):
+    """
+    The state machine run sample by sample
+    """
+    changes = []
+    for k, value in enumerate(block):
+        if value > high and not active:
+            active = True
+            changes.append((k, True))
+        elif value < high - hysteresis and active and not latch:
+            active = False
+            changes.append((k, False))
+    return active, changes
+
+
+def changes(result):
+    new, samples, values, states = result
+    return bool(new[0]), list(zip(samples.tolist(), states.tolist()))
+
+
+def test_raised_again_dated_by_first_trip_after_clear():
+    block = [0.5, 1.1, 0.9, 0.75, 0.7, 1.05, 0.95]
+    assert changes(settle(block)) == (True, [(1, True), (3, False), (5, True)])
+
+
+def test_raised_cleared_and_raised_again():
+    block = [1.1, 0.5, 1.2, 0.9]
+    assert changes(settle(block)) == (True, [(0, True), (1, False), (2, True)])
+
+
+def test_transient_alarm_inside_a_block_is_reported():
+    block = [0.5, 1.3, 0.6, 0.5]
+    assert changes(settle(block)) == (False, [(1, True), (2, False)])
+
+
+def test_latched_alarm_does_not_clear():
+    block = [1.1, 0.5, 1.2, 0.5]
+    assert changes(settle(block, latch=True)) == (True, [(0, True)])
+
+
+def test_single_sample():
+    assert changes(settle([1.5])) == (True, [(0, True)])
+    assert changes(settle([0.5], active=True)) == (False, [(0, False)])
+    assert changes(settle([0.9], active=True)) == (True, [])
+
+
+def test_matches_sample_by_sample_reference():
+    rs = np.random.RandomState(1)
+    for _ in range(200):
+        block = 1 + 0.3*rs.randn(rs.randint(1, 20))
+        active = bool(rs.randint(2))
+        latch = bool(rs.randint(2))
+        assert changes(settle(block, active=active, latch=latch)) == \
+            reference(block, active=active, latch=latch)
+
+
+def test_block_events_carry_time_and_value():
+    engine = AlarmEngine()
+    rules = AlarmRules('Beam_Balances', ['X1', 'X2'], high=1.0, hysteresis=0.2)
+    engine.add(rules)
+    check = rules.blockListener(['X1', 'X2'])
+    block = np.array([[0.5, 1.1, 0.9, 0.75, 0.7, 1.05, 0.95],
+                      [1.1, 0.5, 1.2, 0.9, 0.9, 0.9, 0.9]]).T
+    check(100 + 0.01*np.arange(len(block)), block)
+    events = []
+    while not engine.queue.empty():
+        events.append(engine.queue.get())
+    found = sorted((e.dataName, round(e.time, 2), e.active, e.value) for e in events)
+    assert found == [('X1', 100.01, True, 1.1), ('X1', 100.03, False, 0.75),
+                     ('X1', 100.05, True, 1.05),
+                     ('X2', 100.0, True, 1.1), ('X2', 100.01, False, 0.5),
+                     ('X2', 100.02, True, 1.2)]
+    assert rules.states().tolist() == [1, 1]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of resampling channels onto a common time grid (TimeAlignment.py)
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from Records import RecordBuffer
+from SimulatedDevices import SimulatedServer
+from TimeAlignment import GridAligner, originTimestamp
+
+
+class Channel(object):
+    def __init__(self, name, dataNames):
+        self.name = 'Hybrid_' + name
+        self.dataNames = dataNames
+        self.buffer = RecordBuffer(dataNames, 16)
+
+
+class Publisher(object):
+    def __init__(self):
+        self.records = []
+
+    def publish(self, chan, record, archiveOnly=False):
+        self.records.append(record)
+        return True
+
+
+@pytest.mark.parametrize('now, scale, integer', [(lambda: time.time(), 1.0, False),
+                                                 (lambda: int(time.time()*1e9), 1e9, True),
+                                                 (lambda: time.time()*1e3, 1e3, False),
+                                                 (lambda: int(time.time()*2**32), 2.0**32, True)])
+def test_origin_timestamp_recognizes_the_units(now, scale, integer):
+    timestamp = originTimestamp(now)
+    t = time.time()
+    stamp = timestamp(t)
+    assert isinstance(stamp, (int, long)) == integer
+    assert abs(stamp/scale - t) < 1e-3
+
+
+def test_channels_at_offset_rates_are_interpolated_onto_the_grid():
+    t0 = int(time.time()) - 100
+    temp = Channel('Temp', ['Coils'])
+    pickoffs = Channel('Beam_Balances', ['X1', 'X2'])
+    timestamp = originTimestamp(lambda: int(time.time()*1e9))
+    aligner = GridAligner('Aligned', [temp, pickoffs], SimulatedServer(), 1.0, timestamp)
+    publisher = Publisher()
+    # Temp every 0.3 s, the pickoffs every 0.7 s from 0.1 s on, both linear
+    samples = [(t0 + 0.3*i, temp, lambda t: [2*(t - t0)]) for i in range(30)]
+    samples += [(t0 + 0.1 + 0.7*i, pickoffs, lambda t: [100 - (t - t0), 0.5]) for i in range(13)]
+    for t, chan, signal in sorted(samples, key=lambda sample: sample[0]):
+        record = chan.buffer.next()
+        record.values[:] = signal(t)
+        aligner.add(chan, t, record, 'time', publisher)
+    # from the first sample of all at t0 to the last grid point the pickoffs
+    # caught up to
+    stamps = [published['time'] for published in publisher.records]
+    grid = t0 + np.arange(len(stamps))
+    assert stamps == [int(round(g*1e9)) for g in grid]
+    assert grid[-1] == t0 + 8
+    coils = np.array([published['Temp_Coils'] for published in publisher.records])
+    x1 = np.array([published['Beam_Balances_X1'] for published in publisher.records])
+    x2 = np.array([published['Beam_Balances_X2'] for published in publisher.records])
+    assert np.allclose(coils, 2*(grid - t0))
+    # the pickoffs start after the first grid point
+    assert np.isnan(x1[0]) and np.isnan(x2[0])
+    assert np.allclose(x1[1:], 100 - (grid[1:] - t0))
+    assert np.allclose(x2[1:], 0.5)
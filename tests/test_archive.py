@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the range queries of the local archive (StreamArchive.py)
+"""
+
+import numpy as np
+import pytest
+
+from StreamArchive import StreamArchive
+
+
+@pytest.fixture
+def archive(tmpdir):
+    archive = StreamArchive(str(tmpdir), 'Hybrid_Temp', ['Coils', 'Chamber'], indexEvery=16)
+    for i in range(200):
+        archive.append(10.0 + 0.5*i, {'Coils' : float(i), 'Chamber' : -float(i)})
+    return archive
+
+
+@pytest.mark.parametrize('start, stop', [(None, None), (10.0, 20.0), (9.0, 10.25),
+                                         (17.75, 17.75), (50.2, 95.0), (100.0, None),
+                                         (None, 42.0), (200.0, 300.0)])
+def test_query_matches_the_rows_in_range(archive, start, stop):
+    timestamps = 10.0 + 0.5*np.arange(200)
+    inRange = np.ones(200, dtype=bool)
+    if start is not None:
+        inRange &= timestamps >= start
+    if stop is not None:
+        inRange &= timestamps < stop
+    data = archive.query(start, stop)
+    assert np.array_equal(data['timestamp'], timestamps[inRange])
+    assert np.array_equal(data['Coils'], np.arange(200.0)[inRange])
+    assert np.array_equal(data['Chamber'], -np.arange(200.0)[inRange])
+    assert sorted(archive.query(start, stop, ['Coils'])) == ['Coils', 'timestamp']
+
+
+def test_reopened_archive_cuts_back_a_torn_row(archive, tmpdir):
+    archive.close()
+    # a crash in the middle of an append left one column a row longer
+    with open(str(tmpdir.join('Hybrid_Temp', 'Coils.f64')), 'ab') as f:
+        f.write(np.array([1e9], dtype='<f8').tobytes())
+    reopened = StreamArchive(str(tmpdir), 'Hybrid_Temp')
+    assert reopened.rows == 200
+    reopened.append(110.0, {'Coils' : 200.0})
+    data = reopened.query(109.0)
+    assert data['timestamp'].tolist() == [109.0, 109.5, 110.0]
+    assert data['Coils'].tolist() == [198.0, 199.0, 200.0]
+    assert np.isnan(data['Chamber'][-1])
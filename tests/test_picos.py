@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the TC-08 streaming mode against the simulated driver
+(PicosMonitor.py)
+"""
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import PicosMonitor
+from DeviceWorkers import DeviceError
+from SimulatedDevices import SimulatedTC08DLL
+
+CHANNELS = {'Chamber' : 1, 'Coils' : 2, 'Near_Terminal' : 3}
+
+
+def streaming(channels, units=1):
+    dll = SimulatedTC08DLL(units=units, conversionTime=0.005)
+    return PicosMonitor.start_tc08(channels, dll=dll, streaming=True), dll
+
+
+def collect(picos, measurements=3):
+    blocks = []
+    picos.add_block_listener(lambda times, block: blocks.append((times.copy(), block.copy())))
+    for _ in range(measurements):
+        time.sleep(0.1)
+        latest = picos.get_temp()
+    return (np.concatenate([times for times, block in blocks]),
+            np.concatenate([block for times, block in blocks]), latest)
+
+
+def test_block_listeners_see_every_reading():
+    picos, dll = streaming(CHANNELS)
+    try:
+        times, block, latest = collect(picos)
+        fetched = dll.runs[picos._handle][2]
+    finally:
+        picos.close_unit()
+    assert picos.mapNames == ['Chamber', 'Coils', 'Near_Terminal']
+    # every reading the driver handed over, complete rows in time order
+    assert len(block) == min(fetched.values()) > 10
+    assert np.all(np.diff(times) > 0)
+    if len(set(fetched.values())) == 1:
+        assert np.allclose(block[-1], [latest[name] for name in picos.mapNames])
+
+
+def test_manager_blocks_cover_all_units():
+    channels = {'Chamber' : (0, 1), 'Coils' : (0, 2), 'Top' : (1, 1)}
+    picos, dll = streaming(channels, units=2)
+    try:
+        times, block, latest = collect(picos)
+    finally:
+        picos.close_unit()
+    assert sorted(picos.mapNames) == sorted(channels)
+    assert block.shape[1] == 3 and len(block) > 10
+    assert np.isfinite(block).all()
+
+
+def test_missing_streamed_readings_raise():
+    picos, dll = streaming(CHANNELS)
+    getTemp = dll.usb_tc08_get_temp
+    def silent(handle, temp, times, length, overflow, channel, units, fill_missing):
+        if channel.value == 2:
+            return 0
+        return getTemp(handle, temp, times, length, overflow, channel, units, fill_missing)
+    dll.usb_tc08_get_temp = silent
+    try:
+        with pytest.raises(DeviceError):
+            picos.get_temp()
+    finally:
+        picos.close_unit()
+
+
+def test_stream_blocks_wait_for_whole_rows():
+    blocks = PicosMonitor.StreamBlocks(['a', 'b'], 4)
+    seen = []
+    blocks.listeners.append(lambda times, block: seen.append(block.copy()))
+    blocks.add(0, np.array([1.0, 2.0, 3.0]), np.array([1.0, 2.0, 3.0]))
+    blocks.add(1, np.array([10.0]), np.array([1.0]))
+    blocks.emit()
+    blocks.add(1, np.array([20.0, 30.0]), np.array([2.0, 3.0]))
+    blocks.emit()
+    assert [block.tolist() for block in seen] == [[[1.0, 10.0]], [[2.0, 20.0], [3.0, 30.0]]]
+
+
+class FailingRunDLL(SimulatedTC08DLL):
+    """
+    The second unit refuses to stream
+    """
+    def usb_tc08_run(self, handle, interval_ms):
+        if _handle(handle) == 2:
+            self.lastError = 5
+            return 0
+        return SimulatedTC08DLL.usb_tc08_run(self, handle, interval_ms)
+
+
+def _handle(handle):
+    return getattr(handle, 'value', handle)
+
+
+def test_failed_start_closes_the_units():
+    dll = FailingRunDLL(units=2, conversionTime=0.005)
+    channels = {'Chamber' : (0, 1), 'Coils' : (1, 2)}
+    with pytest.raises(ValueError):
+        PicosMonitor.start_tc08(channels, dll=dll, streaming=True)
+    assert dll.handles == {} and dll.runs == {}
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('tc08-')]
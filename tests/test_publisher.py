@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the publisher's urgent records, timing statistics, reconnects and
+offline spooling (OriginPublisher.py)
+"""
+
+import threading
+import time
+
+from HybridChannels import channel
+from LoopStats import ChannelStats
+from OriginPublisher import OriginPublisher
+from Records import RecordBuffer
+from SimulatedDevices import SimulatedServer
+
+
+class Connection(object):
+    def __init__(self, name, sent):
+        self.name = name
+        self.sent = sent
+
+    def send(self, **data):
+        self.sent.append((self.name, threading.current_thread().name, data))
+
+
+class Channel(object):
+    def __init__(self, name, sent):
+        self.name = name
+        self.connection = Connection(name, sent)
+        self.stats = ChannelStats()
+
+
+def test_urgent_records_skip_the_batch_wait():
+    sent = []
+    publisher = OriginPublisher(batchSize=100, maxDelay=5.0)
+    publisher.start()
+    try:
+        publisher.publish(Channel('Hybrid_Temp', sent), {'Coils' : 20.0})
+        time.sleep(0.1)
+        publisher.publish(Channel('Hybrid_Alarms', sent), {'Temp_Coils' : 1}, urgent=True)
+        deadline = time.time() + 2
+        while len(sent) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        publisher.stop(10)
+    # sent by the worker long before the batch's maxDelay
+    assert sorted(name for name, thread, data in sent) == ['Hybrid_Alarms', 'Hybrid_Temp']
+    assert set(thread for name, thread, data in sent) == set(['publisher'])
+
+
+def test_urgent_record_wakes_an_idle_worker():
+    sent = []
+    publisher = OriginPublisher(batchSize=100, maxDelay=5.0)
+    publisher.start()
+    try:
+        time.sleep(0.05)
+        start = time.time()
+        publisher.publish(Channel('Hybrid_Alarms', sent), {'Temp_Coils' : 1}, urgent=True)
+        while not sent and time.time() - start < 2:
+            time.sleep(0.01)
+        assert sent and time.time() - start < 1
+    finally:
+        publisher.stop(10)
+
+
+def test_age_counts_from_the_acquisition_time():
+    sent = []
+    chan = Channel('Hybrid_Temp', sent)
+    record = RecordBuffer(['Coils'], 4).next()
+    record.values[:] = 20.0
+    # acquired two seconds before it was handed to the publisher
+    record.stamp(time.time() - 2, 0, 'time')
+    publisher = OriginPublisher(batchSize=1, maxDelay=0.1)
+    publisher.start()
+    try:
+        publisher.publish(chan, record)
+        publisher.publish(chan, {'Coils' : 20.0, 'time' : 0})
+        deadline = time.time() + 2
+        while len(sent) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        publisher.stop(10)
+    age = chan.stats.age.snapshot()
+    assert age['count'] == 2
+    assert 2 <= age['max'] < 3
+    assert age['mean'] < 1.5
+
+
+class RecordingServer(SimulatedServer):
+    """
+    SimulatedServer noting when streams are registered and what they receive
+    """
+    def __init__(self):
+        super(RecordingServer, self).__init__(onReceive=self.receive)
+        self.attempts = []
+        self.received = []
+
+    def registerStream(self, stream, records, timeout=None):
+        self.attempts.append(time.time())
+        return super(RecordingServer, self).registerStream(stream, records, timeout)
+
+    def receive(self, stream, data, t):
+        self.received.append(data['n'])
+
+
+def publishThroughOutage(publisher, server, outage=0.8, count=100):
+    """
+    Publishes count records of a channel every 20 ms, taking the server down
+    after a third of them, and waits until all are received or dropped
+    """
+    chan = channel('Counter', 'float', server, ['n'])
+    del server.attempts[:]
+    publisher.start()
+    try:
+        for n in range(count):
+            if n == count//3:
+                server.outage(outage)
+            publisher.publish(chan, {'n' : float(n)})
+            time.sleep(0.02)
+        deadline = time.time() + outage + 5
+        while ((publisher.offline or len(server.received) + publisher.dropped < count)
+               and time.time() < deadline):
+            time.sleep(0.02)
+    finally:
+        publisher.stop(10)
+    return publisher.stats()
+
+
+def test_reconnect_backs_off_up_to_the_maximum_interval():
+    server = RecordingServer()
+    publisher = OriginPublisher(batchSize=1, maxDelay=0.01, retryInterval=0.05,
+                                maxRetryInterval=0.4)
+    stats = publishThroughOutage(publisher, server)
+    first = server.attempts[0] - (server.downUntil - 0.8)
+    gaps = [b - a for a, b in zip(server.attempts, server.attempts[1:])]
+    # attempts 0.05, 0.15, 0.35, 0.75 s into the 0.8 s outage fail, the
+    # interval doubles up to 0.4 s and the attempt at 1.15 s succeeds
+    assert 0.05 <= first < 0.1
+    assert len(gaps) == 4
+    assert [round(gap, 1) for gap in gaps] == [0.1, 0.2, 0.4, 0.4]
+    assert stats['reconnects'] == 1
+    assert stats['offline'] == []
+    # without a spool the records of the outage are lost, the rest arrive
+    assert stats['dropped'] > 0
+    assert len(server.received) + stats['dropped'] == 100
+    assert server.received[-1] == 99.0
+
+
+def test_offline_records_are_spooled_and_replayed_in_order(tmpdir):
+    server = RecordingServer()
+    publisher = OriginPublisher(batchSize=1, maxDelay=0.01, retryInterval=0.05,
+                                maxRetryInterval=0.2, replayChunk=4,
+                                spoolDirectory=str(tmpdir))
+    stats = publishThroughOutage(publisher, server)
+    assert server.received == [float(n) for n in range(100)]
+    assert stats['reconnects'] == 1
+    assert stats['spooled'] > 10
+    assert stats['replayed'] == stats['spooled']
+    assert stats['spool depth'] == 0
+    assert stats['dropped'] == 0
+    assert stats['offline'] == []
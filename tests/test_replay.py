@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of replaying archived records (Replay.py)
+"""
+
+import numpy as np
+
+import Replay
+from StreamArchive import StreamArchive
+
+CONFIG = """
+[Channel Beam_Balances]
+device = PickoffMonitor
+inputs = X1:ai4, X2:ai2
+
+[Alarms Beam_Balances]
+high = 1.0
+"""
+
+
+def test_alarm_states_get_the_timestamps_of_the_archive(tmpdir):
+    archive = StreamArchive(str(tmpdir.join('archive')), 'Hybrid_Beam_Balances', ['X1', 'X2'])
+    # timestamps in ns like origin's, X1 goes above its limit and back
+    for i in range(100):
+        archive.append(1700000000*10**9 + i*10**8,
+                       {'X1' : 1.5 if 40 <= i < 60 else 0.5, 'X2' : 0.5})
+    archive.close()
+    config = tmpdir.join('HybridMonitor.cfg')
+    config.write(CONFIG)
+    Replay.main(['--archive', str(tmpdir.join('archive')), '--config', str(config),
+                 '--target', 'archive', '--output', str(tmpdir.join('out'))])
+    records = StreamArchive(str(tmpdir.join('out')), 'Hybrid_Beam_Balances').query()
+    alarms = StreamArchive(str(tmpdir.join('out')), 'Hybrid_Alarms').query()
+    assert len(records['timestamp']) == 100
+    # raised by the 40th record, cleared by the 60th
+    assert np.array_equal(alarms['timestamp'], records['timestamp'][[40, 60]])
+    assert alarms['Beam_Balances_X1'].tolist() == [1, 0]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the reporting policies (ReportingPolicy.py)
+"""
+
+import numpy as np
+
+from ReportingPolicy import ReportingPolicy
+
+
+class Record(object):
+    def __init__(self, values):
+        self.values = np.array(values, dtype=np.float64)
+
+
+def run(policy, times, values):
+    reported = []
+    for t, row in zip(times, values):
+        for record in policy.filter(t, Record(row)):
+            reported.append(record)
+    return reported
+
+
+def test_deadbands_and_heartbeat():
+    policy = ReportingPolicy(['A', 'B'], absolute=[0.5, None], relative=[None, 0.1],
+                             heartbeat=10)
+    values = [(0, 100), (0.4, 105), (0.6, 105), (0.6, 109), (0.6, 121), (0.6, 121)]
+    reported = run(policy, [0, 1, 2, 3, 4, 14], values)
+    # the first record, A moved 0.6 > 0.5, B moved 21 > 10% of 100, heartbeat
+    assert [tuple(record.values) for record in reported] == [(0, 100), (0.6, 105),
+                                                             (0.6, 121), (0.6, 121)]
+    assert policy.reported == 4 and policy.suppressed == 2
+
+
+def test_swinging_door_reconstructs_within_deviation():
+    deviation = 0.05
+    times = np.arange(0, 50, 0.5)
+    signal = np.column_stack((np.sin(0.2*times), 0.01*times))
+    policy = ReportingPolicy(['A', 'B'], swinging_door=deviation)
+    reported = run(policy, times, signal)
+    # the held back point ends the sequence
+    reported.append(policy.held[2])
+    points = dict((tuple(record.values), None) for record in reported)
+    rows = [i for i in range(len(times)) if tuple(signal[i]) in points]
+    assert len(rows) < len(times)/2
+    for column in range(2):
+        interpolated = np.interp(times, times[rows], signal[rows, column])
+        assert np.abs(interpolated - signal[:, column]).max() <= deviation + 1e-12
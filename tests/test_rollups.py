@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the rollups against numpy's statistics
+"""
+
+import numpy as np
+
+from HybridChannels import channel
+from Records import RecordBuffer
+from Rollups import Rollup, RollupStage
+from SimulatedDevices import SimulatedServer
+
+
+class Publisher(object):
+    def __init__(self):
+        self.records = []
+
+    def publish(self, chan, record, archiveOnly=False):
+        self.records.append((chan.name, record))
+        return True
+
+
+def test_rollup_matches_numpy():
+    random = np.random.RandomState(1)
+    # temperatures, the sums must not lose the std to the offset
+    values = 300 + 0.01*random.standard_normal((50, 2))
+    times = np.linspace(0, 4.9, 50)
+    rollup = Rollup(1.0, ['A', 'B'])
+    records = [rollup.add(t, t, row) for t, row in zip(times, values)]
+    records = [record for record in records if record is not None] + [rollup.flush()]
+    assert rollup.flush() is None
+    assert len(records) == 5
+    for bucket, record in enumerate(records):
+        reference = values[(times >= bucket) & (times < bucket + 1)]
+        assert record['count'] == len(reference)
+        for i, name in enumerate(['A', 'B']):
+            assert np.isclose(record[name + '_mean'], reference[:, i].mean(), rtol=0, atol=1e-12)
+            assert np.isclose(record[name + '_std'], reference[:, i].std(), rtol=1e-6)
+            assert record[name + '_min'] == reference[:, i].min()
+            assert record[name + '_max'] == reference[:, i].max()
+
+
+def test_flush_publishes_the_last_buckets():
+    server = SimulatedServer()
+    chan = channel('Temp', 'float', server, ['A'])
+    stage = RollupStage(chan, server, (1, 10))
+    publisher = Publisher()
+    buffer = RecordBuffer(['A'], 16)
+    for i in range(25):
+        record = buffer.next()
+        record.values[:] = i
+        record.stamp(0.1*i, 0.1*i, 'time')
+        stage.add(record, 0.1*i, 'time', publisher)
+    stage.hang()
+    counts = {}
+    for name, record in publisher.records:
+        counts[name] = counts.get(name, 0) + record['count']
+    assert counts == {'Hybrid_Temp_1s' : 25, 'Hybrid_Temp_10s' : 25}
+    assert publisher.records[-1][1]['time'] == 0.1*24
+    assert all(stream.closed for name, stream in server.streams.items() if name != 'Hybrid_Temp')
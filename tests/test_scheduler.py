@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the deadline scheduler (ChannelScheduler.py)
+"""
+
+import time
+
+import numpy as np
+
+from ChannelScheduler import ChannelScheduler
+from DeviceWorkers import DeviceError
+
+
+class Channel(object):
+    def __init__(self, name, period, duration=0.0, error=None):
+        self.name = name
+        self.period = period
+        self.duration = duration    # seconds a measurement takes
+        self.error = error          # raised by the first measurement
+        self.calls = []
+
+
+def measure(channel):
+    channel.calls.append(time.time())
+    if channel.duration:
+        time.sleep(channel.duration)
+    if channel.error is not None and len(channel.calls) == 1:
+        raise channel.error
+
+
+def run(channels, duration):
+    scheduler = ChannelScheduler(channels, measure, recoverable=(DeviceError,))
+    scheduler.start()
+    time.sleep(duration)
+    scheduler.stop(1)
+    return scheduler
+
+
+def test_periods_are_kept_without_drift():
+    fast = Channel('fast', 0.05, duration=0.01)
+    slow = Channel('slow', 0.2)
+    scheduler = run([fast, slow], 1.0)
+    assert 19 <= len(fast.calls) <= 21
+    assert 5 <= len(slow.calls) <= 6
+    # on the deadline grid, the measurement time does not add up
+    offsets = np.array(fast.calls) - fast.calls[0] - 0.05*np.arange(len(fast.calls))
+    assert np.abs(offsets).max() < 0.02
+    assert scheduler.missed == {'fast' : 0, 'slow' : 0}
+
+
+def test_overruns_skip_deadlines():
+    overrun = Channel('overrun', 0.05, duration=0.12)
+    scheduler = run([overrun], 0.8)
+    intervals = np.diff(overrun.calls)
+    # the next slot after the overrun, not the missed ones back to back
+    assert np.allclose(intervals, 0.15, atol=0.02)
+    # two slots missed by every measurement
+    assert scheduler.missed['overrun'] == 2*len(overrun.calls)
+
+
+def test_wake_measures_right_away():
+    idle = Channel('idle', 10.0)
+    scheduler = ChannelScheduler([idle], measure)
+    scheduler.start()
+    time.sleep(0.1)
+    woken = time.time()
+    scheduler.wake(idle)
+    time.sleep(0.1)
+    scheduler.stop(1)
+    assert len(idle.calls) == 2
+    assert idle.calls[1] - woken < 0.05
+
+
+def test_recoverable_errors_only_skip_a_measurement():
+    device = Channel('device', 0.05, error=DeviceError('timeout'))
+    other = Channel('other', 0.05)
+    scheduler = run([device, other], 0.3)
+    assert scheduler.failed['device'] == 1 and not scheduler.errors
+    assert len(device.calls) > 3
+    broken = Channel('broken', 0.05, error=ValueError('bug'))
+    scheduler = run([broken, Channel('other', 0.05)], 0.2)
+    assert not scheduler.is_running()
+    assert [channel for channel, info in scheduler.errors] == [broken]
+    assert len(broken.calls) == 1
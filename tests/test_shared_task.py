@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the decimation of the shared continuous DAQ task
+"""
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from DeviceWorkers import DeviceError
+from PickoffMonitor import SharedAITask
+from SimulatedDevices import SimulatedNIDAQmx
+
+
+def test_decimated_samples_are_box_filtered_alike_in_blocks_and_read():
+    # 3250 Hz would alias to 250 Hz at 1 kHz with an amplitude of 0.5
+    daq = SimulatedNIDAQmx(voltages=(1.0,), noise=0.0, tones=((3250, 0.5),))
+    task = SharedAITask('Dev1', daq)
+    lock = threading.Lock()
+    blocks = []
+    times = []
+    def listener(t, block):
+        with lock:
+            blocks.append(block.copy())
+            times.append(t.copy())
+    # blocks of 700 samples, the groups of 10 span two blocks
+    fast = task.subscribe(['ai0'], 10000, 700, 10000)
+    slow = task.subscribe(['ai1'], 1000, 100, 500, listener)
+    time.sleep(0.5)
+    task.unsubscribe(fast)
+    task.unsubscribe(slow)
+    samples = np.concatenate(blocks)[:, 0]
+    t = np.concatenate(times)
+    assert len(samples) > 100
+    assert np.abs(samples - 1.0).max() < 0.05
+    # dated within a block by the sample clock, across blocks by arrival
+    assert all(np.allclose(np.diff(block), 1e-3, rtol=0, atol=1e-6) for block in times)
+    values, middle = task.read(slow, 50, np.array)
+    assert np.array_equal(values[:, 0], samples[-50:])
+    assert abs(middle - 0.5*(t[-50] + t[-1])) < 1e-6
+
+
+class MissingInputDAQ(SimulatedNIDAQmx):
+    """
+    A device without ai99
+    """
+    def DAQmxCreateAIVoltageChan(self, handle, channels, *args):
+        if 'ai99' in getattr(channels, 'value', channels):
+            return -200170
+        return SimulatedNIDAQmx.DAQmxCreateAIVoltageChan(self, handle, channels, *args)
+
+
+def test_failed_subscriber_leaves_the_others_running():
+    daq = MissingInputDAQ()
+    task = SharedAITask('Dev1', daq)
+    blocks = []
+    healthy = task.subscribe(['ai0'], 1000, 100, 1000, lambda t, block: blocks.append(len(block)))
+    with pytest.raises(DeviceError):
+        task.subscribe(['ai99'], 1000, 100, 1000)
+    assert task.subscriptions == [healthy] and task.inputs == ['ai0']
+    # the half created task was cleared, the healthy one runs again
+    assert len(daq.tasks) == 1
+    count = len(blocks)
+    time.sleep(0.3)
+    assert len(blocks) > count
+    other = task.subscribe(['ai1'], 1000, 100, 1000)
+    task.unsubscribe(other)
+    task.unsubscribe(healthy)
+    assert daq.tasks == {}
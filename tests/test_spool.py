@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the store-and-forward spool (StreamSpool.py)
+"""
+
+from StreamSpool import HEADER_SIZE, StreamSpool
+
+TIMESTAMP = 'measurement_time'
+
+
+def records(n, start=0):
+    return [{TIMESTAMP : 1000 + i, 'X1' : 0.5*i} for i in range(start, start + n)]
+
+
+def drain(spool, chunk=7):
+    replayed = []
+    while True:
+        batch = spool.peek(chunk)
+        if not batch:
+            return replayed
+        replayed.extend(batch)
+        spool.commit(len(batch))
+
+
+def test_reopen_returns_unreplayed_records(tmpdir):
+    spool = StreamSpool(str(tmpdir), 'Hybrid_Temp', timestampKey=TIMESTAMP)
+    for data in records(10):
+        spool.append(data)
+    spool.commit(len(spool.peek(4)))
+    spool.close()
+    spool = StreamSpool(str(tmpdir), 'Hybrid_Temp', timestampKey=TIMESTAMP)
+    assert len(spool) == 6
+    replayed = drain(spool)
+    assert replayed == records(6, 4)
+    assert all(isinstance(data[TIMESTAMP], (int, long)) for data in replayed)
+    spool.close()
+
+
+def test_replay_across_segments(tmpdir):
+    # room for 5 records of two fields per segment
+    spool = StreamSpool(str(tmpdir), 'Hybrid_Temp', segmentBytes=HEADER_SIZE + 5*16,
+                        timestampKey=TIMESTAMP)
+    for data in records(23):
+        spool.append(data)
+    assert len(spool.segments) == 5
+    assert drain(spool) == records(23)
+    assert len(spool) == 0
+    assert len(tmpdir.listdir()) == 1
+    spool.close()
+
+
+def test_replay_continues_after_exhausted_segment(tmpdir):
+    spool = StreamSpool(str(tmpdir), 'Hybrid_Temp', timestampKey=TIMESTAMP)
+    for data in records(3):
+        spool.append(data)
+    assert drain(spool) == records(3)
+    # new fields start a new segment behind the replayed one
+    later = [dict(data, X2=1.0) for data in records(4, 3)]
+    for data in later:
+        spool.append(data)
+    assert drain(spool) == later
+    spool.close()
+
+
+def test_full_spool_drops_oldest_segment(tmpdir):
+    spool = StreamSpool(str(tmpdir), 'Hybrid_Temp', segmentBytes=HEADER_SIZE + 5*16,
+                        maxSegments=2, timestampKey=TIMESTAMP)
+    for data in records(12):
+        spool.append(data)
+    assert spool.dropped == 5
+    assert drain(spool) == records(7, 5)
+    spool.close()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the checks ChannelStartup makes before opening a device
+"""
+
+import ConfigParser
+import io
+
+import pytest
+
+import PickoffMonitor
+from Alarms import AlarmEngine, load_alarms
+from ChannelStartup import ChannelStartup, I2VDevice, daq_channels
+from SimulatedDevices import SimulatedNIDAQmx, SimulatedServer
+
+
+def config(text):
+    parser = ConfigParser.RawConfigParser()
+    parser.optionxform = str
+    parser.readfp(io.BytesIO(text))
+    return parser
+
+
+CHANNEL = """
+[Channel Beam_Balances]
+device = PickoffMonitor
+inputs = X1:ai4, X2:ai2
+continuous = %s
+process = true
+"""
+
+
+@pytest.mark.parametrize('section', ['[Alarms Beam_Balances]\nhigh = 1\n',
+                                     '[Adaptive Beam_Balances]\nmin_period = 1\nmax_period = 10\n'])
+def test_block_listeners_refused_in_worker_process(section):
+    cfg = config(CHANNEL % 'true' + section)
+    spec = I2VDevice(PickoffMonitor, cfg, 'Channel Beam_Balances')
+    startup = ChannelStartup(cfg, None, None)
+    with pytest.raises(ValueError):
+        startup.openDevice('Beam_Balances', 'Channel Beam_Balances', spec)
+
+
+TRIGGERED = """
+[Channel Beam_Balances]
+device = PickoffMonitor
+inputs = X1:ai4, X2:ai2
+continuous = false
+
+[Channel Mag]
+device = MagSensor
+axes = Bx:ai8, By:ai9, Bz:ai10
+"""
+
+
+def test_triggered_channel_refused_next_to_continuous_one():
+    cfg = config(TRIGGERED)
+    assert daq_channels(cfg) == [('Beam_Balances', 'PXI2Slot6', False),
+                                 ('Mag', 'PXI2Slot6', True)]
+    startup = ChannelStartup(cfg, None, None)
+    with pytest.raises(ValueError):
+        startup.checkDAQ('Beam_Balances')
+    startup.checkDAQ('Mag')
+    startup.names = ['Beam_Balances']
+    startup.checkDAQ('Beam_Balances')
+    cfg.set('Channel Mag', 'daq', 'PXI2Slot7')
+    startup.names = None
+    startup.checkDAQ('Beam_Balances')
+
+
+class SimulatedStartup(ChannelStartup):
+    """
+    Opens the devices on the simulated DAQ
+    """
+    def openDevice(self, name, section, spec):
+        spec.kwargs['nidaq'] = SimulatedNIDAQmx()
+        return ChannelStartup.openDevice(self, name, section, spec)
+
+
+def test_streams_closed_when_channel_fails_to_start():
+    cfg = config(CHANNEL % 'false' + 'rollups = 1, 10\n'
+                 '[Alarms Beam_Balances]\nhigh = 1\n'
+                 '[Adaptive Beam_Balances]\nmin_period = 1\n')
+    cfg.set('Channel Beam_Balances', 'process', 'false')
+    server = SimulatedServer()
+    alarms = AlarmEngine()
+    temp = load_alarms(config('[Alarms Temp]\nhigh = 30\n'), 'Temp', ['Coils'], alarms)
+    startup = SimulatedStartup(cfg, server, None, alarms=alarms)
+    with pytest.raises(ValueError):
+        startup.open('Beam_Balances', 'Channel Beam_Balances')
+    assert len(server.streams) == 3
+    assert all(stream.closed for stream in server.streams.values())
+    # the rules of the channel are not checked or sent either
+    assert alarms.rules == [temp]
+    assert alarms.dataNames == ['Temp_Coils'] and temp.offset == 0
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the streaming Welch spectrum of the magnetic field sensor
+(MagSensor.py) against scipy's
+"""
+
+import numpy as np
+import pytest
+
+from MagSensor import StreamingWelch
+
+signal = pytest.importorskip('scipy.signal')
+
+
+@pytest.mark.parametrize('overlap', [0.5, 0.25, 0.0])
+def test_streaming_welch_matches_scipy(overlap):
+    rate = 1000.0
+    random = np.random.RandomState(2)
+    t = np.arange(5000)/rate
+    samples = np.column_stack((0.3 + np.sin(2*np.pi*60*t), 0.1*np.sin(2*np.pi*180*t)))
+    samples += 0.05*random.standard_normal(samples.shape)
+    welch = StreamingWelch(rate, 2, 256, overlap)
+    # blocks which do not line up with the segments
+    for start in range(0, len(samples), 337):
+        welch.add(samples[start:start + 337])
+    freqs, reference = signal.welch(samples, rate, window='hann', nperseg=256,
+                                    noverlap=256 - welch.step, detrend='constant',
+                                    scaling='density', axis=0)
+    assert np.allclose(welch.freqs, freqs)
+    assert welch.segments == (len(samples) - 256)//welch.step + 1
+    assert np.allclose(welch.psd(), reference, rtol=1e-10, atol=1e-15)
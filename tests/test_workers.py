@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the device worker processes, their shared ring and their supervisor
+(DeviceWorkers.py)
+"""
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+from DeviceWorkers import DeviceProcess, DeviceSupervisor, DeviceUnavailable, SampleRing
+
+
+class Counter(object):
+    """
+    Device counting its measurements. If crashFile is given, the worker exits
+    at measurement crashAt unless the file exists, which it creates first, so
+    only the first worker crashes.
+    """
+    def __init__(self, crashAt=None, crashFile=None):
+        self.count = 0
+        self.crashAt = crashAt
+        self.crashFile = crashFile
+
+    def measure(self):
+        self.count += 1
+        if self.count == self.crashAt and not os.path.exists(self.crashFile):
+            open(self.crashFile, 'w').close()
+            os._exit(1)
+        self.acquisition_time = 1000.0 + self.count
+        return {'n' : float(self.count), 'twice' : 2.0*self.count}
+
+
+def counter(**kwargs):
+    worker = DeviceProcess(Counter, kwargs=kwargs, dataNames=['n', 'twice'],
+                           capacity=4, timeout=5.0, name='counter')
+    worker.start()
+    return worker
+
+
+def test_ring_wraps_around_in_place():
+    ring = SampleRing(['a', 'b'], capacity=3)
+    for i in range(5):
+        assert ring.write(float(i), {'a' : i, 'b' : -i}) == i
+    assert ring.written == 5
+    assert ring.record(4) == (4.0, {'a' : 4.0, 'b' : -4.0})
+    with pytest.raises(IndexError):
+        ring.row(1)
+    assert ring.latest(5).tolist() == [[2, 2, -2], [3, 3, -3], [4, 4, -4]]
+
+
+def test_worker_records_wrap_around_the_shared_ring():
+    worker = counter()
+    try:
+        measured = [worker.measure() for _ in range(10)]
+        times = worker.acquisition_time
+        out = np.zeros(2)
+        worker.measure_into(out, worker.value_order(['twice', 'n']))
+    finally:
+        worker.stop()
+    assert [data['n'] for data in measured] == range(1, 11)
+    assert times == 1010.0
+    assert out.tolist() == [22.0, 11.0]
+    # the worker wrote the records to the ring the main process reads
+    assert worker.ring.written == 11
+    assert worker.ring.latest(4).tolist() == [[1000.0 + n, n, 2*n] for n in range(8, 12)]
+    with pytest.raises(IndexError):
+        worker.ring.record(6)
+
+
+def test_supervisor_restarts_a_crashed_worker(tmpdir):
+    worker = counter(crashAt=3, crashFile=str(tmpdir.join('crashed')))
+    supervisor = DeviceSupervisor([worker], interval=0.05)
+    supervisor.start()
+    try:
+        assert worker.measure()['n'] == 1
+        assert worker.measure()['n'] == 2
+        with pytest.raises(DeviceUnavailable):
+            worker.measure()
+        deadline = time.time() + 10
+        while worker.restarts == 0 or not worker.ready:
+            assert time.time() < deadline, 'the worker was not restarted'
+            time.sleep(0.05)
+        # a new device, writing on into the same ring
+        assert worker.measure()['n'] == 1
+        assert worker.ring.written == 3
+    finally:
+        supervisor.stop(5)
+        worker.stop()
+    assert worker.restarts == 1
+    assert not worker.is_alive()
+    assert not worker.needs_restart()